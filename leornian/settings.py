@@ -27,6 +27,12 @@ DATABASES = {
     }
 }
 
+# Cached note data (card fragments, Discover pool, Drill samplers, etc.) is
+# updated in place as notes change, so all web workers and management
+# commands must share one cache; the default in-memory cache is per process
+# and only suitable for a single process in dev:
+CACHES = {"default": env.cache("LEOR_CACHE_URL", default="locmemcache://")}
+
 
 # Application definition
 
@@ -8,8 +8,8 @@ from django.utils import timezone
 from django.utils.text import slugify
 from django.views.generic import FormView, TemplateView
 from django_registration.backends.activation.views import RegistrationView as DjRegView
-from markdown_it import MarkdownIt
 
+from leornian_helpers.markdown import renderer
 from leornian_helpers.mixins import CaptchaFormMixin
 from notes.views import Start
 
@@ -38,8 +38,8 @@ class TermsAndPrivacy(TemplateView):
             },
         )
         # before actually rendering to HTML. The source is trusted so
-        # we can use default MarkdownIt configuration (usually unsafe):
-        content = safestring.mark_safe(MarkdownIt().render(content))
+        # we can use the default configuration (usually unsafe):
+        content = safestring.mark_safe(renderer.render(content, "trusted"))
         kwargs.update({"terms_and_privacy": content})
         return super().get_context_data(**kwargs)
 
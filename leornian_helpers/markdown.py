@@ -0,0 +1,210 @@
+"""
+Shared Markdown rendering service.
+
+Parsers are built once per process for each configured preset, and rendered
+output is kept in a size-bounded LRU cache keyed by a hash of the preset and
+source text. The module intentionally has no Django dependencies so that it
+can also be used from worker processes.
+"""
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+from markdown_it import MarkdownIt
+
+PRESETS = {
+    # Restricted subset allowed in user-submitted notes:
+    "note": (
+        "zero",
+        ["emphasis", "strikethrough", "backticks", "entity", "escape", "list"],
+    ),
+    # Default (CommonMark) configuration, which allows raw HTML. Only use
+    # this for trusted sources:
+    "trusted": ("commonmark", []),
+}
+
+
+# ------------------------------------
+# Fast path for the restricted subset
+# ------------------------------------
+
+# Characters that may trigger an enabled inline rule other than `*` emphasis
+# (`_` emphasis, strikethrough, backticks, entities, escapes), and characters
+# that markdown-it normalizes or treats specially as whitespace:
+_FAST_PATH_BLOCKERS = re.compile(r"[_~`\\&\r\0]|[^\S \n]")
+_LIST_MARKER = re.compile(r"(?:[-+*]|[0-9]{1,9}[.)])(?: |$)")
+_WORD_SEPARATOR = re.compile(r"([ \n]+)")
+_EMPHASIZED_WORD = re.compile(
+    r"(\*{1,3})([A-Za-z0-9](?:[^*]*[A-Za-z0-9])?)\1([.,;:!?]*)"
+)
+_EMPHASIS_TAGS = {
+    1: ("<em>", "</em>"),
+    2: ("<strong>", "</strong>"),
+    3: ("<em><strong>", "</strong></em>"),
+}
+
+
+def _escape_html(text):
+    return text.replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+def render_note_fast(text):
+    """
+    Render the common shapes of note text without the markdown-it pipeline.
+
+    Handles paragraphs of plain words, where `*` only appears as balanced
+    emphasis wrapping a single word (e.g., `*foo*`, `**foo**,`). Returns
+    None for anything else, in which case the full parser must be used. The
+    output is byte-identical to that of the "note" preset.
+    """
+    if _FAST_PATH_BLOCKERS.search(text):
+        return None
+
+    output = []
+    paragraph = []
+    for line in text.split("\n") + [""]:
+        if not line.strip(" "):
+            if paragraph:
+                inline = _render_inline_fast("\n".join(paragraph))
+                if inline is None:
+                    return None
+                output.append(f"<p>{inline}</p>\n")
+                paragraph = []
+            continue
+        if line[0] == " " or line[-1] == " " or _LIST_MARKER.match(line):
+            return None
+        paragraph.append(line)
+    return "".join(output)
+
+
+def _render_inline_fast(content):
+    parts = _WORD_SEPARATOR.split(content)
+    # Separators are at odd indices and are output as-is:
+    for index in range(0, len(parts), 2):
+        word = parts[index]
+        if "*" not in word:
+            parts[index] = _escape_html(word)
+            continue
+        match = _EMPHASIZED_WORD.fullmatch(word)
+        if not match:
+            return None
+        delimiters, inner, trailing = match.groups()
+        opening, closing = _EMPHASIS_TAGS[len(delimiters)]
+        parts[index] = opening + _escape_html(inner) + closing + trailing
+    return "".join(parts)
+
+
+FAST_RENDERERS = {"note": render_note_fast}
+
+
+class MarkdownRenderer:
+    """Render Markdown with pooled parsers and an LRU cache of the output."""
+
+    def __init__(
+        self, presets=None, fast_renderers=None, max_cache_bytes=8 * 1024 * 1024
+    ):
+        self.presets = PRESETS if presets is None else presets
+        self.fast_renderers = (
+            FAST_RENDERERS if fast_renderers is None else fast_renderers
+        )
+        self.max_cache_bytes = max_cache_bytes
+        self.hits = 0
+        self.misses = 0
+        self.fast_renders = 0
+        self._parsers = {}
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+
+    def get_parser(self, preset):
+        """Return the parser for `preset`, building it on first use."""
+        try:
+            return self._parsers[preset]
+        except KeyError:
+            config, rules = self.presets[preset]
+            parser = MarkdownIt(config)
+            if rules:
+                parser.enable(rules)
+            return self._parsers.setdefault(preset, parser)
+
+    @staticmethod
+    def cache_key(text, preset):
+        return hashlib.blake2b(
+            text.encode(), digest_size=16, person=preset.encode()[:16]
+        ).digest()
+
+    def _cache_get(self, key):
+        with self._lock:
+            html = self._cache.get(key)
+            if html is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._cache.move_to_end(key)
+            return html
+
+    def _cache_set(self, key, html):
+        # The size accounting is approximate: characters, not encoded bytes,
+        # plus the key itself.
+        size = len(html) + len(key)
+        if size > self.max_cache_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = html
+            self._cache_bytes += size
+            while self._cache_bytes > self.max_cache_bytes:
+                old_key, old_html = self._cache.popitem(last=False)
+                self._cache_bytes -= len(old_html) + len(old_key)
+
+    def render(self, text, preset="note"):
+        """Render `text` to HTML. The output is not marked as safe."""
+        key = self.cache_key(text, preset)
+        html = self._cache_get(key)
+        if html is None:
+            if fast_renderer := self.fast_renderers.get(preset):
+                html = fast_renderer(text)
+            if html is None:
+                html = self.get_parser(preset).render(text)
+            else:
+                self.fast_renders += 1
+            self._cache_set(key, html)
+        return html
+
+    def render_many(self, texts, preset="note"):
+        """
+        Render a sequence of texts, returning a list of HTML strings in the
+        same order. Duplicate texts in the batch are only rendered once.
+        """
+        rendered = {}
+        output = []
+        for text in texts:
+            if text not in rendered:
+                rendered[text] = self.render(text, preset)
+            output.append(rendered[text])
+        return output
+
+    def cache_info(self):
+        """Return cache statistics as a dict."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "fast_renders": self.fast_renders,
+                "entries": len(self._cache),
+                "bytes": self._cache_bytes,
+                "max_bytes": self.max_cache_bytes,
+            }
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+            self._cache_bytes = 0
+            self.hits = self.misses = self.fast_renders = 0
+
+
+renderer = MarkdownRenderer()
+"""Process-wide shared renderer instance."""
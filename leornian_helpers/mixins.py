@@ -2,6 +2,8 @@ import logging
 
 import requests
 from django.conf import settings
+from django.db.models import Model
+from django.shortcuts import get_object_or_404
 
 logger = logging.getLogger(__name__)
 
@@ -82,3 +84,48 @@ class CaptchaFormMixin:
             super().get_form(form_class),
             self.captcha_for_anon_only,
         )
+
+
+class IdentityMapMixin:
+    """
+    Mixin to memoize object lookups for the duration of a request, so that
+    each object is fetched once however many times the view looks it up
+    (e.g., `get_object()` from both a blocker check and the generic view's
+    handler).
+
+    Views are instantiated per request, so the map is kept on the view and
+    reset in `setup()`. Memoized objects aren't refetched if the database
+    changes during the request.
+    """
+
+    def setup(self, request, *args, **kwargs):
+        super().setup(request, *args, **kwargs)
+        self.identity_map = {}
+
+    def get_memoized(self, key, fetch):
+        """
+        Return the object memoized under `key`, calling `fetch()` to get it
+        on the first lookup. Exceptions raised by `fetch()` aren't memoized.
+        """
+        try:
+            return self.identity_map[key]
+        except KeyError:
+            obj = self.identity_map[key] = fetch()
+            return obj
+
+    def lookup_object(self, model, **kwargs):
+        """
+        Memoized `get_object_or_404()`, for a model. Querysets aren't
+        accepted, as their filters would have to be part of the key; use
+        `get_memoized()` with a suitable key instead.
+        """
+        if not (isinstance(model, type) and issubclass(model, Model)):
+            raise TypeError("lookup_object() takes a model class.")
+        key = (model._meta.label, tuple(sorted(kwargs.items())))
+        return self.get_memoized(key, lambda: get_object_or_404(model, **kwargs))
+
+    def get_object(self, queryset=None):
+        """Memoized `get_object()`, for SingleObjectMixin-based views."""
+        if queryset is not None:
+            return super().get_object(queryset)
+        return self.get_memoized("object", super().get_object)
@@ -5,11 +5,21 @@ import requests
 from django import forms
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
-from django.test import RequestFactory, TestCase
-from django.views.generic import FormView
+from django.test import RequestFactory, TestCase, override_settings
+from django.http import Http404
+from django.urls import NoReverseMatch, reverse, set_script_prefix
+from django.views.generic import DetailView, FormView
 
-from .mixins import CAPTCHA_FORM_RESPONSE_NAME, CaptchaFormMixin, _verify_form_captcha
-from .utils import get_object_url
+from notes.utils import generate_lorem_ipsum
+
+from .markdown import MarkdownRenderer, render_note_fast
+from .mixins import (
+    CAPTCHA_FORM_RESPONSE_NAME,
+    CaptchaFormMixin,
+    IdentityMapMixin,
+    _verify_form_captcha,
+)
+from .utils import URLTemplate, get_object_url
 
 UserModel = get_user_model()
 
@@ -121,6 +131,44 @@ class CaptchaFormMixinTests(TestCase):
         self.assertIsInstance(self.view.get_form(), DummyForm)
 
 
+class TestIdentityMapMixinView(IdentityMapMixin, DetailView):
+    model = UserModel
+    slug_field = "username"
+
+
+class IdentityMapMixinTests(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+        self.view = TestIdentityMapMixinView()
+        self.view.setup(RequestFactory().get("/test/"), slug="juan")
+
+    def test_get_object(self):
+        with self.assertNumQueries(1):
+            obj = self.view.get_object()
+            self.assertIs(self.view.get_object(), obj)
+        # Explicit querysets bypass the map:
+        with self.assertNumQueries(1):
+            self.view.get_object(UserModel.objects.all())
+        # The map is reset per request:
+        self.view.setup(RequestFactory().get("/test/"), slug="juan")
+        with self.assertNumQueries(1):
+            self.assertIsNot(self.view.get_object(), obj)
+
+    def test_lookup_object(self):
+        with self.assertNumQueries(1):
+            obj = self.view.lookup_object(UserModel, username="juan")
+            self.assertIs(self.view.lookup_object(UserModel, username="juan"), obj)
+        # Querysets would need their filters in the key:
+        with self.assertRaises(TypeError):
+            self.view.lookup_object(UserModel.objects.none(), username="juan")
+        with self.assertNumQueries(1):
+            self.view.lookup_object(UserModel, pk=self.user.pk)
+        # Misses aren't memoized:
+        for _ in range(2):
+            with self.assertNumQueries(1), self.assertRaises(Http404):
+                self.view.lookup_object(UserModel, username="mary")
+
+
 class GetObjectURLTests(TestCase):
     def test_get_object_url_function(self):
         req = RequestFactory().get("/test/")
@@ -128,3 +176,189 @@ class GetObjectURLTests(TestCase):
         obj.get_absolute_url.return_value = "/foobar/"
         url = get_object_url(req, obj)
         self.assertEqual(url, "http://testserver/foobar/")
+
+
+class URLTemplateTests(TestCase):
+    def tearDown(self):
+        set_script_prefix("/")
+
+    def test_matches_reverse(self):
+        cases = [
+            ("notes:single-note", {"slug": "ABC234"}, {}),
+            ("notes:collection-action", {"code": "ABC234"}, {"action": "unsave"}),
+            ("moderation:submit-report", {"id": "ABC234"}, {"type": "note"}),
+            ("notes:notes-by-username", {"username": "juan"}, {}),
+        ]
+        for viewname, kwargs, fixed_kwargs in cases:
+            template = URLTemplate(viewname, *kwargs, **fixed_kwargs)
+            self.assertEqual(
+                template.format(**kwargs),
+                reverse(viewname, kwargs={**kwargs, **fixed_kwargs}),
+            )
+        self.assertEqual(URLTemplate("notes:my-collection").format(), "/collection/")
+
+    def test_quoting(self):
+        template = URLTemplate("notes:notes-by-username", "username")
+        self.assertEqual(template.format(username="a b/c"), "/@a%20b/c/")
+
+    def test_script_prefix(self):
+        template = URLTemplate("notes:single-note", "slug")
+        self.assertEqual(template.format(slug="ABC"), "/ABC/")
+        set_script_prefix("/prefix/")
+        self.assertEqual(template.format(slug="ABC"), "/prefix/ABC/")
+        self.assertEqual(
+            template.format(slug="ABC"), reverse("notes:single-note", args=["ABC"])
+        )
+
+    def test_urlconf_change(self):
+        template = URLTemplate("moderation:submit-report", "id", type="note")
+        template.format(id="ABC")
+        with override_settings(ROOT_URLCONF="notes.urls"):
+            with self.assertRaises(NoReverseMatch):
+                template.format(id="ABC")
+        self.assertEqual(template.format(id="ABC"), "/moderation/report/note/ABC/")
+
+
+class MarkdownRendererTests(TestCase):
+    def test_presets(self):
+        renderer = MarkdownRenderer()
+        self.assertEqual(renderer.render("*foo*"), "<p><em>foo</em></p>\n")
+        self.assertEqual(renderer.render("# foo"), "<p># foo</p>\n")
+        self.assertEqual(renderer.render("# foo", "trusted"), "<h1>foo</h1>\n")
+        self.assertEqual(renderer.render("<b>x</b>", "trusted"), "<p><b>x</b></p>\n")
+
+    def test_parsers_built_once(self):
+        renderer = MarkdownRenderer()
+        self.assertIs(renderer.get_parser("note"), renderer.get_parser("note"))
+        self.assertIsNot(renderer.get_parser("note"), renderer.get_parser("trusted"))
+
+    def test_cache_hits_and_misses(self):
+        renderer = MarkdownRenderer()
+        renderer.render("foo")
+        renderer.render("foo")
+        renderer.render("foo", "trusted")
+        info = renderer.cache_info()
+        self.assertEqual(info["hits"], 1)
+        self.assertEqual(info["misses"], 2)
+        self.assertEqual(info["entries"], 2)
+        renderer.clear_cache()
+        self.assertEqual(renderer.cache_info()["entries"], 0)
+
+    def test_cache_size_cap(self):
+        renderer = MarkdownRenderer(max_cache_bytes=100)
+        renderer.render("a" * 30)
+        renderer.render("b" * 30)
+        self.assertEqual(renderer.cache_info()["entries"], 1)
+        self.assertLessEqual(renderer.cache_info()["bytes"], 100)
+        # Output larger than the cap is never cached:
+        renderer.render("c" * 200)
+        self.assertEqual(renderer.cache_info()["entries"], 1)
+
+    def test_cache_lru_eviction(self):
+        renderer = MarkdownRenderer(max_cache_bytes=100)
+        renderer.render("a")
+        renderer.render("b")
+        renderer.render("a")  # "a" is now the most recently used
+        renderer.render("c" * 40)
+        renderer.render("a")
+        self.assertEqual(renderer.cache_info()["hits"], 2)
+        renderer.render("b")
+        self.assertEqual(renderer.cache_info()["hits"], 2)
+
+    def test_render_many(self):
+        renderer = MarkdownRenderer()
+        texts = ["*a*", "b", "*a*"]
+        self.assertEqual(
+            renderer.render_many(texts),
+            ["<p><em>a</em></p>\n", "<p>b</p>\n", "<p><em>a</em></p>\n"],
+        )
+        self.assertEqual(renderer.cache_info()["misses"], 2)
+        self.assertEqual(renderer.render_many([]), [])
+
+
+FAST_PATH_EDGE_CASES = [
+    "",
+    "   ",
+    "\n\nFoo\n",
+    "Foo\nbar\n\n\nbaz",
+    "Foo\n   \nbar",
+    "  Leading spaces",
+    "Trailing spaces  \nbar",
+    "Two  spaces",
+    "Tab\tseparated",
+    "Non-breaking\xa0*space*",
+    "Windows\r\nnewlines",
+    "*foo* **bar** ***baz***",
+    "**foo**, *bar*! ***baz***.",
+    "*foo*\n*bar*",
+    "*foo bar*",
+    "*foo*bar",
+    "foo*bar*",
+    "**foo*",
+    "*foo**",
+    "****foo****",
+    "(*foo*)",
+    "*.*",
+    "*é*",
+    "snake_case and _under_",
+    "~~struck~~",
+    "`code`",
+    "\\*escaped*",
+    "&mdash; &amp; & AT&T",
+    "<b>tag</b> \"quoted\" 'single'",
+    "- item\n- item",
+    "* item",
+    "+ item",
+    "1. one\n2. two",
+    "1) one",
+    "Foo\n- item",
+    "2024. was a year",
+    "# heading",
+    "> quote",
+    "---",
+    "***",
+    "Foo\n===",
+]
+
+
+class MarkdownFastPathTests(TestCase):
+    def setUp(self):
+        self.parser = MarkdownRenderer().get_parser("note")
+
+    def assert_identical_or_fallback(self, text):
+        html = render_note_fast(text)
+        if html is not None:
+            self.assertEqual(html, self.parser.render(text), repr(text))
+        return html
+
+    def test_differential_lorem_ipsum_corpus(self):
+        fast_count = 0
+        for index in range(2000):
+            text = generate_lorem_ipsum(rich=True, start_with_lorem=index % 2 == 0)
+            if index % 10 == 0:
+                text += "\n\n" + generate_lorem_ipsum(rich=True)
+            if self.assert_identical_or_fallback(text) is not None:
+                fast_count += 1
+        # Generated lorem ipsum is exactly the shape the fast path targets:
+        self.assertEqual(fast_count, 2000)
+
+    def test_differential_edge_cases(self):
+        for text in FAST_PATH_EDGE_CASES:
+            self.assert_identical_or_fallback(text)
+
+    def test_fallback_cases(self):
+        for text in ["*foo bar*", "_foo_", "- item", "&mdash;", "\\*", "a\tb"]:
+            self.assertIsNone(render_note_fast(text), repr(text))
+
+    def test_renderer_uses_fast_path(self):
+        renderer = MarkdownRenderer()
+        for text in FAST_PATH_EDGE_CASES:
+            self.assertEqual(renderer.render(text), self.parser.render(text))
+        self.assertGreater(renderer.cache_info()["fast_renders"], 0)
+        self.assertLess(
+            renderer.cache_info()["fast_renders"], len(FAST_PATH_EDGE_CASES)
+        )
+        # Presets without a fast path always use the parser:
+        renderer = MarkdownRenderer(fast_renderers={})
+        renderer.render("*foo*")
+        self.assertEqual(renderer.cache_info()["fast_renders"], 0)
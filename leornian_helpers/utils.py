@@ -1,4 +1,12 @@
+import re
+import weakref
+from urllib.parse import quote
+
 from django.contrib.sites.shortcuts import get_current_site
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.urls import get_script_prefix, reverse
+from django.utils.http import RFC3986_SUBDELIMS
 
 
 def get_object_url(request, obj):
@@ -7,3 +15,68 @@ def get_object_url(request, obj):
     url += "://" + str(get_current_site(request))
     url += obj.get_absolute_url()
     return url
+
+
+class URLTemplate:
+    """
+    A named URL pattern resolved once into a format template.
+
+    `reverse()` walks the URL resolver on every call. This resolves the
+    pattern once (per URLconf) with placeholder values for the `params`,
+    then fills in actual values by string concatenation. Keyword arguments
+    whose values don't vary, or whose pattern rejects placeholder values
+    (e.g., `(?P<action>save|unsave)`), are passed as `fixed_kwargs`.
+
+    Unlike `reverse()`, values are not validated against the pattern, so
+    only use this for values known to match (e.g., note codes). Per-request
+    URLconfs (`request.urlconf`) are also not supported; templates are only
+    reset when the ROOT_URLCONF setting changes.
+    """
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self, viewname, *params, **fixed_kwargs):
+        self.viewname = viewname
+        self.params = params
+        self.fixed_kwargs = fixed_kwargs
+        self._parts = None
+        self._instances.add(self)
+
+    @classmethod
+    def reset_all(cls):
+        """Discard all resolved templates."""
+        for template in cls._instances:
+            template._parts = None
+
+    def _placeholder(self, param):
+        return f"0urltemplate0{param}0"
+
+    def _build_template(self):
+        kwargs = {param: self._placeholder(param) for param in self.params}
+        url = reverse(self.viewname, kwargs={**self.fixed_kwargs, **kwargs})
+        path = url[len(get_script_prefix()) :]
+        # Split into literal parts (at even indices) and parameter names (at
+        # odd indices):
+        placeholders = "|".join(
+            re.escape(self._placeholder(param)) for param in self.params
+        )
+        parts = re.split(f"({placeholders})", path) if self.params else [path]
+        for index in range(1, len(parts), 2):
+            parts[index] = parts[index][len("0urltemplate0") : -1]
+        return parts
+
+    def format(self, **kwargs):
+        if self._parts is None:
+            self._parts = self._build_template()
+        url = [get_script_prefix()]
+        for index, part in enumerate(self._parts):
+            if index % 2:
+                part = quote(str(kwargs[part]), safe=RFC3986_SUBDELIMS + "/~:@")
+            url.append(part)
+        return "".join(url)
+
+
+@receiver(setting_changed)
+def reset_url_templates(setting, **kwargs):
+    if setting == "ROOT_URLCONF":
+        URLTemplate.reset_all()
@@ -0,0 +1,440 @@
+"""
+Benchmarks for performance-sensitive code paths.
+
+Run with `python manage.py benchmark <name>`. Each benchmark returns a dict
+of results, which the command prints as JSON so that runs can be compared
+between releases.
+"""
+
+import math
+import random
+import statistics
+import time
+import timeit
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+from django.contrib.auth import get_user_model
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from leornian_helpers.markdown import MarkdownRenderer, render_note_fast
+from leornian_helpers.utils import URLTemplate
+from notes.models import Collection, Note
+from notes.utils import generate_lorem_ipsum, generate_reference_code
+
+BENCHMARKS = {}
+
+
+def register(name):
+    """Decorator for registering a benchmark function under `name`."""
+
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return decorator
+
+
+def best_time(func, number=1, repeat=5):
+    """Return the best time of `repeat` runs of `number` calls, in seconds."""
+    return min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+@contextmanager
+def rolled_back():
+    """Run a block in a transaction that is always rolled back."""
+    with transaction.atomic():
+        yield
+        transaction.set_rollback(True)
+
+
+def seed_notes(count, start=1, author=None, unlisted_every=10):
+    """
+    Bulk insert `count` dummy notes with a single INSERT ... SELECT. Every
+    `unlisted_every`th note is unlisted. Use `start` to continue numbering
+    from an earlier call, as note codes are derived from the sequence.
+    """
+    columns, values, params = [], [], []
+    for field in Note._meta.concrete_fields:
+        if field.primary_key:
+            continue
+        columns.append(connection.ops.quote_name(field.column))
+        if field.name == "code":
+            values.append("'B' || lpad(to_hex(i), 8, '0')")
+        elif field.name == "visibility":
+            values.append("CASE WHEN i %% %s = 0 THEN %s ELSE %s END")
+            params += [unlisted_every, Note.Visibility.UNLISTED, Note.Visibility.NORMAL]
+        elif field.name == "created":
+            values.append("now() - i * interval '1 second'")
+        elif field.name == "author":
+            values.append("%s")
+            params.append(author.pk if author else None)
+        else:
+            values.append("%s")
+            params.append(field.get_db_prep_save(field.get_default(), connection))
+    sql = (
+        f"INSERT INTO {connection.ops.quote_name(Note._meta.db_table)}"
+        f" ({', '.join(columns)}) SELECT {', '.join(values)}"
+        " FROM generate_series(%s, %s) AS i"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [start, start + count - 1])
+        cursor.execute(f"ANALYZE {connection.ops.quote_name(Note._meta.db_table)}")
+
+
+def seed_collection(user, count, promoted_every=10):
+    """
+    Bulk insert collection items for the `count` notes with the lowest IDs
+    with a single INSERT ... SELECT. Every `promoted_every`th item is
+    promoted, and items of notes with higher IDs were drilled longer ago.
+    """
+    columns, values, params = [], [], []
+    for field in Collection._meta.concrete_fields:
+        if field.primary_key:
+            continue
+        columns.append(connection.ops.quote_name(field.column))
+        if field.name == "note":
+            values.append("id")
+        elif field.name == "user":
+            values.append("%s")
+            params.append(user.pk)
+        elif field.name == "promoted":
+            values.append("i %% %s = 0")
+            params.append(promoted_every)
+        elif field.name in ("created", "last_drilled"):
+            values.append("now() - i * interval '1 second'")
+        else:
+            values.append("%s")
+            params.append(field.get_db_prep_save(field.get_default(), connection))
+    note_pk = connection.ops.quote_name(Note._meta.pk.column)
+    table = connection.ops.quote_name(Collection._meta.db_table)
+    sql = (
+        f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join(values)}"
+        f" FROM (SELECT {note_pk} AS id, row_number() OVER (ORDER BY {note_pk})"
+        f" AS i FROM {connection.ops.quote_name(Note._meta.db_table)}"
+        f" ORDER BY {note_pk} LIMIT %s) AS notes"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [count])
+        cursor.execute(f"ANALYZE {table}")
+
+
+def chi_squared_test(observed, expected, min_expected=5):
+    """
+    Compare observed counts against expected counts, both dicts keyed by
+    category. Categories with expected counts below `min_expected` are
+    pooled. Return the chi-squared statistic and its critical value at the
+    0.1% significance level.
+    """
+    chi_squared = 0
+    pooled_observed = pooled_expected = 0
+    categories = 0
+    for category, expected_count in expected.items():
+        if expected_count < min_expected:
+            pooled_observed += observed.get(category, 0)
+            pooled_expected += expected_count
+            continue
+        chi_squared += (observed.get(category, 0) - expected_count) ** 2 / (
+            expected_count
+        )
+        categories += 1
+    if pooled_expected:
+        chi_squared += (pooled_observed - pooled_expected) ** 2 / pooled_expected
+        categories += 1
+    # Wilson-Hilferty approximation of the critical value:
+    df = max(categories - 1, 1)
+    critical = df * (1 - 2 / (9 * df) + 3.09 * math.sqrt(2 / (9 * df))) ** 3
+    return chi_squared, critical
+
+
+@register("markdown")
+def markdown_benchmark(number=1000, repeat=5, **options):
+    """Compare per-note rendering time of the full parser and the fast path."""
+    rng = random.Random(0)
+    random.seed(0)  # generate_lorem_ipsum() uses the global generator
+    corpus = [
+        generate_lorem_ipsum(rich=True, start_with_lorem=rng.random() < 0.5)
+        for _ in range(number)
+    ]
+    parser = MarkdownRenderer().get_parser("note")
+    fast_count = sum(render_note_fast(text) is not None for text in corpus)
+
+    def run_parser():
+        for text in corpus:
+            parser.render(text)
+
+    def run_fast():
+        for text in corpus:
+            if render_note_fast(text) is None:
+                parser.render(text)
+
+    parser_time = best_time(run_parser, repeat=repeat) / number
+    fast_time = best_time(run_fast, repeat=repeat) / number
+    return {
+        "notes": number,
+        "fast_path_coverage": fast_count / number,
+        "parser_us_per_note": parser_time * 1e6,
+        "fast_path_us_per_note": fast_time * 1e6,
+        "speedup": parser_time / fast_time,
+    }
+
+
+@register("urls")
+def urls_benchmark(number=10000, repeat=5, **options):
+    """Compare `reverse()` against precomputed URL templates."""
+    codes = [generate_reference_code() for _ in range(100)]
+    cases = {
+        "notes:single-note": ("slug", {}),
+        "notes:collection-action": ("code", {"action": "save"}),
+        "moderation:submit-report": ("id", {"type": "note"}),
+    }
+    results = {}
+    for viewname, (param, fixed_kwargs) in cases.items():
+        template = URLTemplate(viewname, param, **fixed_kwargs)
+        template.format(**{param: codes[0]})  # resolve outside of timing
+
+        def run_reverse():
+            for code in codes:
+                reverse(viewname, kwargs={**fixed_kwargs, param: code})
+
+        def run_template():
+            for code in codes:
+                template.format(**{param: code})
+
+        reverse_time = best_time(run_reverse, number // 100 or 1, repeat)
+        template_time = best_time(run_template, number // 100 or 1, repeat)
+        results[viewname] = {
+            "reverse_us_per_call": reverse_time / number * 1e6,
+            "template_us_per_call": template_time / number * 1e6,
+            "speedup": reverse_time / template_time,
+        }
+    return results
+
+
+@register("random")
+def random_benchmark(sizes=(1_000_000, 10_000_000), number=20, repeat=3, **options):
+    """
+    Compare random note selection against `order_by("?")` as the notes table
+    grows. Seeded data is rolled back afterwards.
+    """
+
+    def run_get_random():
+        for _ in range(number):
+            Note.objects.get_random()
+
+    def run_get_random_many():
+        for _ in range(number):
+            Note.objects.get_random_many(10)
+
+    def run_order_by_random():
+        Note.objects.exclude(visibility=Note.Visibility.UNLISTED).order_by("?").first()
+
+    results = []
+    with rolled_back():
+        seeded = 0
+        for size in sorted(sizes):
+            seed_notes(size - seeded, start=seeded + 1)
+            seeded = size
+            get_random = best_time(run_get_random, repeat=repeat) / number
+            get_random_many = best_time(run_get_random_many, repeat=repeat) / number
+            order_by_random = best_time(run_order_by_random, repeat=1)
+            results.append(
+                {
+                    "notes": size,
+                    "get_random_ms": get_random * 1e3,
+                    "get_random_many_10_ms": get_random_many * 1e3,
+                    "order_by_random_ms": order_by_random * 1e3,
+                }
+            )
+    return results
+
+
+@register("drill-weights")
+def drill_weights_benchmark(
+    sizes=(1_000, 10_000, 100_000), number=100, repeat=3, **options
+):
+    """
+    Compare a draw with per-draw weights (`Drill.generate_weights()` and
+    `random.choices()`) against building a `DrillSampler` and drawing from
+    it, across collection sizes. No database access is involved.
+    """
+    # Imported here, as the views module is heavy and unrelated to the
+    # other benchmarks:
+    from notes.drill import DrillSampler
+    from notes.views import Drill
+
+    results = []
+    rng = random.Random(0)
+    for size in sorted(sizes):
+        items = [(pk, rng.random() < 0.1) for pk in range(1, size + 1)]
+        promotion_statuses = [promoted for _, promoted in reversed(items[:-1])]
+        sampler = DrillSampler(items)
+
+        def run_weights():
+            weights = Drill.generate_weights(promotion_statuses)
+            random.choices(range(len(weights)), weights)
+
+        def run_build():
+            DrillSampler(items)
+
+        def run_draw():
+            for _ in range(number):
+                sampler.draw()
+
+        weights_time = best_time(run_weights, repeat=repeat)
+        draw_time = best_time(run_draw, repeat=repeat) / number
+        results.append(
+            {
+                "notes": size,
+                "weights_draw_ms": weights_time * 1e3,
+                "sampler_build_ms": best_time(run_build, repeat=repeat) * 1e3,
+                "sampler_draw_us": draw_time * 1e6,
+                "speedup": weights_time / draw_time,
+            }
+        )
+    return results
+
+
+@register("drill")
+def drill_benchmark(
+    sizes=(10, 1_000, 10_000, 100_000),
+    number=100,
+    promoted_every=10,
+    samples=20_000,
+    distribution_bins=100,
+    **options,
+):
+    """
+    Measure `Drill.post` as collections grow: the latency and query count of
+    the first draw (which builds the cached sampler and statistics) and of
+    `number` subsequent draws, and the peak memory allocated per draw. Also
+    check the distribution of `samples` draws from the user's sampler
+    against `Drill.generate_weights()` with a chi-squared test, over up to
+    `distribution_bins` bins of consecutive items. Seeded data is rolled
+    back afterwards.
+    """
+    from notes.drill import build_drill_sampler, invalidate_drill_sampler
+    from notes.drill_stats import invalidate_drill_stats
+    from notes.views import Drill
+
+    view = Drill.as_view()
+    factory = RequestFactory()
+    url = reverse("notes:drill")
+    rng = random.Random(0)
+
+    def run_draw(user):
+        request = factory.post(url)
+        request.user = user
+        start = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            view(request)
+        return time.perf_counter() - start, len(queries)
+
+    results = []
+    user_pks = []
+    with rolled_back():
+        seeded = 0
+        for size in sorted(sizes):
+            if size > seeded:
+                seed_notes(size - seeded, start=seeded + 1)
+                seeded = size
+            user = get_user_model().objects.create(username=f"drill-{size}")
+            user_pks.append(user.pk)
+            seed_collection(user, size, promoted_every)
+
+            cold_time, cold_queries = run_draw(user)
+            times, query_counts = zip(*(run_draw(user) for _ in range(number)))
+            peaks = []
+            tracemalloc.start()
+            try:
+                for _ in range(min(number, 10)):
+                    tracemalloc.reset_peak()
+                    baseline = tracemalloc.get_traced_memory()[0]
+                    run_draw(user)
+                    peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+            finally:
+                tracemalloc.stop()
+
+            # Items are least recently drilled first; the last one is
+            # excluded from draws, and `generate_weights()` takes the most
+            # recent first:
+            sampler = build_drill_sampler(user.pk)
+            items = sampler.items()
+            weights = Drill.generate_weights(
+                [promoted for _, promoted in reversed(items[:-1])]
+            )
+            # Consecutive items are binned, so that large collections keep
+            # enough categories with sizable expected counts:
+            total = sum(weights)
+            bin_of = {}
+            expected = Counter()
+            for index, ((pk, _), weight) in enumerate(
+                zip(reversed(items[:-1]), weights)
+            ):
+                bin_of[pk] = index * distribution_bins // len(weights)
+                expected[bin_of[pk]] += samples * weight / total
+            observed = Counter(bin_of[sampler.draw(rng)] for _ in range(samples))
+            chi_squared, critical = chi_squared_test(observed, expected)
+
+            results.append(
+                {
+                    "notes": size,
+                    "promoted": sum(promoted for _, promoted in items),
+                    "cold_draw_ms": cold_time * 1e3,
+                    "cold_draw_queries": cold_queries,
+                    "draw_mean_ms": statistics.fmean(times) * 1e3,
+                    "draw_p50_ms": statistics.median(times) * 1e3,
+                    "draw_p95_ms": sorted(times)[int(len(times) * 0.95)] * 1e3,
+                    "draw_mean_queries": statistics.fmean(query_counts),
+                    "draw_max_queries": max(query_counts),
+                    "draw_peak_kib": max(peaks) / 1024,
+                    "distribution_chi_squared": chi_squared,
+                    "distribution_critical": critical,
+                    "distribution_ok": chi_squared < critical,
+                }
+            )
+    # The cached data refers to rolled back users:
+    invalidate_drill_sampler(*user_pks)
+    invalidate_drill_stats(*user_pks)
+    return results
+
+
+@register("cards")
+def cards_benchmark(sizes=(10, 100, 1_000), number=20, repeat=3, **options):
+    """
+    Compare fetching lists of `sizes` notes as model instances with
+    `select_related("author")`, as list views used to, against
+    `NoteQuerySet.cards()`: the best time per fetch and the peak memory
+    allocated while fetching. Saved state is resolved in both cases. Seeded
+    data is rolled back afterwards.
+    """
+    results = []
+    with rolled_back():
+        author = get_user_model().objects.create(username="cards-author")
+        seed_notes(max(sizes), author=author, unlisted_every=max(sizes) + 1)
+        seed_collection(author, max(sizes) // 2)
+        notes = Note.objects.filter(author=author).with_saved(author)
+        paths = {
+            "model": lambda size: list(notes.select_related("author")[:size]),
+            "cards": lambda size: list(notes.cards()[:size]),
+        }
+        for size in sorted(sizes):
+            result = {"notes": size}
+            for name, fetch in paths.items():
+                elapsed = best_time(lambda: fetch(size), number, repeat) / number
+                tracemalloc.start()
+                try:
+                    fetch(size)
+                    peak = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+                result[f"{name}_ms"] = elapsed * 1e3
+                result[f"{name}_peak_kib"] = peak / 1024
+            result["speedup"] = result["model_ms"] / result["cards_ms"]
+            result["memory_ratio"] = result["model_peak_kib"] / result["cards_peak_kib"]
+            results.append(result)
+    return results
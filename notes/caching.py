@@ -0,0 +1,50 @@
+"""
+Cache keys and invalidation helpers for note rendering.
+
+Note cards are cached in two parts: template fragments of the card content
+(shared by all viewers), and the data for the control strip, which varies
+only by whether the viewer saved the note and whether they authored it.
+Entries are invalidated by the receivers in `notes.signals`.
+"""
+
+import itertools
+from functools import partial
+
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
+from django.db import transaction
+
+NOTE_CARD_CACHE_TIMEOUT = 60 * 60 * 24
+"""Passed to `notes/includes/note_card.html` by `{% note_card_cache_timeout %}`."""
+
+NOTE_CARD_FRAGMENTS = ("note-card-html", "note-card-footer")
+
+
+def note_controls_cache_key(note_pk, saved, is_author):
+    return f"notes:note-controls:{note_pk}:{int(saved)}:{int(is_author)}"
+
+
+def invalidate_note_card(*note_pks):
+    """Delete all cached card fragments and controls of the given notes."""
+    keys = []
+    for note_pk in note_pks:
+        keys += [
+            make_template_fragment_key(fragment, [note_pk])
+            for fragment in NOTE_CARD_FRAGMENTS
+        ]
+        keys += [
+            note_controls_cache_key(note_pk, saved, is_author)
+            for saved, is_author in itertools.product((False, True), repeat=2)
+        ]
+    cache.delete_many(keys)
+
+
+def update_cache_on_commit(update, *args):
+    """
+    Call `update(*args)`, e.g., an invalidation or an in-place update of
+    cached data, once the current transaction commits (at once outside a
+    transaction). Invalidating earlier lets a concurrent request cache the
+    data again from the rows as they were before the commit, and updating
+    earlier keeps changes in the cache if the transaction rolls back.
+    """
+    transaction.on_commit(partial(update, *args))
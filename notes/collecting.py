@@ -0,0 +1,238 @@
+"""
+Saving and unsaving notes with single statements.
+
+`user.collected_notes.add(note)` takes a lookup of the note, a SELECT of
+the existing `Collection` rows and an INSERT, and concurrent saves of the
+same note (e.g., a double-click) can still fail on the `unique_collect`
+constraint. Instead, `save_notes()` resolves note codes and inserts the
+missing rows with one `INSERT ... SELECT ... ON CONFLICT DO NOTHING`, and
+`unsave_notes()` deletes rows with one `DELETE ... USING`. Both adjust the
+notes' `collector_count` in the same statement.
+
+Raw SQL sends no model signals, so both functions then apply the other
+side effects of the receivers in `notes.signals` through explicit hooks,
+`collection_added()` and `collection_removed()`, for the rows actually
+inserted or deleted.
+
+`apply_collection_action()` applies these, or a promotion or demotion, to
+many notes at once for the bulk collection endpoint.
+"""
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .caching import invalidate_note_card, update_cache_on_commit
+from .counters import increment_counters
+from .drill import DrillSampler, set_promoted_many, update_drill_sampler
+from .drill_stats import DrillStats, update_drill_stats
+from .exclusions import add_excluded_ids, remove_collected_ids
+from .models import Collection, Counter, Note
+
+COLLECTION_ACTIONS = ("save", "unsave", "promote", "demote")
+COLLECTION_ACTION_MAX_CODES = 1000
+
+# Per-code results of `apply_collection_action()`:
+DONE = {
+    "save": "saved",
+    "unsave": "unsaved",
+    "promote": "promoted",
+    "demote": "demoted",
+}
+UNCHANGED = "unchanged"
+NOT_FOUND = "not-found"
+NOT_IN_COLLECTION = "not-in-collection"
+
+
+def _tables_and_columns():
+    qn = connection.ops.quote_name
+    collection = qn(Collection._meta.db_table)
+    note = qn(Note._meta.db_table)
+    columns = {
+        name: qn(Collection._meta.get_field(name).column)
+        for name in ("note", "user", "last_drilled")
+    }
+    columns.update(
+        {
+            f"note_{name}": qn(Note._meta.get_field(name).column)
+            for name in ("id", "code", "collector_count")
+        }
+    )
+    return collection, note, columns
+
+
+def _result(rows):
+    """
+    Map codes to `(note_pk, changed)` pairs for the `(note_pk, code,
+    changed, last_drilled)` rows returned by the statements below.
+    """
+    return {code: (note_pk, changed) for note_pk, code, changed, _ in rows}
+
+
+def save_notes(user_pk, codes):
+    """
+    Save the notes with the given codes to the user's collection.
+
+    Return a dict mapping the code of each existing note to a `(note_pk,
+    added)` pair, where `added` is false if the note was already saved.
+    Unknown codes are left out. This takes a single statement, plus those
+    of `collection_added()`.
+    """
+    collection, note, c = _tables_and_columns()
+    now = timezone.now()
+    columns, values = [], []
+    params = {"user": user_pk, "codes": list(codes)}
+    for field in Collection._meta.concrete_fields:
+        if field.primary_key:
+            continue
+        columns.append(connection.ops.quote_name(field.column))
+        if field.name == "note":
+            values.append(f"{note}.{c['note_id']}")
+        elif field.name == "user":
+            values.append("%(user)s")
+        else:
+            if getattr(field, "auto_now_add", False) or field.default is timezone.now:
+                value = now
+            else:
+                value = field.get_default()
+            params[field.name] = field.get_db_prep_save(value, connection)
+            values.append(f"%({field.name})s")
+    sql = (
+        f"WITH inserted AS ("
+        f"INSERT INTO {collection} ({', '.join(columns)})"
+        f" SELECT {', '.join(values)} FROM {note}"
+        f" WHERE {note}.{c['note_code']} = ANY(%(codes)s)"
+        f" ON CONFLICT DO NOTHING"
+        f" RETURNING {c['note']}, {c['last_drilled']}"
+        f"), counted AS ("
+        f"UPDATE {note} SET {c['note_collector_count']}"
+        f" = {note}.{c['note_collector_count']} + 1"
+        f" FROM inserted WHERE {note}.{c['note_id']} = inserted.{c['note']}"
+        f") SELECT {note}.{c['note_id']}, {note}.{c['note_code']},"
+        f" inserted.{c['note']} IS NOT NULL, inserted.{c['last_drilled']}"
+        f" FROM {note} LEFT JOIN inserted"
+        f" ON inserted.{c['note']} = {note}.{c['note_id']}"
+        f" WHERE {note}.{c['note_code']} = ANY(%(codes)s)"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    collection_added(user_pk, [row[0] for row in rows if row[2]], now)
+    return _result(rows)
+
+
+def unsave_notes(user_pk, codes):
+    """
+    Remove the notes with the given codes from the user's collection.
+
+    Return a dict mapping the code of each existing note to a `(note_pk,
+    removed)` pair, where `removed` is false if the note wasn't saved.
+    Unknown codes are left out. This takes a single statement, plus those
+    of `collection_removed()`.
+    """
+    collection, note, c = _tables_and_columns()
+    sql = (
+        f"WITH deleted AS ("
+        f"DELETE FROM {collection} USING {note}"
+        f" WHERE {collection}.{c['note']} = {note}.{c['note_id']}"
+        f" AND {note}.{c['note_code']} = ANY(%(codes)s)"
+        f" AND {collection}.{c['user']} = %(user)s"
+        f" RETURNING {collection}.{c['note']}, {collection}.{c['last_drilled']}"
+        f"), counted AS ("
+        f"UPDATE {note} SET {c['note_collector_count']}"
+        f" = {note}.{c['note_collector_count']} - 1"
+        f" FROM deleted WHERE {note}.{c['note_id']} = deleted.{c['note']}"
+        f") SELECT {note}.{c['note_id']}, {note}.{c['note_code']},"
+        f" deleted.{c['note']} IS NOT NULL, deleted.{c['last_drilled']}"
+        f" FROM {note} LEFT JOIN deleted"
+        f" ON deleted.{c['note']} = {note}.{c['note_id']}"
+        f" WHERE {note}.{c['note_code']} = ANY(%(codes)s)"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {"user": user_pk, "codes": list(codes)})
+        rows = cursor.fetchall()
+    collection_removed(user_pk, [(row[0], row[3]) for row in rows if row[2]])
+    return _result(rows)
+
+
+def collection_added(user_pk, note_pks, last_drilled):
+    """
+    Apply the side effects of adding notes to the user's collection with
+    raw SQL, like `notes.signals` does for `collected_notes.add()`, except
+    for `collector_count`.
+    """
+    if not note_pks:
+        return
+    update_cache_on_commit(invalidate_note_card, *note_pks)
+    update_cache_on_commit(add_excluded_ids, user_pk, note_pks)
+    update_cache_on_commit(
+        update_drill_sampler, user_pk, DrillSampler.add_many, note_pks
+    )
+    update_cache_on_commit(
+        update_drill_stats,
+        user_pk,
+        DrillStats.record_added,
+        last_drilled,
+        len(note_pks),
+    )
+    increment_counters(Counter.Kind.COLLECTED, [user_pk], len(note_pks))
+
+
+def collection_removed(user_pk, items):
+    """
+    Apply the side effects of removing notes from the user's collection
+    with raw SQL, like `notes.signals` does for `collected_notes.remove()`,
+    except for `collector_count`. `items` are `(note_pk, last_drilled)`
+    pairs of the deleted rows.
+    """
+    if not items:
+        return
+    note_pks = [note_pk for note_pk, _ in items]
+    update_cache_on_commit(invalidate_note_card, *note_pks)
+    update_cache_on_commit(remove_collected_ids, user_pk, note_pks)
+    update_cache_on_commit(
+        update_drill_sampler, user_pk, DrillSampler.remove_many, note_pks
+    )
+    update_cache_on_commit(
+        update_drill_stats,
+        user_pk,
+        DrillStats.record_removals,
+        [last_drilled for _, last_drilled in items],
+    )
+    increment_counters(Counter.Kind.COLLECTED, [user_pk], -len(note_pks))
+
+
+def apply_collection_action(user_pk, action, codes):
+    """
+    Apply an action from `COLLECTION_ACTIONS` to the notes with the given
+    codes, in one transaction with one set-based statement.
+
+    Return a dict mapping each code to the action's result: the value of
+    `DONE[action]`, `UNCHANGED`, or `NOT_FOUND` for unknown codes. Like
+    `Drill.post`, promotion and demotion only apply to notes in the user's
+    collection, and give `NOT_IN_COLLECTION` for the other codes.
+    """
+    with transaction.atomic():
+        if action == "save":
+            results = save_notes(user_pk, codes)
+        elif action == "unsave":
+            results = unsave_notes(user_pk, codes)
+        else:
+            promoted = action == "promote"
+            results = set_promoted_many(user_pk, codes, promoted)
+            if changed := [pk for pk, changed in results.values() if changed]:
+                update_cache_on_commit(
+                    update_drill_sampler,
+                    user_pk,
+                    DrillSampler.set_promoted_many,
+                    changed,
+                    promoted,
+                )
+    missing = NOT_FOUND if action in ("save", "unsave") else NOT_IN_COLLECTION
+    return {
+        code: (
+            (DONE[action] if results[code][1] else UNCHANGED)
+            if code in results
+            else missing
+        )
+        for code in codes
+    }
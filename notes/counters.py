@@ -0,0 +1,111 @@
+"""
+Cheap row counts for paginated note lists.
+
+Counting a user's collection or authored notes with `COUNT(*)` scans all of
+their rows on every page view. Instead, the sizes of the main per-user
+lists are kept in `Counter` rows, which are created for new users, updated
+by the receivers in `notes.signals`, and reconciled in batches by the
+`repair_counters` command. Updates only apply to existing rows.
+
+Lists without a counter (e.g., filtered views, or users who predate the
+counters) are counted exactly up to a limit, which is cheap for the short
+lists most views show, and the count is stored if the list has a counter
+kind. Past the limit, they fall back to the query planner's row estimate,
+which costs the same regardless of the list size.
+"""
+
+import json
+
+from django.db.models import Count, F
+
+from .models import Collection, Counter, Deattribution, Note
+
+EXACT_COUNT_THRESHOLD = 1000
+"""Lists are counted exactly up to this many rows, and estimated past it."""
+
+COUNTED = {
+    # Kind: (model, user field, other filters)
+    Counter.Kind.COLLECTED: (Collection, "user", {}),
+    Counter.Kind.LISTED: (Note, "author", {"visibility": Note.Visibility.NORMAL}),
+    Counter.Kind.DEATTRIBUTED: (Deattribution, "author", {}),
+}
+
+
+def counted_queryset(kind, user_pks):
+    """Return the rows counted by counters of `kind` for the given users."""
+    model, user_field, filters = COUNTED[kind]
+    return model.objects.filter(**{f"{user_field}__in": user_pks}, **filters)
+
+
+def create_counters(user_pk):
+    """Create zeroed counters of every kind for a new user."""
+    Counter.objects.bulk_create(
+        [Counter(user_id=user_pk, kind=kind) for kind in Counter.Kind],
+        ignore_conflicts=True,
+    )
+
+
+def increment_counters(kind, user_pks, delta=1):
+    """Add `delta` to the existing counters of `kind` for the given users."""
+    Counter.objects.filter(kind=kind, user__in=user_pks).update(
+        count=F("count") + delta
+    )
+
+
+def save_counts(kind, counts):
+    """Create or overwrite counters of `kind` from a `{user_pk: count}` dict."""
+    Counter.objects.bulk_create(
+        [Counter(user_id=user_pk, kind=kind, count=n) for user_pk, n in counts.items()],
+        update_conflicts=True,
+        unique_fields=["user", "kind"],
+        update_fields=["count"],
+    )
+
+
+def exact_counts(kind, user_pks):
+    """Count the rows of `kind` for each of the given users."""
+    model, user_field, filters = COUNTED[kind]
+    counts = dict.fromkeys(user_pks, 0)
+    counts.update(
+        counted_queryset(kind, user_pks)
+        .order_by()
+        .values_list(user_field)
+        .annotate(Count("pk"))
+    )
+    return counts
+
+
+def refresh_counter(kind, user_pk):
+    """Recount a user's counter of `kind`, creating it if needed."""
+    save_counts(kind, exact_counts(kind, [user_pk]))
+
+
+def estimate_count(queryset):
+    """Return the query planner's estimate of the number of rows."""
+    plan = json.loads(queryset.order_by().values("pk").explain(format="json"))
+    return plan[0]["Plan"]["Plan Rows"]
+
+
+def get_count(queryset, counter=None):
+    """
+    Return the number of rows of `queryset`, and whether it's an estimate.
+
+    `counter` may be given as a `(kind, user_pk)` pair if `queryset` holds
+    exactly the rows counted by that counter, in which case the count is
+    read from it if it exists.
+    """
+    if counter:
+        kind, user_pk = counter
+        stored = (
+            Counter.objects.filter(kind=kind, user=user_pk)
+            .values_list("count", flat=True)
+            .first()
+        )
+        if stored is not None:
+            return stored, False
+    count = queryset[:EXACT_COUNT_THRESHOLD].count()
+    if count >= EXACT_COUNT_THRESHOLD:
+        return max(estimate_count(queryset), count), True
+    if counter:
+        save_counts(kind, {user_pk: count})
+    return count, False
@@ -0,0 +1,73 @@
+"""
+Shared pool of pre-sampled note IDs for anonymous Discover requests.
+
+Random selection is the most expensive query behind the Discover page, and
+anonymous visitors don't need exclusions, so they are served from a pool
+of public note IDs kept in the cache. The pool is refreshed on a schedule
+with the `refresh_discover_pool` command, and refilled on demand if it is
+missing (e.g., after eviction) by one request at a time, while concurrent
+requests fall back to a direct random selection; notes that get unlisted or
+deleted are removed from it right away (see `notes.signals`).
+"""
+
+import random
+
+from django.core.cache import cache
+
+from .models import Note
+
+DISCOVER_POOL_CACHE_KEY = "notes:discover-pool"
+DISCOVER_POOL_SIZE = 5000
+DISCOVER_POOL_TIMEOUT = 60 * 60 * 6
+"""Should be longer than the refresh interval, so the pool never lapses."""
+DISCOVER_POOL_LOCK_CACHE_KEY = "notes:discover-pool-lock"
+DISCOVER_POOL_LOCK_TIMEOUT = 60
+
+
+def refresh_discover_pool(size=DISCOVER_POOL_SIZE):
+    """Replace the pool with a new sample; return the sample size."""
+    pks = Note.objects.get_random_many(size, pks_only=True)
+    cache.set(DISCOVER_POOL_CACHE_KEY, pks, DISCOVER_POOL_TIMEOUT)
+    return len(pks)
+
+
+def remove_from_discover_pool(*note_pks):
+    pool = cache.get(DISCOVER_POOL_CACHE_KEY)
+    if pool and not set(note_pks).isdisjoint(pool):
+        pool = [pk for pk in pool if pk not in note_pks]
+        cache.set(DISCOVER_POOL_CACHE_KEY, pool, DISCOVER_POOL_TIMEOUT)
+
+
+def get_pooled_note(attempts=3):
+    """
+    Return a random public note from the pool, or None if the pool is
+    empty, no longer holds valid entries, or is missing and being refilled
+    by another request.
+    """
+    pool = cache.get(DISCOVER_POOL_CACHE_KEY)
+    if pool is None:
+        # Only one request refills the pool at a time:
+        if not cache.add(
+            DISCOVER_POOL_LOCK_CACHE_KEY, True, DISCOVER_POOL_LOCK_TIMEOUT
+        ):
+            return None
+        try:
+            refresh_discover_pool()
+        finally:
+            cache.delete(DISCOVER_POOL_LOCK_CACHE_KEY)
+        pool = cache.get(DISCOVER_POOL_CACHE_KEY)
+    for _ in range(attempts):
+        if not pool:
+            return None
+        pk = random.choice(pool)
+        note = (
+            Note.objects.filter(pk=pk, visibility=Note.Visibility.NORMAL)
+            .select_related("author")
+            .first()
+        )
+        if note:
+            return note
+        # Deleted or unlisted in a way that bypassed signals:
+        remove_from_discover_pool(pk)
+        pool = [other for other in pool if other != pk]
+    return None
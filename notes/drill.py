@@ -0,0 +1,587 @@
+"""
+Weighted random selection of notes for Drill.
+
+A draw favors notes that haven't been drilled for a long time, and promoted
+notes (see `Drill.generate_weights()`). Instead of loading the user's whole
+collection to build a list of weights for every draw, each user has a
+`DrillSampler`, kept in the cache and updated in place as notes are
+drilled, promoted, demoted, saved and unsaved (see `notes.signals`). It is
+rebuilt from the database on a cache miss, or when the view finds it out of
+date.
+
+Cards are pre-drawn in batches and queued in the cache (see
+`pop_drill_card()`), so that most drill steps need no draw at all.
+"""
+
+import itertools
+import math
+import random
+from array import array
+
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+import numpy as np
+
+from .drill_stats import DrillStats, update_drill_stats
+from .models import Collection, Note
+
+DRILL_SAMPLER_CACHE_TIMEOUT = 60 * 60 * 24
+DRILL_SAMPLER_MIN_CAPACITY = 64
+DRILL_QUEUE_SIZE = 20
+DRILL_SYNC_MAX_EVENTS = 1000
+
+# Spaced repetition:
+REVIEW_RESULTS = ("again", "good")
+REVIEW_AGAIN_DELAY = timezone.timedelta(minutes=10)
+REVIEW_FIRST_INTERVALS = (timezone.timedelta(days=1), timezone.timedelta(days=6))
+REVIEW_MIN_EASE = 1.3
+REVIEW_EASE_PENALTY = 0.2
+REVIEW_DUE_COUNT_LIMIT = 99
+PROMOTED_INTERVAL_FACTOR = 0.5
+
+
+class DrillSampler:
+    """
+    Sampling index over a user's collection, ordered by when each note was
+    last drilled.
+
+    Notes occupy numbered slots in the order they were last drilled; drilling
+    a note moves it to a new slot after all others, and slots are compacted
+    when they run out. A Fenwick tree counting the occupied slots finds the
+    note with a given recency rank in O(log n), so that a draw costs
+    O(log n) instead of O(n).
+
+    Draws follow the same distribution as `Drill.generate_weights()`, by
+    rejection sampling: a rank `x` (1 for the second most recently drilled
+    note, up to `n` for the least recently drilled) is proposed with
+    probability proportional to `x`, which is the weight of promoted notes,
+    and is accepted with probability `(x / n) ** 3` for other notes, giving
+    them weights proportional to `x ** 4`. At most 2.5 proposals are needed
+    on average.
+
+    Notes are found by primary key through a map to their slots, built on
+    first use. Neither the map, the tree nor the unused slots at the end
+    are pickled, so that cache entries hold little more than the note IDs;
+    the tree is rebuilt on unpickling.
+    """
+
+    __slots__ = ("note_ids", "promoted", "tree", "count", "next_slot", "slots")
+
+    def __init__(self, items=()):
+        """`items` are `(note_pk, promoted)` pairs, least recently drilled first."""
+        items = list(items)
+        items = np.fromiter(
+            itertools.chain.from_iterable(items), dtype=np.int64, count=2 * len(items)
+        ).reshape(-1, 2)
+        self._load(items[:, 0], items[:, 1])
+
+    def _load(self, note_ids, promoted):
+        """
+        Fill the first slots from arrays of note IDs and promotion statuses,
+        in linear time without Python-level loops.
+        """
+        count = len(note_ids)
+        capacity = max(DRILL_SAMPLER_MIN_CAPACITY, 2 * count)
+        # Slots are 1-based; index 0 is unused:
+        slots = np.zeros(capacity + 1, dtype=np.int64)
+        slots[1 : count + 1] = note_ids
+        self.note_ids = array("q", slots.tobytes())
+        flags = np.zeros(capacity + 1, dtype=np.uint8)
+        flags[1 : count + 1] = promoted
+        self.promoted = bytearray(flags.tobytes())
+        self._build_tree(slots != 0)
+        self.next_slot = count + 1
+        self.slots = None
+
+    def _build_tree(self, occupied):
+        """Build the tree from an array of occupied slot flags, and count them."""
+        # The tree node of slot `i` counts the occupied slots in
+        # `(i - lowbit(i), i]`:
+        prefix = np.cumsum(occupied, dtype=np.int64)
+        index = np.arange(len(occupied), dtype=np.int64)
+        tree = prefix - prefix[index - (index & -index)]
+        self.tree = array("q", tree.tobytes())
+        self.count = int(prefix[-1])
+
+    def __getstate__(self):
+        capacity = len(self.tree) - 1
+        return (
+            self.note_ids[: self.next_slot],
+            bytes(self.promoted[: self.next_slot]),
+            capacity,
+        )
+
+    def __setstate__(self, state):
+        used_note_ids, used_promoted, capacity = state
+        slots = np.zeros(capacity + 1, dtype=np.int64)
+        slots[: len(used_note_ids)] = np.frombuffer(used_note_ids, dtype=np.int64)
+        self.note_ids = array("q", slots.tobytes())
+        self.promoted = bytearray(capacity + 1)
+        self.promoted[: len(used_promoted)] = used_promoted
+        self._build_tree(slots != 0)
+        self.next_slot = len(used_note_ids)
+        self.slots = None
+
+    def _compact(self):
+        note_ids = np.frombuffer(self.note_ids, dtype=np.int64)
+        occupied = note_ids != 0
+        promoted = np.frombuffer(self.promoted, dtype=np.uint8)[occupied]
+        self._load(note_ids[occupied], promoted)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, note_pk):
+        return self._slot_of(note_pk) is not None
+
+    def items(self):
+        """Return `(note_pk, promoted)` pairs, least recently drilled first."""
+        return [
+            (note_pk, bool(promoted))
+            for note_pk, promoted in zip(self.note_ids, self.promoted)
+            if note_pk
+        ]
+
+    def _slot_of(self, note_pk):
+        if self.slots is None:
+            note_ids = np.frombuffer(self.note_ids, dtype=np.int64)
+            occupied = np.flatnonzero(note_ids)
+            self.slots = dict(zip(note_ids[occupied].tolist(), occupied.tolist()))
+        return self.slots.get(note_pk)
+
+    def _update_tree(self, slot, delta):
+        capacity = len(self.tree) - 1
+        while slot <= capacity:
+            self.tree[slot] += delta
+            slot += slot & -slot
+
+    def _find(self, k):
+        """Return the `k`-th occupied slot."""
+        capacity = len(self.tree) - 1
+        slot = 0
+        bit = 1 << (capacity.bit_length() - 1)
+        while bit:
+            if slot + bit <= capacity and self.tree[slot + bit] < k:
+                slot += bit
+                k -= self.tree[slot]
+            bit >>= 1
+        return slot + 1
+
+    def _append(self, note_pk, promoted):
+        if self.next_slot == len(self.tree):
+            self._compact()
+        slot = self.next_slot
+        self.note_ids[slot] = note_pk
+        self.promoted[slot] = promoted
+        if self.slots is not None:
+            self.slots[note_pk] = slot
+        self._update_tree(slot, 1)
+        self.count += 1
+        self.next_slot += 1
+
+    def _clear(self, slot):
+        promoted = self.promoted[slot]
+        if self.slots is not None:
+            del self.slots[self.note_ids[slot]]
+        self.note_ids[slot] = 0
+        self.promoted[slot] = 0
+        self._update_tree(slot, -1)
+        self.count -= 1
+        return promoted
+
+    def add(self, note_pk, promoted=False):
+        """Add a note as the most recently drilled one, if not present."""
+        if note_pk not in self:
+            self._append(note_pk, promoted)
+
+    def add_many(self, note_pks):
+        for note_pk in note_pks:
+            self.add(note_pk)
+
+    def remove(self, note_pk):
+        if (slot := self._slot_of(note_pk)) is not None:
+            self._clear(slot)
+
+    def remove_many(self, note_pks):
+        for note_pk in note_pks:
+            self.remove(note_pk)
+
+    def touch(self, note_pk):
+        """Mark a note as the most recently drilled one."""
+        if (slot := self._slot_of(note_pk)) is not None:
+            self._append(note_pk, self._clear(slot))
+
+    def is_promoted(self, note_pk):
+        slot = self._slot_of(note_pk)
+        return slot is not None and bool(self.promoted[slot])
+
+    def set_promoted(self, note_pk, promoted):
+        if (slot := self._slot_of(note_pk)) is not None:
+            self.promoted[slot] = promoted
+
+    def set_promoted_many(self, note_pks, promoted):
+        if self.slots is not None:
+            for note_pk in note_pks:
+                self.set_promoted(note_pk, promoted)
+            return
+        # Matching slots in one pass is cheaper than building the slot map:
+        note_pks = np.fromiter(note_pks, dtype=np.int64)
+        note_ids = np.frombuffer(self.note_ids, dtype=np.int64)
+        flags = np.frombuffer(self.promoted, dtype=np.uint8)
+        flags[np.isin(note_ids, note_pks) & (note_ids != 0)] = promoted
+
+    def draw(self, rng=random):
+        """
+        Return the primary key of a randomly drawn note, never the most
+        recently drilled one, or None if there are fewer than two notes.
+        """
+        slot = self._draw_slot(rng)
+        return None if slot is None else self.note_ids[slot]
+
+    def draw_and_touch(self, rng=random):
+        """
+        Draw a note like `draw()`, and mark it as the most recently drilled
+        one, without looking up its slot.
+        """
+        slot = self._draw_slot(rng)
+        if slot is None:
+            return None
+        note_pk = self.note_ids[slot]
+        self._append(note_pk, self._clear(slot))
+        return note_pk
+
+    def _draw_slot(self, rng):
+        n = self.count - 1
+        if n < 1:
+            return None
+        total = n * (n + 1) // 2
+        while True:
+            # Invert the cumulative distribution `x * (x + 1) / 2`, then
+            # correct any floating-point error:
+            u = rng.randint(1, total)
+            x = math.ceil((math.sqrt(8 * u + 1) - 1) / 2)
+            while x * (x + 1) // 2 < u:
+                x += 1
+            while x > 1 and (x - 1) * x // 2 >= u:
+                x -= 1
+            slot = self._find(self.count - x)
+            if self.promoted[slot] or rng.random() * n**3 < x**3:
+                return slot
+
+
+def drill_sampler_cache_key(user_pk):
+    return f"notes:drill-sampler:{user_pk}"
+
+
+def drill_queue_cache_key(user_pk):
+    return f"notes:drill-queue:{user_pk}"
+
+
+def build_drill_sampler(user_pk):
+    """Build the user's sampler from the database and cache it."""
+    items = (
+        Collection.objects.filter(user=user_pk)
+        .order_by("last_drilled", "pk")
+        .values_list("note_id", "promoted")
+    )
+    sampler = DrillSampler(items)
+    save_drill_sampler(user_pk, sampler)
+    return sampler
+
+
+def get_drill_sampler(user_pk):
+    sampler = cache.get(drill_sampler_cache_key(user_pk))
+    if sampler is None:
+        sampler = build_drill_sampler(user_pk)
+    return sampler
+
+
+def save_drill_sampler(user_pk, sampler):
+    cache.set(drill_sampler_cache_key(user_pk), sampler, DRILL_SAMPLER_CACHE_TIMEOUT)
+
+
+def update_drill_sampler(user_pk, method, *args):
+    """
+    Call a `DrillSampler` method on the user's cached sampler, if there is
+    one, e.g., `update_drill_sampler(user.pk, DrillSampler.add, note.pk)`.
+
+    While a drill queue is pending, the cached sampler is ahead of the
+    database by the queued drills, so changes to the collection discard
+    both the queue and the sampler instead. Promotion and demotion don't
+    affect the order of notes, and are applied in place; queued cards keep
+    the weights they were drawn with.
+    """
+    keys = [drill_sampler_cache_key(user_pk), drill_queue_cache_key(user_pk)]
+    cached = cache.get_many(keys)
+    sampler = cached.get(keys[0])
+    if sampler is None:
+        return
+    if cached.get(keys[1]) and method not in (
+        DrillSampler.set_promoted,
+        DrillSampler.set_promoted_many,
+    ):
+        invalidate_drill_sampler(user_pk)
+        return
+    method(sampler, *args)
+    save_drill_sampler(user_pk, sampler)
+
+
+def invalidate_drill_sampler(*user_pks):
+    """Delete the cached samplers and drill queues of the given users."""
+    cache.delete_many(
+        [drill_sampler_cache_key(user_pk) for user_pk in user_pks]
+        + [drill_queue_cache_key(user_pk) for user_pk in user_pks]
+    )
+
+
+def pop_drill_card(user_pk, queue_size=DRILL_QUEUE_SIZE):
+    """
+    Return the primary key of the next note to drill, or None if the
+    collection has fewer than two notes.
+
+    Cards are drawn `queue_size` at a time by simulating drills on the
+    user's sampler, which follows the same rules as single draws (e.g.,
+    never repeating the last drilled note). The queue is kept in the cache
+    along with the advanced sampler, so that the following cards need no
+    draws, only a cache lookup. An empty queue is kept once used up, as
+    the sampler is then in sync with the database again; if there is no
+    queue at all, the sampler is rebuilt. Callers are expected to stamp each card as
+    drilled, and to call `invalidate_drill_sampler()` if that fails.
+    """
+    key = drill_queue_cache_key(user_pk)
+    # Stored in reverse, so that the next card is popped from the end:
+    queue = cache.get(key)
+    if not queue:
+        if queue is None:
+            # A cached sampler without its queue (e.g., if the queue was
+            # evicted on its own) may be ahead of the database by cards that
+            # were never shown:
+            sampler = build_drill_sampler(user_pk)
+        else:
+            sampler = get_drill_sampler(user_pk)
+        if len(sampler) < 2:
+            return None
+        queue = []
+        for _ in range(queue_size):
+            queue.append(sampler.draw_and_touch())
+        queue.reverse()
+        save_drill_sampler(user_pk, sampler)
+    note_pk = queue.pop()
+    cache.set(key, queue, DRILL_SAMPLER_CACHE_TIMEOUT)
+    return note_pk
+
+
+def _collection_table_and_columns():
+    qn = connection.ops.quote_name
+    table = qn(Collection._meta.db_table)
+    columns = {
+        name: qn(Collection._meta.get_field(name).column)
+        for name in ("user", "note", "last_drilled", "promoted")
+    }
+    return table, columns
+
+
+def stamp_drilled(user_pk, note_pk, now):
+    """
+    Set the last drilled time of a note in the user's collection to `now`.
+
+    Return a `(promoted, previous_last_drilled)` pair, or None if the note
+    isn't in the collection. This takes a single statement.
+    """
+    table, c = _collection_table_and_columns()
+    pk = connection.ops.quote_name(Collection._meta.pk.column)
+    # The joined row is read as it was before the update:
+    sql = (
+        f"UPDATE {table} SET {c['last_drilled']} = %(now)s"
+        f" FROM {table} AS previous"
+        f" WHERE previous.{pk} = {table}.{pk}"
+        f" AND {table}.{c['user']} = %(user)s AND {table}.{c['note']} = %(note)s"
+        f" RETURNING {table}.{c['promoted']}, previous.{c['last_drilled']}"
+    )
+    params = {"now": now, "user": user_pk, "note": note_pk}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchone()
+
+
+def set_promoted(user_pk, note_code, promoted):
+    """
+    Set the promotion status of a note in the user's collection. Return the
+    note's primary key, or None if it isn't in the collection. This takes a
+    single statement.
+    """
+    table, c = _collection_table_and_columns()
+    qn = connection.ops.quote_name
+    note_table = qn(Note._meta.db_table)
+    note_pk = qn(Note._meta.pk.column)
+    code = qn(Note._meta.get_field("code").column)
+    sql = (
+        f"UPDATE {table} SET {c['promoted']} = %(promoted)s"
+        f" FROM {note_table}"
+        f" WHERE {c['note']} = {note_table}.{note_pk}"
+        f" AND {note_table}.{code} = %(code)s AND {c['user']} = %(user)s"
+        f" RETURNING {table}.{c['note']}"
+    )
+    params = {"promoted": promoted, "code": note_code, "user": user_pk}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def set_promoted_many(user_pk, note_codes, promoted):
+    """
+    Set the promotion status of notes in the user's collection. Return a
+    dict mapping the code of each note in the collection to a `(note_pk,
+    changed)` pair. This takes a single statement.
+    """
+    table, c = _collection_table_and_columns()
+    qn = connection.ops.quote_name
+    pk = qn(Collection._meta.pk.column)
+    note_table = qn(Note._meta.db_table)
+    note_pk = qn(Note._meta.pk.column)
+    code = qn(Note._meta.get_field("code").column)
+    # The joined row is read as it was before the update:
+    sql = (
+        f"UPDATE {table} SET {c['promoted']} = %(promoted)s"
+        f" FROM {note_table}, {table} AS previous"
+        f" WHERE previous.{pk} = {table}.{pk}"
+        f" AND {table}.{c['note']} = {note_table}.{note_pk}"
+        f" AND {note_table}.{code} = ANY(%(codes)s)"
+        f" AND {table}.{c['user']} = %(user)s"
+        f" RETURNING {note_table}.{note_pk}, {note_table}.{code},"
+        f" previous.{c['promoted']} <> %(promoted)s"
+    )
+    params = {"promoted": promoted, "codes": list(note_codes), "user": user_pk}
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    return {code: (note_pk, changed) for note_pk, code, changed in rows}
+
+
+def apply_drill_events(user_pk, events):
+    """
+    Apply a batch of drill events recorded by an offline client, in one
+    transaction with one bulk update per field.
+
+    `events` are `(note_code, drilled_at, promoted)` tuples in the order
+    they happened, where `promoted` is the note's promotion status after
+    the event, or None if unchanged. Last drilled times only move forward,
+    in case the note was drilled later elsewhere. Return the set of codes
+    that are not in the user's collection.
+    """
+    latest = {}
+    promoted = {}
+    for code, drilled_at, promoted_after in events:
+        if code not in latest or drilled_at > latest[code]:
+            latest[code] = drilled_at
+        if promoted_after is not None:
+            promoted[code] = promoted_after
+
+    with transaction.atomic():
+        rows = (
+            Collection.objects.filter(user=user_pk, note__code__in=latest)
+            .select_for_update(of=("self",))
+            .values_list("pk", "note__code", "last_drilled", "promoted")
+        )
+        drilled = []
+        drill_times = []
+        changed = []
+        found = set()
+        for pk, code, last_drilled, was_promoted in rows:
+            found.add(code)
+            if latest[code] > last_drilled:
+                drilled.append(Collection(pk=pk, last_drilled=latest[code]))
+                drill_times.append((last_drilled, latest[code]))
+            if code in promoted and promoted[code] != was_promoted:
+                changed.append(Collection(pk=pk, promoted=promoted[code]))
+        Collection.objects.bulk_update(drilled, ["last_drilled"])
+        Collection.objects.bulk_update(changed, ["promoted"])
+
+    if drilled or changed:
+        # Rebuilt on the next online draw:
+        invalidate_drill_sampler(user_pk)
+    if drill_times:
+        update_drill_stats(user_pk, DrillStats.record_drills, drill_times)
+    return set(latest) - found
+
+
+# ------------------
+# Spaced repetition
+# ------------------
+
+
+def schedule_review(interval, ease, result, promoted):
+    """
+    Return the new `(interval, ease, delay)` of a collection item after a
+    review with the given result, loosely following SM-2: the interval
+    grows by the ease factor after each successful review, and failing a
+    review resets it and lowers the ease. `delay` is the time until the
+    item is due again, which is shortened for promoted items.
+    """
+    if result == "again":
+        return (
+            timezone.timedelta(),
+            max(REVIEW_MIN_EASE, ease - REVIEW_EASE_PENALTY),
+            REVIEW_AGAIN_DELAY,
+        )
+    for first_interval in REVIEW_FIRST_INTERVALS:
+        if interval < first_interval:
+            interval = first_interval
+            break
+    else:
+        interval = interval * ease
+    delay = interval * PROMOTED_INTERVAL_FACTOR if promoted else interval
+    return interval, ease, delay
+
+
+def review_note(user_pk, note_code, result):
+    """
+    Record a spaced-repetition review of a note in the user's collection,
+    which also counts as drilling it. Return whether the note was found.
+    """
+    collection = (
+        Collection.objects.filter(user=user_pk, note__code=note_code)
+        .only("note_id", "promoted", "interval", "ease", "last_drilled")
+        .first()
+    )
+    if collection is None:
+        return False
+    interval, ease, delay = schedule_review(
+        collection.interval, collection.ease, result, collection.promoted
+    )
+    now = timezone.now()
+    Collection.objects.filter(pk=collection.pk).update(
+        interval=interval, ease=ease, due_at=now + delay, last_drilled=now
+    )
+    update_drill_sampler(user_pk, DrillSampler.touch, collection.note_id)
+    update_drill_stats(user_pk, DrillStats.record_drill, collection.last_drilled, now)
+    return True
+
+
+def get_next_due(user_pk, now):
+    """
+    Return the most overdue collection item of the user, with its note and
+    author, or None if none is due. This is a range scan on the `(user,
+    due_at)` index.
+    """
+    return (
+        Collection.objects.filter(user=user_pk, due_at__lte=now)
+        .order_by("due_at")
+        .select_related("note__author")
+        .first()
+    )
+
+
+def count_due(user_pk, now):
+    """
+    Return the number of the user's collection items due for review, up to
+    `REVIEW_DUE_COUNT_LIMIT`, and whether there are more. Counting stops
+    after the limit, so that a large backlog costs no more than a short one.
+    """
+    count = Collection.objects.filter(user=user_pk, due_at__lte=now)[
+        : REVIEW_DUE_COUNT_LIMIT + 1
+    ].count()
+    return min(count, REVIEW_DUE_COUNT_LIMIT), count > REVIEW_DUE_COUNT_LIMIT
@@ -0,0 +1,127 @@
+"""
+Per-user drill statistics shown on the Drill pages.
+
+Counting a user's collection, and the notes in it drilled (or added) in the
+last 24 hours, takes a scan of their rows in `Collection`. Instead, each
+user has a `DrillStats` in the cache with the collection size and the
+number of notes last drilled in each hour, updated as notes are drilled,
+saved and unsaved (see `notes.signals`), and rebuilt from the table on a
+cache miss.
+
+The 24-hour count is to the hour: it covers the current hour and the 23
+before it.
+"""
+
+import datetime
+
+from django.core.cache import cache
+from django.db.models import Count
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from .models import Collection
+
+DRILL_STATS_CACHE_TIMEOUT = 60 * 60 * 24
+RECENT_DRILL_HOURS = 24
+
+
+def hour_of(moment):
+    """Return the number of the UTC hour of a datetime."""
+    return int(moment.timestamp() // 3600)
+
+
+class DrillStats:
+    """Collection size, and the number of notes last drilled in each hour."""
+
+    __slots__ = ("size", "hourly")
+
+    def __init__(self, size=0, hourly=None):
+        self.size = size
+        self.hourly = hourly or {}
+
+    def prune(self, now):
+        oldest = hour_of(now) - RECENT_DRILL_HOURS + 1
+        for hour in [hour for hour in self.hourly if hour < oldest]:
+            del self.hourly[hour]
+
+    def _add(self, moment, count):
+        hour = hour_of(moment)
+        self.hourly[hour] = self.hourly.get(hour, 0) + count
+        if not self.hourly[hour]:
+            del self.hourly[hour]
+
+    def recent_drill_count(self, now):
+        oldest = hour_of(now) - RECENT_DRILL_HOURS + 1
+        return sum(count for hour, count in self.hourly.items() if hour >= oldest)
+
+    def record_drill(self, previous, drilled_at):
+        """Record that a note last drilled at `previous` was drilled again."""
+        self.record_drills([(previous, drilled_at)])
+
+    def record_drills(self, drills):
+        """Record a sequence of `(previous, drilled_at)` pairs."""
+        for previous, drilled_at in drills:
+            self._add(previous, -1)
+            self._add(drilled_at, 1)
+        self.prune(timezone.now())
+
+    def record_added(self, last_drilled, count=1):
+        self.size += count
+        self._add(last_drilled, count)
+        self.prune(timezone.now())
+
+    def record_removed(self, last_drilled):
+        self.record_removals([last_drilled])
+
+    def record_removals(self, last_drilled_times):
+        """Record the removal of notes last drilled at the given times."""
+        for last_drilled in last_drilled_times:
+            self.size -= 1
+            self._add(last_drilled, -1)
+        self.prune(timezone.now())
+
+
+def drill_stats_cache_key(user_pk):
+    return f"notes:drill-stats:{user_pk}"
+
+
+def build_drill_stats(user_pk):
+    """Build the user's statistics from the database and cache them."""
+    now = timezone.now()
+    items = Collection.objects.filter(user=user_pk)
+    hourly = (
+        items.filter(
+            last_drilled__gte=now - timezone.timedelta(hours=RECENT_DRILL_HOURS)
+        )
+        .annotate(hour=TruncHour("last_drilled", tzinfo=datetime.timezone.utc))
+        .values_list("hour")
+        .annotate(count=Count("pk"))
+        .order_by()
+    )
+    stats = DrillStats(items.count(), {hour_of(hour): count for hour, count in hourly})
+    stats.prune(now)
+    cache.set(drill_stats_cache_key(user_pk), stats, DRILL_STATS_CACHE_TIMEOUT)
+    return stats
+
+
+def get_drill_stats(user_pk):
+    stats = cache.get(drill_stats_cache_key(user_pk))
+    if stats is None:
+        stats = build_drill_stats(user_pk)
+    return stats
+
+
+def update_drill_stats(user_pk, method, *args):
+    """
+    Call a `DrillStats` method on the user's cached statistics, if any, e.g.,
+    `update_drill_stats(user.pk, DrillStats.record_added, timezone.now())`.
+    """
+    key = drill_stats_cache_key(user_pk)
+    stats = cache.get(key)
+    if stats is not None:
+        method(stats, *args)
+        cache.set(key, stats, DRILL_STATS_CACHE_TIMEOUT)
+
+
+def invalidate_drill_stats(*user_pks):
+    cache.delete_many([drill_stats_cache_key(user_pk) for user_pk in user_pks])
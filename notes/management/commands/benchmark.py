@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from notes.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Run a benchmark and print the results as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", choices=sorted(BENCHMARKS))
+        parser.add_argument("--number", type=int, help="Iterations per run.")
+        parser.add_argument("--repeat", type=int, help="Runs per measurement.")
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", help="Data set sizes, where applicable."
+        )
+
+    def handle(self, *args, **options):
+        kwargs = {
+            key: options[key]
+            for key in ("number", "repeat", "sizes")
+            if options[key] is not None
+        }
+        values = [kwargs.get("number", 1), kwargs.get("repeat", 1)]
+        if min(values + kwargs.get("sizes", [])) < 1:
+            raise CommandError("number, repeat and sizes should be positive.")
+        results = BENCHMARKS[options["name"]](**kwargs)
+        self.stdout.write(
+            json.dumps({"benchmark": options["name"], "results": results}, indent=4)
+        )
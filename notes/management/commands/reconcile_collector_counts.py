@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+
+from notes.models import Collection, Note
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount the collectors of all notes, correcting any maintained"
+        " collector counts that have drifted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def iter_batches(self, batch_size):
+        """Yield batches of `(pk, collector_count)` pairs using keyset iteration."""
+        last_pk = 0
+        while True:
+            batch = list(
+                Note.objects.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .values_list("pk", "collector_count")[:batch_size]
+            )
+            if not batch:
+                return
+            last_pk = batch[-1][0]
+            yield batch
+
+    def reconcile_batch(self, batch):
+        counts = dict(
+            Collection.objects.filter(note__in=[pk for pk, _ in batch])
+            .order_by()
+            .values_list("note")
+            .annotate(Count("pk"))
+        )
+        notes = [
+            Note(pk=pk, collector_count=counts.get(pk, 0))
+            for pk, stored in batch
+            if stored != counts.get(pk, 0)
+        ]
+        Note.objects.bulk_update(notes, ["collector_count"])
+        return len(notes)
+
+    def handle(self, *args, **options):
+        if (batch_size := options["batch_size"]) < 1:
+            raise CommandError("batch-size should be positive.")
+        reconciled_count = 0
+        for batch in self.iter_batches(batch_size):
+            reconciled_count += self.reconcile_batch(batch)
+        self.stdout.write("%s note(s) reconciled." % reconciled_count)
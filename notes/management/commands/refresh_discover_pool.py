@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from notes.discover import DISCOVER_POOL_SIZE, refresh_discover_pool
+
+
+class Command(BaseCommand):
+    help = (
+        "Refill the pool of random public notes shown to anonymous Discover"
+        " visitors. Intended to be run on a schedule."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=DISCOVER_POOL_SIZE)
+
+    def handle(self, *args, **options):
+        if (size := options["size"]) < 1:
+            raise CommandError("size should be positive.")
+        count = refresh_discover_pool(size)
+        self.stdout.write("%s note(s) in the Discover pool." % count)
@@ -0,0 +1,94 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from leornian_helpers.markdown import renderer
+from notes.caching import invalidate_note_card
+from notes.models import Note
+
+
+def _render_chunk(chunk):
+    """Render a chunk of `(pk, text)` pairs; runs in worker processes."""
+    pks, texts = zip(*chunk)
+    return list(zip(pks, renderer.render_many(texts)))
+
+
+class Command(BaseCommand):
+    help = (
+        "Backfill or re-render the stored HTML of notes. By default, only"
+        " notes rendered with an outdated renderer version are processed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Re-render all notes, including those that are up to date.",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--jobs",
+            type=int,
+            default=1,
+            help="Number of worker processes used for rendering.",
+        )
+
+    def iter_chunks(self, queryset, batch_size):
+        """Yield chunks of `(pk, text)` pairs using keyset iteration."""
+        last_pk = 0
+        while True:
+            chunk = list(
+                queryset.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .values_list("pk", "text")[:batch_size]
+            )
+            if not chunk:
+                return
+            last_pk = chunk[-1][0]
+            yield chunk
+
+    def save_chunk(self, rendered):
+        notes = [
+            Note(
+                pk=pk,
+                html_rendered=html,
+                html_renderer_version=Note.HTML_RENDERER_VERSION,
+            )
+            for pk, html in rendered
+        ]
+        Note.objects.bulk_update(notes, ["html_rendered", "html_renderer_version"])
+        # `bulk_update()` sends no signals:
+        invalidate_note_card(*(note.pk for note in notes))
+        return len(notes)
+
+    def handle(self, *args, **options):
+        if (batch_size := options["batch_size"]) < 1:
+            raise CommandError("batch-size should be positive.")
+        if (jobs := options["jobs"]) < 1:
+            raise CommandError("jobs should be positive.")
+
+        queryset = Note.objects.all()
+        if not options["all"]:
+            queryset = queryset.exclude(
+                html_renderer_version=Note.HTML_RENDERER_VERSION
+            )
+        chunks = self.iter_chunks(queryset, batch_size)
+
+        rendered_count = 0
+        if jobs == 1:
+            for chunk in chunks:
+                rendered_count += self.save_chunk(_render_chunk(chunk))
+        else:
+            # Keep a bounded number of chunks in flight so that memory use
+            # does not grow with the size of the notes table:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(executor.submit(_render_chunk, chunk))
+                    if len(pending) >= jobs * 2:
+                        rendered_count += self.save_chunk(pending.popleft().result())
+                while pending:
+                    rendered_count += self.save_chunk(pending.popleft().result())
+
+        self.stdout.write("%s note(s) rendered." % rendered_count)
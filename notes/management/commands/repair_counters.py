@@ -0,0 +1,62 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from notes.counters import exact_counts, save_counts
+from notes.models import Counter
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount the maintained note list counters of all users, creating"
+        " missing ones and correcting any that have drifted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of users whose counters are recounted per query.",
+        )
+
+    def iter_user_batches(self, batch_size):
+        """Yield batches of user primary keys using keyset iteration."""
+        user_model = get_user_model()
+        last_pk = 0
+        while True:
+            batch = list(
+                user_model.objects.filter(pk__gt=last_pk)
+                .order_by("pk")
+                .values_list("pk", flat=True)[:batch_size]
+            )
+            if not batch:
+                return
+            last_pk = batch[-1]
+            yield batch
+
+    def repair_batch(self, user_pks):
+        stored = {
+            (user_pk, kind): count
+            for user_pk, kind, count in Counter.objects.filter(
+                user__in=user_pks
+            ).values_list("user", "kind", "count")
+        }
+        repaired = 0
+        for kind in Counter.Kind:
+            drifted = {
+                user_pk: count
+                for user_pk, count in exact_counts(kind, user_pks).items()
+                if stored.get((user_pk, kind)) != count
+            }
+            if drifted:
+                save_counts(kind, drifted)
+            repaired += len(drifted)
+        return repaired
+
+    def handle(self, *args, **options):
+        if (batch_size := options["batch_size"]) < 1:
+            raise CommandError("batch-size should be positive.")
+        repaired_count = 0
+        for user_pks in self.iter_user_batches(batch_size):
+            repaired_count += self.repair_batch(user_pks)
+        self.stdout.write("%s counter(s) repaired." % repaired_count)
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.11 on 2026-10-18 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0008_note_visibility_locked'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='html_rendered',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='note',
+            name='html_renderer_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+    ]
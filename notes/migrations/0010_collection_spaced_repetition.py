@@ -0,0 +1,36 @@
+# Generated by Django 4.2.11 on 2026-10-18 13:25
+
+import datetime
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notes", "0009_note_html_rendered"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="due_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="ease",
+            field=models.FloatField(default=2.5),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="interval",
+            field=models.DurationField(default=datetime.timedelta),
+        ),
+        migrations.AddIndex(
+            model_name="collection",
+            index=models.Index(
+                fields=["user", "due_at"], name="collection_user_due_at"
+            ),
+        ),
+    ]
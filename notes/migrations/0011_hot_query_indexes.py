@@ -0,0 +1,35 @@
+# Generated by Django 4.2.11 on 2026-10-18 13:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notes", "0010_collection_spaced_repetition"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="collection",
+            index=models.Index(
+                fields=["user", "last_drilled"], name="collection_user_last_drilled"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="collection",
+            index=models.Index(
+                condition=models.Q(("promoted", True)),
+                fields=["user", "note"],
+                name="collection_user_promoted",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="note",
+            index=models.Index(
+                condition=models.Q(("visibility", 1)),
+                fields=["author", "-created"],
+                name="note_author_created_listed",
+            ),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.11 on 2026-10-18 13:52
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def count_collectors(apps, schema_editor):
+    Collection = apps.get_model("notes", "Collection")
+    Note = apps.get_model("notes", "Note")
+    counts = (
+        Collection.objects.filter(note=OuterRef("pk"))
+        .order_by()
+        .values("note")
+        .annotate(count=Count("pk"))
+        .values("count")
+    )
+    Note.objects.update(collector_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notes", "0012_counter"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="note",
+            name="collector_count",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_collectors, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="note",
+            index=models.Index(
+                condition=models.Q(("visibility", 1)),
+                fields=["-collector_count", "-created"],
+                name="note_popular_listed",
+            ),
+        ),
+    ]
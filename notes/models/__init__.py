@@ -1,3 +1,4 @@
-from .note import Note
+from .note import Note, NoteCard
 from .collection import Collection
 from .deattribution import Deattribution
+from .counter import Counter
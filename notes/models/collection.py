@@ -10,7 +10,25 @@ class Collection(models.Model):
     last_drilled = models.DateTimeField(default=timezone.now)
     promoted = models.BooleanField(default=False)
 
+    # Spaced repetition scheduling (see `notes.drill.schedule_review()`):
+    interval = models.DurationField(default=timezone.timedelta)
+    ease = models.FloatField(default=2.5)
+    due_at = models.DateTimeField(default=timezone.now)
+
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=["note", "user"], name="unique_collect"),
         ]
+        indexes = [
+            models.Index(fields=["user", "due_at"], name="collection_user_due_at"),
+            # Drill sampler and statistics:
+            models.Index(
+                fields=["user", "last_drilled"], name="collection_user_last_drilled"
+            ),
+            # Promoted notes of a user:
+            models.Index(
+                fields=["user", "note"],
+                condition=models.Q(promoted=True),
+                name="collection_user_promoted",
+            ),
+        ]
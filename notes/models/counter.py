@@ -0,0 +1,27 @@
+"""
+Maintained row counts of per-user note lists.
+
+Rows are kept up to date by the receivers in `notes.signals`, and can be
+reconciled with the `repair_counters` command. See `notes.counters`.
+"""
+
+from django.db import models
+from django.conf import settings
+
+
+class Counter(models.Model):
+    class Kind(models.IntegerChoices):
+        COLLECTED = 1  # notes in the user's collection
+        LISTED = 2  # listed notes authored by the user
+        DEATTRIBUTED = 3  # notes deattributed by the user
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+"
+    )
+    kind = models.PositiveSmallIntegerField(choices=Kind.choices)
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "kind"], name="unique_counter"),
+        ]
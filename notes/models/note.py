@@ -1,17 +1,61 @@
 """Core note model and related querying logic."""
 
+import itertools
+import random
+from typing import NamedTuple
+
 from django.db import models
-from django.db.models import Exists, OuterRef
+from django.db.models import Exists, F, Max, Min, OuterRef
+from django.db.models.query import ModelIterable, ValuesListIterable
 from django.conf import settings
 from django.utils import safestring
-from django.urls import reverse
-
-from markdown_it import MarkdownIt
 
+from leornian_helpers.markdown import renderer
+from leornian_helpers.utils import URLTemplate
 from notes.utils import ChoiceTags, generate_reference_code
 
+SINGLE_NOTE_URL = URLTemplate("notes:single-note", "slug")
+
+# Parameters for random selection by primary key probing (see
+# `NoteQuerySet.get_random_many()`):
+RANDOM_PROBE_MIN_SIZE = 32
+RANDOM_PROBE_OVERSAMPLING = 4
+RANDOM_PROBE_ATTEMPTS = 3
+
+
+def set_saved(notes, user):
+    """
+    Set the `saved` attribute of notes for a user with a single `note_id IN
+    (...)` query on `Collection`.
+    """
+    saved = set(
+        Note.collectors.through.objects.filter(
+            user=user, note__in=[note.pk for note in notes]
+        ).values_list("note_id", flat=True)
+    )
+    for note in notes:
+        note.saved = note.pk in saved
+
 
 class NoteQuerySet(models.QuerySet):
+    _saved_for = None
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._saved_for = self._saved_for
+        return clone
+
+    def _fetch_all(self):
+        fetching = self._result_cache is None
+        super()._fetch_all()
+        if (
+            fetching
+            and self._saved_for is not None
+            and self._iterable_class in (ModelIterable, NoteCardIterable)
+            and self._result_cache
+        ):
+            set_saved(self._result_cache, self._saved_for)
+
     def annotate_for_controls(self, user):
         if not hasattr(user, "collected_notes"):
             return self
@@ -19,17 +63,128 @@ class NoteQuerySet(models.QuerySet):
             saved=Exists(user.collected_notes.filter(pk=OuterRef("pk")))
         )
 
-    def get_random(self, for_user=None):
-        if for_user:
+    def with_saved(self, user):
+        """
+        Like `annotate_for_controls()`, but without a correlated subquery
+        per row: once fetched, the notes get their `saved` attribute from
+        `set_saved()`.
+        """
+        if not hasattr(user, "collected_notes"):
+            return self
+        clone = self._chain()
+        clone._saved_for = user
+        return clone
+
+    def cards(self):
+        """
+        Return the notes as `NoteCard` instances, fetching only the columns
+        shown on note cards (and `saved`, if annotated).
+        """
+        fields = NoteCard.FIELDS
+        if "saved" in self.query.annotations:
+            fields += ("saved",)
+        clone = self.values_list(*fields)
+        clone._iterable_class = NoteCardIterable
+        return clone
+
+    def popular(self):
+        """Return listed notes, most collected first."""
+        return self.filter(visibility=Note.Visibility.NORMAL).order_by(
+            "-collector_count", "-created"
+        )
+
+    def add_collectors(self, delta):
+        """Adjust the maintained `collector_count` of the notes by `delta`."""
+        return self.update(collector_count=F("collector_count") + delta)
+
+    def get_random(self, for_user=None, exclude_ids=None):
+        """Return a random listed note, or None if there is none."""
+        notes = self.get_random_many(1, for_user=for_user, exclude_ids=exclude_ids)
+        return notes[0] if notes else None
+
+    def get_random_many(self, count, for_user=None, pks_only=False, exclude_ids=None):
+        """
+        Return a list of up to `count` distinct, randomly selected, listed
+        notes, excluding those collected or authored by `for_user` if given.
+        If `pks_only` is true, return a list of primary keys instead.
+
+        `exclude_ids` may be given instead of `for_user` as a container of
+        note IDs to skip (e.g., from `notes.exclusions`). Candidates are
+        then rejected in memory, which avoids an anti-join on `Collection`.
+
+        Instead of `order_by("?")`, which sorts the whole table (see
+        tech.reversedelay.net/2023/09/optimizing-sql-random-row-select/),
+        this draws random primary keys from the range of existing keys and
+        fetches the eligible notes among them, which costs the same
+        regardless of table size. If probing repeatedly fails to find
+        enough notes (e.g., when few notes are eligible), the remainder is
+        taken by scanning forward from a random key, which is cheap but
+        less uniform.
+        """
+        if for_user and exclude_ids is None:
             qs = self.exclude(collectors=for_user).exclude(author=for_user)
         else:
             qs = self
+        qs = qs.exclude(visibility=Note.Visibility.UNLISTED)
+        if pks_only:
+            qs = qs.values_list("pk", flat=True)
+        else:
+            qs = qs.select_related("author")
+        if exclude_ids is None:
+            exclude_ids = ()
+
+        bounds = self.model.objects.aggregate(low=Min("pk"), high=Max("pk"))
+        if bounds["low"] is None:
+            return []
+        key_range = range(bounds["low"], bounds["high"] + 1)
+
+        notes = []
+        picked_pks = []
+
+        def pick(found):
+            found = list(found)
+            notes.extend(found)
+            picked_pks.extend(found if pks_only else [note.pk for note in found])
 
-        qs = qs.exclude(visibility=Note.Visibility.UNLISTED).select_related("author")
+        for _ in range(RANDOM_PROBE_ATTEMPTS):
+            needed = count - len(notes)
+            probe_size = max(RANDOM_PROBE_MIN_SIZE, needed * RANDOM_PROBE_OVERSAMPLING)
+            probe_size = min(probe_size, len(key_range))
+            keys = [
+                key
+                for key in random.sample(key_range, probe_size)
+                if key not in exclude_ids
+            ]
+            if keys:
+                pick(
+                    qs.filter(pk__in=keys)
+                    .exclude(pk__in=picked_pks)
+                    .order_by("?")[:needed]
+                )
+            if len(notes) == count or probe_size == len(key_range):
+                # Done, or the probe already covered every possible key:
+                return notes
 
-        # `order_by("?")` can be slow at scale. See:
-        # tech.reversedelay.net/2023/09/optimizing-sql-random-row-select/
-        return qs.order_by("?").first()
+        start = random.choice(key_range)
+        for keys in ({"pk__gte": start}, {"pk__lt": start}):
+            needed = count - len(notes)
+            scan = qs.filter(**keys).exclude(pk__in=picked_pks).order_by("pk")
+            if exclude_ids:
+                # At most `len(exclude_ids)` of the scanned notes are skipped:
+                scan = scan[: needed + len(exclude_ids)].iterator(
+                    chunk_size=max(RANDOM_PROBE_MIN_SIZE, needed)
+                )
+                scan = (
+                    found
+                    for found in scan
+                    if (found if pks_only else found.pk) not in exclude_ids
+                )
+                pick(itertools.islice(scan, needed))
+            else:
+                pick(scan[:needed])
+            if len(notes) == count:
+                break
+        return notes
 
 
 class Note(models.Model):
@@ -48,6 +203,10 @@ class Note(models.Model):
         Visibility.UNLISTED: ChoiceTags("secondary", "eye-slash"),
     }
 
+    # Bump this whenever the Markdown rendering rules change, so that stored
+    # HTML gets marked as stale (see the `render_note_html` command):
+    HTML_RENDERER_VERSION = 1
+
     # ------
     # FIELDS
     # ------
@@ -71,6 +230,11 @@ class Note(models.Model):
         settings.AUTH_USER_MODEL, through="Collection", related_name="collected_notes"
     )
     created = models.DateTimeField(auto_now_add=True)
+    # Number of users who have the note in their collection, maintained by
+    # the receivers in `notes.signals`:
+    collector_count = models.PositiveIntegerField(default=0, editable=False)
+    html_rendered = models.TextField(blank=True, editable=False)
+    html_renderer_version = models.PositiveSmallIntegerField(default=0, editable=False)
 
     # --------------------
     # METHODS & PROPERTIES
@@ -78,21 +242,16 @@ class Note(models.Model):
 
     @property
     def html(self):
-        """Render safe HTML from the Markdown-formatted `text` field."""
-        return safestring.mark_safe(
-            MarkdownIt("zero")
-            .enable(
-                [
-                    "emphasis",
-                    "strikethrough",
-                    "backticks",
-                    "entity",
-                    "escape",
-                    "list",
-                ]
-            )
-            .render(self.text)
-        )
+        """Safe HTML rendered from the Markdown-formatted `text` field."""
+        if self.html_renderer_version == self.HTML_RENDERER_VERSION:
+            return safestring.mark_safe(self.html_rendered)
+        # Stale or not-yet-backfilled row; render on the fly:
+        return safestring.mark_safe(renderer.render(self.text))
+
+    def render_html(self):
+        """Render `text` and store the output in `html_rendered`."""
+        self.html_rendered = renderer.render(self.text)
+        self.html_renderer_version = self.HTML_RENDERER_VERSION
 
     # ----------
     # META, ETC.
@@ -102,9 +261,130 @@ class Note(models.Model):
 
     class Meta:
         ordering = ["-created"]
+        indexes = [
+            # Listed notes by an author, newest first:
+            models.Index(
+                fields=["author", "-created"],
+                condition=models.Q(visibility=1),
+                name="note_author_created_listed",
+            ),
+            # Listed notes by popularity (see `NoteQuerySet.popular()`):
+            models.Index(
+                fields=["-collector_count", "-created"],
+                condition=models.Q(visibility=1),
+                name="note_popular_listed",
+            ),
+        ]
 
     def __str__(self):
         return str(self.code)
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "text" in update_fields:
+            self.render_html()
+            if update_fields is not None:
+                kwargs["update_fields"] = {
+                    *update_fields,
+                    "html_rendered",
+                    "html_renderer_version",
+                }
+        super().save(*args, **kwargs)
+
     def get_absolute_url(self):
-        return reverse("notes:single-note", kwargs={"slug": self.code})
+        return SINGLE_NOTE_URL.format(slug=self.code)
+
+
+class NoteCardAuthor(NamedTuple):
+    pk: int
+    username: str
+
+
+class NoteCard:
+    """
+    Read-only projection of a `Note` with the fields shown on note cards,
+    which `notes/includes/note_card.html` and the note template tags accept
+    in place of a `Note` (see `NoteQuerySet.cards()`). Unlike model
+    instances, cards don't carry the full author row.
+    """
+
+    FIELDS = (
+        "pk",
+        "code",
+        "text",
+        "html_rendered",
+        "html_renderer_version",
+        "visibility",
+        "created",
+        "author_id",
+        "author__username",
+    )
+
+    __slots__ = (
+        "pk",
+        "code",
+        "text",
+        "html_rendered",
+        "html_renderer_version",
+        "visibility",
+        "created",
+        "author",
+        "saved",
+    )
+
+    Visibility = Note.Visibility
+    VISIBILITY_TAGS = Note.VISIBILITY_TAGS
+    HTML_RENDERER_VERSION = Note.HTML_RENDERER_VERSION
+
+    def __init__(
+        self,
+        pk,
+        code,
+        text,
+        html_rendered,
+        html_renderer_version,
+        visibility,
+        created,
+        author_id,
+        author_username,
+        saved=None,
+    ):
+        self.pk = pk
+        self.code = code
+        self.text = text
+        self.html_rendered = html_rendered
+        self.html_renderer_version = html_renderer_version
+        self.visibility = visibility
+        self.created = created
+        self.author = author_id and NoteCardAuthor(author_id, author_username)
+        if saved is not None:
+            self.saved = saved
+
+    def __repr__(self):
+        return f"<NoteCard: {self.code}>"
+
+    def __eq__(self, other):
+        if isinstance(other, (Note, NoteCard)):
+            return self.pk == other.pk
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    @property
+    def author_id(self):
+        return self.author and self.author.pk
+
+    html = Note.html
+    get_absolute_url = Note.get_absolute_url
+
+    def get_visibility_display(self):
+        return Note.Visibility(self.visibility).label
+
+
+class NoteCardIterable(ValuesListIterable):
+    """Yield a `NoteCard` for each row of a `values_list()` query."""
+
+    def __iter__(self):
+        for row in super().__iter__():
+            yield NoteCard(*row)
@@ -0,0 +1,208 @@
+"""
+Keyset (cursor) pagination for lists ordered newest first.
+
+`Paginator` fetches pages with OFFSET, which reads and discards every row
+before the page, so deep pages get slower. `CursorPaginator` instead
+continues from the `(created, pk)` key of the last (or first) row of the
+current page, which is a range scan that costs the same at any depth. The
+first `PAGE_NUMBER_LIMIT` pages keep their `?page=N` URLs, which are cheap
+enough with OFFSET; later pages are linked with opaque `?cursor=` tokens.
+"""
+
+import base64
+import binascii
+import json
+import math
+from collections.abc import Sequence
+from functools import cached_property
+
+from django.core.paginator import EmptyPage, InvalidPage, PageNotAnInteger
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.http import urlencode
+
+from .counters import get_count
+
+PAGE_NUMBER_LIMIT = 5
+
+AFTER = "a"
+BEFORE = "b"
+
+
+class InvalidCursor(InvalidPage):
+    pass
+
+
+def encode_cursor(number, direction, created, pk):
+    """
+    Return a token for page `number`, which starts after (or ends before)
+    the row with the given key.
+    """
+    data = json.dumps([number, direction, created.isoformat(), pk])
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """Return the `(number, direction, created, pk)` encoded in a token."""
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        number, direction, created, pk = json.loads(data)
+        created = parse_datetime(created)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise InvalidCursor("Invalid cursor")
+    if (
+        not isinstance(number, int)
+        or number < 1
+        or direction not in (AFTER, BEFORE)
+        or created is None
+        or not isinstance(pk, int)
+    ):
+        raise InvalidCursor("Invalid cursor")
+    return number, direction, created, pk
+
+
+class CursorPage(Sequence):
+    """Page with links to the adjacent pages, like `django.core.paginator.Page`."""
+
+    def __init__(self, object_list, number, paginator, has_previous, has_next):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def __repr__(self):
+        return "<Page %s>" % self.number
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_previous or self._has_next
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def _page_query(self, number, direction, row):
+        if number <= PAGE_NUMBER_LIMIT:
+            return urlencode({"page": number})
+        key = getattr(row, self.paginator.key_field)
+        return urlencode({"cursor": encode_cursor(number, direction, key, row.pk)})
+
+    def next_page_query(self):
+        """Query string of the next page, e.g., `page=2` or `cursor=...`."""
+        return self._page_query(self.number + 1, AFTER, self.object_list[-1])
+
+    def previous_page_query(self):
+        return self._page_query(self.number - 1, BEFORE, self.object_list[0])
+
+
+class CursorPaginator:
+    """
+    Paginate a queryset newest first, by `key_field` and then primary key.
+
+    `count` and `num_pages` are only queried when used, with
+    `notes.counters.get_count()`: pass `counter` as a `(kind, user_pk)`
+    pair if the queryset holds exactly the rows of a maintained counter.
+    Otherwise, or if the counter is missing, large counts are estimated,
+    which is shown by `count_is_estimate`.
+    """
+
+    def __init__(self, queryset, per_page, key_field="created", counter=None):
+        self.queryset = queryset.order_by(f"-{key_field}", "-pk")
+        self.per_page = int(per_page)
+        self.key_field = key_field
+        self.counter = counter
+
+    @cached_property
+    def _count(self):
+        return get_count(self.queryset, self.counter)
+
+    @property
+    def count(self):
+        return self._count[0]
+
+    @property
+    def count_is_estimate(self):
+        return self._count[1]
+
+    @cached_property
+    def num_pages(self):
+        return max(1, math.ceil(self.count / self.per_page))
+
+    def _page(self, rows, number, has_previous, has_next=None):
+        if has_next is None:
+            has_next = len(rows) > self.per_page
+        return CursorPage(rows[: self.per_page], number, self, has_previous, has_next)
+
+    def page(self, number):
+        """
+        Return a page by number, using OFFSET. Numbers past the last page,
+        or past `PAGE_NUMBER_LIMIT` (later pages are linked with cursors),
+        return the last page.
+        """
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger("That page number is not an integer")
+        if number < 1:
+            raise EmptyPage("That page number is less than 1")
+        rows = []
+        if number <= PAGE_NUMBER_LIMIT:
+            offset = (number - 1) * self.per_page
+            rows = list(self.queryset[offset : offset + self.per_page + 1])
+        if not rows and number > 1:
+            # An exact count is needed here:
+            number = max(1, math.ceil(self.queryset.count() / self.per_page))
+            offset = (number - 1) * self.per_page
+            rows = list(self.queryset[offset : offset + self.per_page + 1])
+        return self._page(rows, number, number > 1)
+
+    def seek(self, direction, created, pk):
+        """
+        Return the rows after (or before, in reverse) the row with the given
+        key. Besides the exact `(key, pk)` condition, the key is bounded on
+        its own so that the scan can start at the cursor in an index.
+        """
+        key = self.key_field
+        if direction == AFTER:
+            return self.queryset.filter(
+                Q(**{f"{key}__lt": created}) | Q(**{key: created, "pk__lt": pk}),
+                **{f"{key}__lte": created},
+            )
+        return self.queryset.reverse().filter(
+            Q(**{f"{key}__gt": created}) | Q(**{key: created, "pk__gt": pk}),
+            **{f"{key}__gte": created},
+        )
+
+    def cursor_page(self, token):
+        """Return the page of a cursor token, with a single range scan."""
+        number, direction, created, pk = decode_cursor(token)
+        rows = list(self.seek(direction, created, pk)[: self.per_page + 1])
+        if direction == AFTER:
+            page = self._page(rows, number, number > 1)
+        else:
+            has_previous = len(rows) > self.per_page
+            page = self._page(rows[: self.per_page][::-1], number, has_previous, True)
+        if not page.object_list:
+            # The rows around the cursor are gone; start over:
+            return self.page(1)
+        return page
+
+    def get_page(self, number=None, cursor=None):
+        """Return the page for the `page` or `cursor` request parameters."""
+        if cursor:
+            return self.cursor_page(cursor)
+        return self.page(number or 1)
@@ -0,0 +1,339 @@
+"""
+Signal receivers that keep cached note data consistent.
+
+Saving and unsaving through `notes.collecting` sends no signals; its hooks
+apply the same side effects and should be kept in sync with the receivers
+for `Collection` below.
+
+Cached data is invalidated or updated with `update_cache_on_commit()`, so
+that a concurrent request can't cache it again from the old rows in
+between, and a rollback leaves it untouched.
+"""
+
+from django.conf import settings
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .caching import invalidate_note_card, update_cache_on_commit
+from .counters import create_counters, increment_counters, refresh_counter
+from .discover import remove_from_discover_pool
+from .drill import DrillSampler, invalidate_drill_sampler, update_drill_sampler
+from .drill_stats import DrillStats, invalidate_drill_stats, update_drill_stats
+from .exclusions import (
+    add_excluded_ids,
+    invalidate_excluded_ids,
+    remove_collected_ids,
+)
+from .models import Collection, Counter, Deattribution, Note
+
+
+@receiver(post_save, sender=Note)
+@receiver(post_delete, sender=Note)
+def note_changed(sender, instance, **kwargs):
+    # Covers visibility changes and deletion:
+    update_cache_on_commit(invalidate_note_card, instance.pk)
+
+
+@receiver(post_save, sender=Note)
+def note_saved_discover_pool(sender, instance, created, **kwargs):
+    if not created and instance.visibility != Note.Visibility.NORMAL:
+        remove_from_discover_pool(instance.pk)
+
+
+@receiver(post_delete, sender=Note)
+def note_deleted_discover_pool(sender, instance, **kwargs):
+    remove_from_discover_pool(instance.pk)
+
+
+@receiver(pre_delete, sender=settings.AUTH_USER_MODEL)
+def user_deleted(sender, instance, **kwargs):
+    # The author of the user's notes is set to null by the deletion, which
+    # sends no signal for the notes:
+    update_cache_on_commit(
+        invalidate_note_card,
+        *Note.objects.filter(author=instance).values_list("pk", flat=True),
+    )
+
+
+@receiver(post_save, sender=Collection)
+@receiver(post_delete, sender=Collection)
+@receiver(post_save, sender=Deattribution)
+@receiver(post_delete, sender=Deattribution)
+def note_relation_changed(sender, instance, **kwargs):
+    # Covers saving/unsaving, and removal/restoration of attribution (the
+    # note's author is changed with a queryset update, which sends no
+    # signal, alongside the creation/deletion of a Deattribution):
+    update_cache_on_commit(invalidate_note_card, instance.note_id)
+
+
+@receiver(m2m_changed, sender=Collection)
+def collection_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Handle `collected_notes.add()` and similar related manager calls."""
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if not reverse:
+        # Called through `note.collectors`; `instance` is the note:
+        update_cache_on_commit(invalidate_note_card, instance.pk)
+    elif action == "pre_clear":
+        update_cache_on_commit(
+            invalidate_note_card, *instance.collected_notes.values_list("pk", flat=True)
+        )
+    else:
+        update_cache_on_commit(invalidate_note_card, *pk_set)
+
+
+@receiver(post_save, sender=Note)
+def note_saved_excluded_ids(sender, instance, created, **kwargs):
+    if created and instance.author_id:
+        update_cache_on_commit(add_excluded_ids, instance.author_id, [instance.pk])
+
+
+@receiver(post_save, sender=Collection)
+def collection_saved_excluded_ids(sender, instance, created, **kwargs):
+    if created:
+        update_cache_on_commit(add_excluded_ids, instance.user_id, [instance.note_id])
+
+
+@receiver(post_delete, sender=Collection)
+def collection_deleted_excluded_ids(sender, instance, **kwargs):
+    update_cache_on_commit(remove_collected_ids, instance.user_id, [instance.note_id])
+
+
+@receiver(post_save, sender=Deattribution)
+@receiver(post_delete, sender=Deattribution)
+def deattribution_changed_excluded_ids(sender, instance, **kwargs):
+    update_cache_on_commit(invalidate_excluded_ids, instance.author_id)
+
+
+@receiver(m2m_changed, sender=Collection)
+def collection_changed_excluded_ids(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if reverse:
+        # Called through `user.collected_notes`; `pk_set` holds notes:
+        if action == "post_add":
+            update_cache_on_commit(add_excluded_ids, instance.pk, pk_set)
+        elif action == "post_remove":
+            update_cache_on_commit(remove_collected_ids, instance.pk, pk_set)
+        elif action == "pre_clear":
+            update_cache_on_commit(invalidate_excluded_ids, instance.pk)
+    else:
+        # Called through `note.collectors`; `pk_set` holds users:
+        if action == "post_add":
+            for user_pk in pk_set:
+                update_cache_on_commit(add_excluded_ids, user_pk, [instance.pk])
+        elif action == "post_remove":
+            for user_pk in pk_set:
+                update_cache_on_commit(remove_collected_ids, user_pk, [instance.pk])
+        elif action == "pre_clear":
+            update_cache_on_commit(
+                invalidate_excluded_ids,
+                *instance.collectors.values_list("pk", flat=True),
+            )
+
+
+@receiver(post_save, sender=Collection)
+def collection_saved_drill_sampler(sender, instance, created, **kwargs):
+    if created:
+        update_cache_on_commit(
+            update_drill_sampler,
+            instance.user_id,
+            DrillSampler.add,
+            instance.note_id,
+            instance.promoted,
+        )
+    else:
+        update_cache_on_commit(
+            update_drill_sampler,
+            instance.user_id,
+            DrillSampler.set_promoted,
+            instance.note_id,
+            instance.promoted,
+        )
+
+
+@receiver(post_delete, sender=Collection)
+def collection_deleted_drill_sampler(sender, instance, **kwargs):
+    update_cache_on_commit(
+        update_drill_sampler, instance.user_id, DrillSampler.remove, instance.note_id
+    )
+
+
+@receiver(m2m_changed, sender=Collection)
+def collection_changed_drill_sampler(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if reverse:
+        # Called through `user.collected_notes`; `pk_set` holds notes:
+        if action == "post_add":
+            for note_pk in pk_set:
+                update_cache_on_commit(
+                    update_drill_sampler, instance.pk, DrillSampler.add, note_pk
+                )
+        elif action == "post_remove":
+            for note_pk in pk_set:
+                update_cache_on_commit(
+                    update_drill_sampler, instance.pk, DrillSampler.remove, note_pk
+                )
+        elif action == "pre_clear":
+            update_cache_on_commit(invalidate_drill_sampler, instance.pk)
+    else:
+        # Called through `note.collectors`; `pk_set` holds users:
+        if action == "post_add":
+            for user_pk in pk_set:
+                update_cache_on_commit(
+                    update_drill_sampler, user_pk, DrillSampler.add, instance.pk
+                )
+        elif action == "post_remove":
+            for user_pk in pk_set:
+                update_cache_on_commit(
+                    update_drill_sampler, user_pk, DrillSampler.remove, instance.pk
+                )
+        elif action == "pre_clear":
+            update_cache_on_commit(
+                invalidate_drill_sampler,
+                *instance.collectors.values_list("pk", flat=True),
+            )
+
+
+@receiver(post_save, sender=Collection)
+def collection_saved_drill_stats(sender, instance, created, **kwargs):
+    if created:
+        update_cache_on_commit(
+            update_drill_stats,
+            instance.user_id,
+            DrillStats.record_added,
+            instance.last_drilled,
+        )
+    else:
+        # The previous last drilled time is unknown:
+        update_cache_on_commit(invalidate_drill_stats, instance.user_id)
+
+
+@receiver(post_delete, sender=Collection)
+def collection_deleted_drill_stats(sender, instance, **kwargs):
+    # Also sent for each item removed through the related managers:
+    update_cache_on_commit(
+        update_drill_stats,
+        instance.user_id,
+        DrillStats.record_removed,
+        instance.last_drilled,
+    )
+
+
+@receiver(m2m_changed, sender=Collection)
+def collection_changed_drill_stats(sender, instance, action, reverse, pk_set, **kwargs):
+    # Items are created in bulk with the default last drilled time:
+    if reverse:
+        # Called through `user.collected_notes`; `pk_set` holds notes:
+        if action == "post_add" and pk_set:
+            update_cache_on_commit(
+                update_drill_stats,
+                instance.pk,
+                DrillStats.record_added,
+                timezone.now(),
+                len(pk_set),
+            )
+        elif action == "pre_clear":
+            update_cache_on_commit(invalidate_drill_stats, instance.pk)
+    else:
+        # Called through `note.collectors`; `pk_set` holds users:
+        if action == "post_add":
+            for user_pk in pk_set:
+                update_cache_on_commit(
+                    update_drill_stats, user_pk, DrillStats.record_added, timezone.now()
+                )
+        elif action == "pre_clear":
+            update_cache_on_commit(
+                invalidate_drill_stats,
+                *instance.collectors.values_list("pk", flat=True),
+            )
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_saved_counters(sender, instance, created, **kwargs):
+    if created:
+        create_counters(instance.pk)
+
+
+@receiver(post_save, sender=Collection)
+def collection_saved_counters(sender, instance, created, **kwargs):
+    if created:
+        increment_counters(Counter.Kind.COLLECTED, [instance.user_id])
+
+
+@receiver(post_delete, sender=Collection)
+def collection_deleted_counters(sender, instance, **kwargs):
+    # Also sent for each item removed through the related managers:
+    increment_counters(Counter.Kind.COLLECTED, [instance.user_id], -1)
+
+
+@receiver(m2m_changed, sender=Collection)
+def collection_changed_counters(sender, instance, action, reverse, pk_set, **kwargs):
+    if action != "post_add" or not pk_set:
+        return
+    if reverse:
+        # Called through `user.collected_notes`; `pk_set` holds notes:
+        increment_counters(Counter.Kind.COLLECTED, [instance.pk], len(pk_set))
+    else:
+        # Called through `note.collectors`; `pk_set` holds users:
+        increment_counters(Counter.Kind.COLLECTED, pk_set)
+
+
+@receiver(post_save, sender=Note)
+def note_saved_counters(sender, instance, created, **kwargs):
+    if not instance.author_id:
+        return
+    if not created:
+        # The visibility might have changed:
+        refresh_counter(Counter.Kind.LISTED, instance.author_id)
+    elif instance.visibility == Note.Visibility.NORMAL:
+        increment_counters(Counter.Kind.LISTED, [instance.author_id])
+
+
+@receiver(post_delete, sender=Note)
+def note_deleted_counters(sender, instance, **kwargs):
+    if instance.author_id and instance.visibility == Note.Visibility.NORMAL:
+        increment_counters(Counter.Kind.LISTED, [instance.author_id], -1)
+
+
+@receiver(post_save, sender=Deattribution)
+def deattribution_saved_counters(sender, instance, created, **kwargs):
+    if created:
+        increment_counters(Counter.Kind.DEATTRIBUTED, [instance.author_id])
+        # The note's author was changed with a queryset update:
+        refresh_counter(Counter.Kind.LISTED, instance.author_id)
+
+
+@receiver(post_delete, sender=Deattribution)
+def deattribution_deleted_counters(sender, instance, **kwargs):
+    increment_counters(Counter.Kind.DEATTRIBUTED, [instance.author_id], -1)
+    # Attribution might have been restored with a queryset update:
+    refresh_counter(Counter.Kind.LISTED, instance.author_id)
+
+
+@receiver(post_save, sender=Collection)
+def collection_saved_collector_count(sender, instance, created, **kwargs):
+    if created:
+        Note.objects.filter(pk=instance.note_id).add_collectors(1)
+
+
+@receiver(post_delete, sender=Collection)
+def collection_deleted_collector_count(sender, instance, **kwargs):
+    # Also sent for each item removed through the related managers:
+    Note.objects.filter(pk=instance.note_id).add_collectors(-1)
+
+
+@receiver(m2m_changed, sender=Collection)
+def collection_changed_collector_count(
+    sender, instance, action, reverse, pk_set, **kwargs
+):
+    if action != "post_add" or not pk_set:
+        return
+    if reverse:
+        # Called through `user.collected_notes`; `pk_set` holds notes:
+        Note.objects.filter(pk__in=pk_set).add_collectors(1)
+    else:
+        # Called through `note.collectors`; `pk_set` holds users:
+        Note.objects.filter(pk=instance.pk).add_collectors(len(pk_set))
@@ -0,0 +1,155 @@
+/*
+ * Offline drill runner. Draws notes locally from a snapshot of the
+ * collection (see `notes.views.DrillSnapshot`), and records drill events in
+ * localStorage until they are synced in batches (see `DrillSync`).
+ */
+(() => {
+    const beginButton = document.getElementById('offlineDrillBegin')
+    if (!beginButton) { return }
+    const root = document.getElementById('offlineDrill')
+    const element = (role) => root.querySelector(`[data-role="${role}"]`)
+    const csrfToken =
+        document.querySelector('[name="csrfmiddlewaretoken"]').value
+    // Per user, so that events recorded by one account are never synced
+    // to another that later signs in on the same browser:
+    const storageKey = `leornianDrillEvents:${beginButton.dataset.userId}`
+    // Keep under `DRILL_SYNC_MAX_EVENTS`:
+    const batchSize = 500
+    const autoSyncThreshold = 50
+    // As shown by the `Drill` view:
+    const insufficientCollectionMessage =
+        'Drill requires your collection to have at least two notes.'
+
+    // Notes as `[code, html, promoted]`, least recently drilled first:
+    let notes = []
+    let current = null
+    let syncing = false
+
+    function pendingEvents() {
+        return JSON.parse(localStorage.getItem(storageKey) || '[]')
+    }
+
+    function updateStatus(message) {
+        const count = pendingEvents().length
+        element('status').textContent = message ||
+            `${count} drill${count == 1 ? '' : 's'} waiting to be synced`
+    }
+
+    function record(event) {
+        const events = pendingEvents()
+        events.push(event)
+        localStorage.setItem(storageKey, JSON.stringify(events))
+        updateStatus()
+        if (events.length >= autoSyncThreshold) { sync() }
+    }
+
+    async function sync(keepalive = false) {
+        if (syncing) { return }
+        syncing = true
+        try {
+            let events = pendingEvents()
+            while (events.length) {
+                const batch = events.slice(0, batchSize)
+                const response = await fetch(beginButton.dataset.syncUrl, {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                        'X-CSRFToken': csrfToken,
+                    },
+                    body: JSON.stringify({events: batch}),
+                    keepalive: keepalive,
+                })
+                if (!response.ok) { throw new Error(response.statusText) }
+                // Events may have been recorded in the meantime:
+                events = pendingEvents().slice(batch.length)
+                localStorage.setItem(storageKey, JSON.stringify(events))
+            }
+            updateStatus()
+        } catch (error) {
+            updateStatus(`Offline: ${pendingEvents().length} drill(s) will be synced later`)
+        } finally {
+            syncing = false
+        }
+    }
+
+    // Same distribution as `notes.drill.DrillSampler.draw()`, and thus
+    // `Drill.generate_weights()`: propose a rank `x` (1 for the second most
+    // recently drilled note, up to `n` for the least recently drilled) with
+    // probability proportional to `x`, then accept it with probability
+    // `(x / n) ** 3` unless the note is promoted.
+    function draw() {
+        const n = notes.length - 1
+        const total = n * (n + 1) / 2
+        while (true) {
+            const u = 1 + Math.floor(Math.random() * total)
+            let x = Math.ceil((Math.sqrt(8 * u + 1) - 1) / 2)
+            while (x * (x + 1) / 2 < u) { x++ }
+            while (x > 1 && (x - 1) * x / 2 >= u) { x-- }
+            const index = n - x
+            if (notes[index][2] || Math.random() * n ** 3 < x ** 3) {
+                return index
+            }
+        }
+    }
+
+    function showNext() {
+        // `draw()` needs a note other than the last drilled one:
+        if (notes.length < 2) {
+            updateStatus(insufficientCollectionMessage)
+            return
+        }
+        // Move the drawn note to the top of the stack:
+        current = notes.splice(draw(), 1)[0]
+        notes.push(current)
+        current.drilledAt = new Date().toISOString()
+        record({code: current[0], drilled_at: current.drilledAt})
+        element('note-html').innerHTML = current[1]
+        element('promoted-badge').classList.toggle('d-none', !current[2])
+        element('toggle-promotion').innerHTML = current[2]
+            ? '<i class="bi-star"></i> Demote and Next'
+            : '<i class="bi-star-fill"></i> Promote and Next'
+    }
+
+    beginButton.addEventListener('click', async () => {
+        beginButton.disabled = true
+        // Apply events left over from earlier sessions first, so that the
+        // snapshot reflects them:
+        await sync()
+        try {
+            const response = await fetch(beginButton.dataset.snapshotUrl)
+            if (!response.ok) { throw new Error(response.statusText) }
+            notes = (await response.json()).notes
+        } catch (error) {
+            beginButton.disabled = false
+            updateStatus('Could not load your collection; please try again.')
+            root.classList.remove('d-none')
+            return
+        }
+        if (notes.length < 2) {
+            // E.g., notes were unsaved since the page was loaded:
+            updateStatus(insufficientCollectionMessage)
+            element('card').classList.add('d-none')
+            element('controls').classList.add('d-none')
+            root.classList.remove('d-none')
+            return
+        }
+        document.getElementById('drillStart').classList.add('d-none')
+        root.classList.remove('d-none')
+        showNext()
+    })
+    element('next').addEventListener('click', showNext)
+    element('toggle-promotion').addEventListener('click', () => {
+        current[2] = !current[2]
+        record({
+            code: current[0],
+            drilled_at: current.drilledAt,
+            promoted: current[2],
+        })
+        showNext()
+    })
+    element('sync').addEventListener('click', () => sync())
+    document.addEventListener('visibilitychange', () => {
+        if (document.visibilityState == 'hidden') { sync(true) }
+    })
+    beginButton.classList.remove('d-none')
+})()
@@ -1,8 +1,24 @@
 from django import template
-from django.urls import reverse
+from django.core.cache import cache
+
+from leornian_helpers.utils import URLTemplate
+from notes.caching import NOTE_CARD_CACHE_TIMEOUT, note_controls_cache_key
 
 register = template.Library()
 
+SAVE_URL = URLTemplate("notes:collection-action", "code", action="save")
+UNSAVE_URL = URLTemplate("notes:collection-action", "code", action="unsave")
+CHANGE_VISIBILITY_URL = URLTemplate("notes:change-vis", "slug")
+DELETE_URL = URLTemplate("notes:delete-note", "slug")
+DEATTRIBUTE_URL = URLTemplate("notes:deattribute", "slug")
+REPORT_URL = URLTemplate("moderation:submit-report", "id", type="note")
+
+
+@register.simple_tag
+def note_card_cache_timeout():
+    """Timeout of the card fragments cached in `notes/includes/note_card.html`."""
+    return NOTE_CARD_CACHE_TIMEOUT
+
 
 @register.inclusion_tag("notes/templatetags/note_controls.html")
 def note_controls(note, request):
@@ -10,85 +26,87 @@ def note_controls(note, request):
     more_controls = []
 
     if request.user.is_authenticated:
-        if not note.saved:
-            # Save note to collection
-            main_controls.append(
-                {
-                    "method": "post",
-                    "action": reverse(
-                        "notes:collection-action",
-                        kwargs={"code": note.code, "action": "save"},
-                    ),
-                    "icon": "plus-circle",
-                    "text": "Save",
-                }
-            )
-        else:
-            # Unsave note from collection
-            main_controls.append(
-                {
-                    "method": "post",
-                    "action": reverse(
-                        "notes:collection-action",
-                        kwargs={"code": note.code, "action": "unsave"},
-                    ),
-                    "icon": "x-circle",
-                    "text": "Unsave",
-                }
-            )
-        if note.author == request.user:
-            # Change visibility
-            more_controls.append(
-                {
-                    "method": "get",
-                    "action": reverse(
-                        "notes:change-vis",
-                        kwargs={"slug": note.code},
-                    ),
-                    "icon": "eye",
-                    "text": "Change Visibility",
-                }
-            )
-            # Delete note
-            more_controls.append(
-                {
-                    "method": "get",
-                    "action": reverse(
-                        "notes:delete-note",
-                        kwargs={"slug": note.code},
-                    ),
-                    "icon": "trash",
-                    "text": "Delete",
-                }
-            )
-            # Remove attribution
-            more_controls.append(
-                {
-                    "method": "get",
-                    "action": reverse(
-                        "notes:deattribute",
-                        kwargs={"slug": note.code},
-                    ),
-                    "icon": "person-dash",
-                    "text": "Remove Attribution",
-                }
-            )
-        else:
-            # Report content
-            more_controls.append(
-                {
-                    "method": "get",
-                    "action": reverse(
-                        "moderation:submit-report",
-                        kwargs={"type": "note", "id": note.code},
-                    ),
-                    "icon": "flag",
-                    "text": "Report Content",
-                }
-            )
+        is_author = note.author_id == request.user.pk
+        key = note_controls_cache_key(note.pk, note.saved, is_author)
+        if (controls := cache.get(key)) is None:
+            controls = build_note_controls(note, is_author)
+            cache.set(key, controls, NOTE_CARD_CACHE_TIMEOUT)
+        main_controls, more_controls = controls
 
     return {
         "main_controls": main_controls,
         "more_controls": more_controls,
         "request": request,
     }
+
+
+def build_note_controls(note, is_author):
+    """
+    Build the lists of main and "more" controls for an authenticated user.
+
+    The output only depends on the note, its saved status, and whether the
+    user is the author, so it can be cached accordingly.
+    """
+    main_controls = []
+    more_controls = []
+
+    if not note.saved:
+        # Save note to collection
+        main_controls.append(
+            {
+                "method": "post",
+                "action": SAVE_URL.format(code=note.code),
+                "icon": "plus-circle",
+                "text": "Save",
+            }
+        )
+    else:
+        # Unsave note from collection
+        main_controls.append(
+            {
+                "method": "post",
+                "action": UNSAVE_URL.format(code=note.code),
+                "icon": "x-circle",
+                "text": "Unsave",
+            }
+        )
+    if is_author:
+        # Change visibility
+        more_controls.append(
+            {
+                "method": "get",
+                "action": CHANGE_VISIBILITY_URL.format(slug=note.code),
+                "icon": "eye",
+                "text": "Change Visibility",
+            }
+        )
+        # Delete note
+        more_controls.append(
+            {
+                "method": "get",
+                "action": DELETE_URL.format(slug=note.code),
+                "icon": "trash",
+                "text": "Delete",
+            }
+        )
+        # Remove attribution
+        more_controls.append(
+            {
+                "method": "get",
+                "action": DEATTRIBUTE_URL.format(slug=note.code),
+                "icon": "person-dash",
+                "text": "Remove Attribution",
+            }
+        )
+    else:
+        # Report content
+        more_controls.append(
+            {
+                "method": "get",
+                "action": REPORT_URL.format(id=note.code),
+                "icon": "flag",
+                "text": "Report Content",
+            }
+        )
+
+    return main_controls, more_controls
@@ -1,5 +1,7 @@
 import formtools
+import json
 import time
+from unittest.mock import patch
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from django.core.exceptions import ImproperlyConfigured
@@ -7,7 +9,6 @@ from django.http import Http404
 from django.test import RequestFactory, TestCase
 from django.urls import reverse
 from django.utils import timezone
-from django.views.generic import ListView
 
 from . import views
 from .models import Collection, Deattribution, Note
@@ -20,23 +21,6 @@ class ViewsTests(TestCase):
         self.factory = RequestFactory()
         self.user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
 
-    def test_GracefulListView(self):
-        Note.objects.create(text="Foo")
-        req = self.factory.get("/test/", {"page": 2})
-        req.user = AnonymousUser()
-
-        # Test default ListView behavior:
-        with self.assertRaises(Http404):
-            ListView.as_view(model=Note, paginate_by=10)(req)
-        # GracefulListView, meanwhile, should not 404:
-        res = views.GracefulListView.as_view(model=Note, paginate_by=10)(req)
-        self.assertEqual(res.status_code, 200)
-        # Negative page numbers should still 404:
-        req = RequestFactory().get("/test/", {"page": -1})
-        req.user = AnonymousUser()
-        with self.assertRaises(Http404):
-            res = views.GracefulListView.as_view(model=Note, paginate_by=10)(req)
-
     def test_create_note_view(self):
         self.client.login(username="juan", password="1234")
 
@@ -99,7 +83,8 @@ class ViewsTests(TestCase):
         for _ in range(3):
             # Create multiple objects for testing for N+1 queries:
             Note.objects.create(author=self.user)
-        with self.assertNumQueries(4):  # test for N+1 queries
+        # Author (once), count and page:
+        with self.assertNumQueries(3):  # test for N+1 queries
             res = self.client.get(
                 reverse(
                     "notes:notes-by-username", kwargs={"username": self.user.username}
@@ -108,6 +93,17 @@ class ViewsTests(TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTemplateUsed(res, "notes/note_list.html")
 
+        # Saved state is looked up once for the page:
+        self.user.collected_notes.add(note)
+        self.client.login(username="juan", password="1234")
+        with self.assertNumQueries(6):
+            res = self.client.get(
+                reverse(
+                    "notes:notes-by-username", kwargs={"username": self.user.username}
+                )
+            )
+        self.assertContains(res, "/unsave/", count=1)
+
     def test_MyCollection_view(self):
         req = self.factory.get("/test/")
         req.user = self.user
@@ -126,6 +122,37 @@ class ViewsTests(TestCase):
             res = self.client.get(reverse("notes:my-collection"))
         self.assertEqual(res.status_code, 200)
 
+    def test_MyCollection_view_cursor_pagination(self):
+        for _ in range(80):
+            self.user.collected_notes.create(author=self.user)
+        self.client.login(username="juan", password="1234")
+        res = self.client.get(reverse("notes:my-collection"), {"page": 5})
+        self.assertContains(res, "Page 5 of 8")
+        seen = list(res.context["page_obj"])
+        # Later pages are linked with cursors, and take as many queries:
+        query = res.context["page_obj"].next_page_query()
+        self.assertTrue(query.startswith("cursor="))
+        while query:
+            with self.assertNumQueries(4):
+                res = self.client.get(f"{reverse('notes:my-collection')}?{query}")
+            page = res.context["page_obj"]
+            seen.extend(page)
+            query = page.has_next() and page.next_page_query()
+        self.assertEqual(page.number, 8)
+        self.assertContains(res, f'href="?{page.previous_page_query()}"')
+        self.assertEqual(
+            seen, list(self.user.collected_notes.order_by("-created", "-pk")[40:])
+        )
+
+        res = self.client.get(reverse("notes:my-collection"), {"cursor": "foo"})
+        self.assertEqual(res.status_code, 404)
+        res = self.client.get(reverse("notes:my-collection"), {"page": 100})
+        self.assertEqual(res.context["page_obj"].number, 8)
+        res = self.client.get(
+            reverse("notes:my-collection"), {"page": "99999999999999999999999"}
+        )
+        self.assertEqual(res.context["page_obj"].number, 8)
+
     def test_MyCollection_view_template(self):
         """
         Test the MyCollection template, which uses request.resolver_match,
@@ -151,10 +178,21 @@ class ViewsTests(TestCase):
         for _ in range(3):
             self.user.collected_notes.create(author=self.user)
         self.client.login(username="juan", password="1234")
+        # Without a counter, short lists are counted exactly:
         with self.assertNumQueries(4):
             res = self.client.get(reverse("notes:my-collection-by-me"))
         self.assertEqual(res.status_code, 200)
 
+    def test_MyCollection_view_estimated_count(self):
+        self.user.collected_notes.create(author=self.user)
+        self.client.login(username="juan", password="1234")
+        res = self.client.get(reverse("notes:my-collection"))
+        self.assertFalse(res.context["paginator"].count_is_estimate)
+        with patch("notes.counters.EXACT_COUNT_THRESHOLD", 0):
+            res = self.client.get(reverse("notes:my-collection-by-me"))
+        self.assertTrue(res.context["paginator"].count_is_estimate)
+        self.assertContains(res, "About ")
+
     def test_NotInCollectionByMe_view(self):
         req = self.factory.get("/test/")
         req.user = self.user
@@ -164,11 +202,19 @@ class ViewsTests(TestCase):
         Note.objects.create(author=self.user)
         self.user.collected_notes.create(author=self.user)
         self.assertEqual(len(view.get_queryset()), 1)
+        # None of the notes are saved, which needs no subquery:
+        self.assertIn('False AS "saved"', str(view.get_queryset().query))
+        self.assertEqual([note.saved for note in view.get_queryset()], [False])
+        view = views.MyCollection()
+        view.setup(req)
+        self.assertIn('True AS "saved"', str(view.get_queryset().query))
+        self.assertEqual([note.saved for note in view.get_queryset()], [True])
 
         # Test for N+1 queries:
         for _ in range(3):
             Note.objects.create(author=self.user)
         self.client.login(username="juan", password="1234")
+        # Without a counter, short lists are counted exactly:
         with self.assertNumQueries(4):
             res = self.client.get(reverse("notes:not-in-collection-by-me"))
         self.assertEqual(res.status_code, 200)
@@ -188,6 +234,7 @@ class ViewsTests(TestCase):
         for _ in range(3):
             self.user.collected_notes.create(author=user2)
         self.client.login(username="juan", password="1234")
+        # Without a counter, short lists are counted exactly:
         with self.assertNumQueries(4):
             res = self.client.get(reverse("notes:my-collection-by-others"))
         self.assertEqual(res.status_code, 200)
@@ -209,6 +256,7 @@ class ViewsTests(TestCase):
             note = self.user.collected_notes.create(author=self.user)
             Collection.objects.filter(user=self.user, note=note).update(promoted=True)
         self.client.login(username="juan", password="1234")
+        # Without a counter, short lists are counted exactly:
         with self.assertNumQueries(4):
             res = self.client.get(reverse("notes:my-collection-promoted"))
         self.assertEqual(res.status_code, 200)
@@ -261,8 +309,15 @@ class ViewsTests(TestCase):
     def test_ChangeNoteVisibility_get_queryset(self):
         note = Note.objects.create(author=self.user)
         self.client.login(username="juan", password="1234")
-        with self.assertNumQueries(4):
+        # Session, user, and note (once for the view and the blocker):
+        with self.assertNumQueries(3):
             self.client.get(reverse("notes:change-vis", kwargs={"slug": note.code}))
+        # Session, user, note, and the update in a transaction:
+        with self.assertNumQueries(6):
+            self.client.post(
+                reverse("notes:change-vis", kwargs={"slug": note.code}),
+                {"visibility": Note.Visibility.UNLISTED},
+            )
 
     def test_ChangeNoteVisibility_blocker(self):
         note = Note.objects.create()
@@ -272,10 +327,14 @@ class ViewsTests(TestCase):
         view.setup(req, slug=note.code)
         self.assertEqual(view.blocker(), "not-author")
 
+        # The note is fetched once per request:
         Note.objects.filter(pk=note.pk).update(author=self.user, visibility_locked=True)
+        self.assertEqual(view.blocker(), "not-author")
+        view.setup(req, slug=note.code)
         self.assertEqual(view.blocker(), "visibility-locked")
 
         Note.objects.filter(pk=note.pk).update(visibility_locked=False)
+        view.setup(req, slug=note.code)
         self.assertEqual(view.blocker(), None)
 
     def test_ChangeNoteVisibility_post(self):
@@ -334,7 +393,9 @@ class ViewsTests(TestCase):
     def test_DeleteNote_get_queryset(self):
         note = Note.objects.create(author=self.user)
         self.client.login(username="juan", password="1234")
-        with self.assertNumQueries(5):
+        # Session, user, note, and its saved status; the blocker reads the
+        # fetched note:
+        with self.assertNumQueries(4):
             self.client.get(reverse("notes:delete-note", kwargs={"slug": note.code}))
 
     def test_DeleteNote_blocker(self):
@@ -348,9 +409,14 @@ class ViewsTests(TestCase):
         Note.objects.filter(pk=note.pk).update(author=self.user)
         user2 = UserModel.objects.create_user("user2", "user2@example.com", "1234")
         user2.collected_notes.add(note)
-        self.assertEqual(view.blocker(), "other-collectors")
+        view.setup(req, slug=note.code)
+        # The note, and its saved status:
+        with self.assertNumQueries(2):
+            self.assertEqual(view.blocker(), "other-collectors")
+            self.assertEqual(view.blocker(), "other-collectors")
 
         user2.collected_notes.remove(note)
+        view.setup(req, slug=note.code)
         self.assertEqual(view.blocker(), None)
 
     def test_DeleteNote_get_context_data(self):
@@ -549,6 +615,16 @@ class ViewsTests(TestCase):
         self.assertEqual(res.status_code, 302)
         self.assertEqual(res.url, note.get_absolute_url())
         self.assertEqual(self.user.collected_notes.all()[0].id, note.id)
+        # Saving twice (e.g., a double-click) is harmless. Session, user, and
+        # the save statement:
+        with self.assertNumQueries(3):
+            res = self.client.post(
+                reverse(
+                    "notes:collection-action",
+                    kwargs={"code": note.code, "action": "save"},
+                )
+            )
+        self.assertEqual(self.user.collected_notes.count(), 1)
         res = self.client.get(res.url)
         self.assertContains(res, "Note saved to collection")
         self.assertContains(
@@ -646,17 +722,21 @@ class ViewsTests(TestCase):
         self.assertEqual(res.context["disable_begin"], True)
         self.assertEqual(res.context["recent_drill_count"], 0)
 
-        self.user.collected_notes.create()  # first collection record
-        note = Note.objects.create()
-        Collection.objects.create(
-            user=self.user,
-            note=note,
-            last_drilled=timezone.now() - timezone.timedelta(hours=25),
-        )  # second collection record
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.collected_notes.create()  # first collection record
+            note = Note.objects.create()
+            Collection.objects.create(
+                user=self.user,
+                note=note,
+                last_drilled=timezone.now() - timezone.timedelta(hours=25),
+            )  # second collection record
         res = self.client.get(reverse("notes:drill"))
         self.assertEqual(res.status_code, 200)
         self.assertEqual(res.context["disable_begin"], False)
         self.assertEqual(res.context["recent_drill_count"], 1)
+        # Session, user, and due count; the drill statistics are cached:
+        with self.assertNumQueries(3):
+            self.client.get(reverse("notes:drill"))
 
     def test_Drill_generate_weights(self):
         self.assertEqual(views.Drill.generate_weights([]), [])
@@ -747,6 +827,268 @@ class ViewsTests(TestCase):
         self.assertGreater(note_old_post_last_drilled, note_old_pre_last_drilled)
         self.assertEqual(note_new_post_last_drilled, note_new_pre_last_drilled)
 
+    def test_Drill_draw_num_queries(self):
+        self.client.login(username="juan", password="1234")
+        notes = [Note.objects.create(author=self.user) for _ in range(3)]
+        for note in notes:
+            self.user.collected_notes.add(note)
+        self.client.post(reverse("notes:drill"))  # builds the sampler and stats
+        # Session, user, drill stamp (with the promoted flag and the previous
+        # last drilled time), and note with author:
+        with self.assertNumQueries(4):
+            res = self.client.post(reverse("notes:drill"))
+        self.assertEqual(res.context["recent_drill_count"], 3)
+        # Promotion takes a single query:
+        with self.assertNumQueries(5):
+            res = self.client.post(reverse("notes:drill"), {"promote": notes[0].code})
+        self.assertContains(res, "A note has been promoted")
+        self.assertEqual(res.context["promoted"], res.context["note"] == notes[0])
+
+    def test_DrillDue(self):
+        self.client.login(username="juan", password="1234")
+        notes = [self.user.collected_notes.create() for _ in range(3)]
+        now = timezone.now()
+        Collection.objects.filter(note=notes[0]).update(
+            due_at=now - timezone.timedelta(days=2)
+        )
+        Collection.objects.filter(note=notes[1]).update(
+            due_at=now - timezone.timedelta(days=1), promoted=True
+        )
+        Collection.objects.filter(note=notes[2]).update(
+            due_at=now + timezone.timedelta(days=1)
+        )
+        res = self.client.get(reverse("notes:drill"))
+        self.assertEqual(res.context["due_count"], 2)
+        self.assertContains(res, "Review Due Notes (2)")
+
+        # Session, user, due count, and most overdue note with author:
+        with self.assertNumQueries(4):
+            res = self.client.post(reverse("notes:drill-due"))
+        self.assertEqual(res.context["note"], notes[0])
+        self.assertEqual(res.context["due_count"], 2)
+        self.assertContains(res, "Promote and Good")
+
+        res = self.client.post(
+            reverse("notes:drill-due"), {"review": notes[0].code, "result": "good"}
+        )
+        self.assertEqual(res.context["note"], notes[1])
+        self.assertEqual(res.context["promoted"], True)
+        self.assertEqual(res.context["due_count"], 1)
+        item = Collection.objects.get(note=notes[0])
+        self.assertEqual(item.interval, timezone.timedelta(days=1))
+        self.assertGreater(item.due_at, now + timezone.timedelta(hours=23))
+        self.assertGreater(item.last_drilled, now)
+
+        res = self.client.post(
+            reverse("notes:drill-due"),
+            {"review": notes[1].code, "result": "good", "demote": notes[1].code},
+        )
+        self.assertContains(res, "No notes in your collection are due")
+        self.assertIn("next_due_at", res.context)
+        item = Collection.objects.get(note=notes[1])
+        self.assertFalse(item.promoted)
+        self.assertEqual(item.interval, timezone.timedelta(days=1))
+
+    def test_DrillDue_count_capped(self):
+        self.client.login(username="juan", password="1234")
+        for _ in range(3):
+            self.user.collected_notes.create()
+        with patch("notes.drill.REVIEW_DUE_COUNT_LIMIT", 2):
+            res = self.client.get(reverse("notes:drill"))
+            self.assertEqual(res.context["due_count"], 2)
+            self.assertContains(res, "Review Due Notes (2+)")
+            res = self.client.post(reverse("notes:drill-due"))
+            self.assertContains(res, "2+ notes in your collection due for review")
+            Collection.objects.filter(note=res.context["note"]).delete()
+            res = self.client.get(reverse("notes:drill"))
+            self.assertContains(res, "Review Due Notes (2)")
+
+    def test_DrillDue_invalid(self):
+        self.client.login(username="juan", password="1234")
+        note = self.user.collected_notes.create()
+        res = self.client.post(
+            reverse("notes:drill-due"), {"review": note.code, "result": "easy"}
+        )
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.client.get(reverse("notes:drill-due")).status_code, 405)
+
+    def test_Drill_page_offline_mode(self):
+        self.client.login(username="juan", password="1234")
+        self.user.collected_notes.create()
+        self.user.collected_notes.create()
+        res = self.client.get(reverse("notes:drill"))
+        self.assertContains(res, "offline-drill.js")
+        self.assertContains(res, reverse("notes:drill-snapshot"))
+        # Pending events are stored per user:
+        self.assertContains(res, f'data-user-id="{self.user.pk}"')
+        # Hidden by the script if the snapshot has too few notes:
+        self.assertContains(res, 'data-role="card"')
+        self.assertContains(res, 'data-role="controls"')
+
+    def test_DrillSnapshot(self):
+        res = self.client.get(reverse("notes:drill-snapshot"))
+        self.assertEqual(res.status_code, 302)
+        self.client.login(username="juan", password="1234")
+        note_old = self.user.collected_notes.create(text="*Old*")
+        note_new = self.user.collected_notes.create(text="New")
+        Collection.objects.filter(note=note_old).update(
+            promoted=True, last_drilled=timezone.now() - timezone.timedelta(days=1)
+        )
+        # Not yet backfilled:
+        Note.objects.filter(pk=note_new.pk).update(html_renderer_version=0)
+        with self.assertNumQueries(3):
+            res = self.client.get(reverse("notes:drill-snapshot"))
+        self.assertEqual(
+            res.json(),
+            {
+                "notes": [
+                    [note_old.code, "<p><em>Old</em></p>\n", True],
+                    [note_new.code, "<p>New</p>\n", False],
+                ]
+            },
+        )
+
+    def post_drill_events(self, events):
+        return self.client.post(
+            reverse("notes:drill-sync"),
+            json.dumps({"events": events}),
+            content_type="application/json",
+        )
+
+    def test_DrillSync(self):
+        self.client.login(username="juan", password="1234")
+        notes = [self.user.collected_notes.create() for _ in range(3)]
+        other = Note.objects.create()
+        before = timezone.now() - timezone.timedelta(hours=1)
+        Collection.objects.update(last_drilled=before)
+        Collection.objects.filter(note=notes[2]).update(
+            last_drilled=timezone.now() + timezone.timedelta(hours=1)
+        )
+        drilled_at = timezone.now() - timezone.timedelta(minutes=5)
+        events = [
+            {"code": notes[0].code, "drilled_at": before.isoformat()},
+            {"code": notes[0].code, "drilled_at": drilled_at.isoformat()},
+            {
+                "code": notes[1].code,
+                "drilled_at": drilled_at.isoformat(),
+                "promoted": True,
+            },
+            {"code": notes[2].code, "drilled_at": drilled_at.isoformat()},
+            {"code": other.code, "drilled_at": drilled_at.isoformat()},
+        ]
+        # Session, user, savepoint, locking select, two bulk updates, and
+        # savepoint release:
+        with self.assertNumQueries(7):
+            res = self.post_drill_events(events)
+        self.assertEqual(res.json(), {"synced": 5, "unknown": [other.code]})
+        collections = {
+            item.note_id: item for item in Collection.objects.filter(user=self.user)
+        }
+        self.assertEqual(collections[notes[0].pk].last_drilled, drilled_at)
+        self.assertEqual(collections[notes[1].pk].last_drilled, drilled_at)
+        self.assertTrue(collections[notes[1].pk].promoted)
+        self.assertFalse(collections[notes[0].pk].promoted)
+        # Only moves forward:
+        self.assertGreater(collections[notes[2].pk].last_drilled, drilled_at)
+
+    def test_DrillSync_invalid(self):
+        self.client.login(username="juan", password="1234")
+        note = self.user.collected_notes.create()
+        drilled_at = timezone.now().isoformat()
+        for events in [
+            "foo",
+            [{"code": note.code}],
+            [{"code": note.code, "drilled_at": "yesterday"}],
+            [{"code": note.code, "drilled_at": "2024-01-01T00:00:00"}],
+            [{"code": note.code, "drilled_at": drilled_at, "promoted": "yes"}],
+            [{"code": 1, "drilled_at": drilled_at}],
+            [{"code": note.code, "drilled_at": drilled_at}] * 1001,
+        ]:
+            self.assertEqual(self.post_drill_events(events).status_code, 400)
+        res = self.client.post(
+            reverse("notes:drill-sync"), "{", content_type="application/json"
+        )
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(self.client.get(reverse("notes:drill-sync")).status_code, 405)
+
+    def post_collection_action(self, data):
+        return self.client.post(
+            reverse("notes:collection-bulk-action"),
+            json.dumps(data),
+            content_type="application/json",
+        )
+
+    def test_CollectionBulkAction(self):
+        self.client.login(username="juan", password="1234")
+        saved = self.user.collected_notes.create()
+        notes = [Note.objects.create() for _ in range(3)]
+        codes = [saved.code] + [note.code for note in notes] + ["FOOBAR"]
+
+        # Session, user, savepoint, the statement, counter update, and
+        # savepoint release:
+        with self.assertNumQueries(6):
+            res = self.post_collection_action({"action": "save", "codes": codes})
+        self.assertEqual(
+            res.json(),
+            {
+                "action": "save",
+                "results": {
+                    saved.code: "unchanged",
+                    **{note.code: "saved" for note in notes},
+                    "FOOBAR": "not-found",
+                },
+            },
+        )
+        self.assertEqual(self.user.collected_notes.count(), 4)
+
+        codes = [notes[0].code, notes[1].code]
+        res = self.post_collection_action({"action": "unsave", "codes": codes})
+        self.assertEqual(
+            res.json()["results"], {notes[0].code: "unsaved", notes[1].code: "unsaved"}
+        )
+        self.assertEqual(self.user.collected_notes.count(), 2)
+
+        # Promotion is limited to the user's collection:
+        codes = [saved.code, notes[0].code]
+        res = self.post_collection_action({"action": "promote", "codes": codes})
+        self.assertEqual(
+            res.json()["results"],
+            {saved.code: "promoted", notes[0].code: "not-in-collection"},
+        )
+        res = self.post_collection_action({"action": "promote", "codes": codes[:1]})
+        self.assertEqual(res.json()["results"], {saved.code: "unchanged"})
+        self.assertEqual(
+            list(
+                Collection.objects.filter(user=self.user, promoted=True).values_list(
+                    "note", flat=True
+                )
+            ),
+            [saved.pk],
+        )
+        res = self.post_collection_action({"action": "demote", "codes": codes[:1]})
+        self.assertEqual(res.json()["results"], {saved.code: "demoted"})
+        self.assertFalse(Collection.objects.filter(promoted=True).exists())
+
+    def test_CollectionBulkAction_invalid(self):
+        self.client.login(username="juan", password="1234")
+        note = Note.objects.create()
+        for data in [
+            "foo",
+            [note.code],
+            {"codes": [note.code]},
+            {"action": "delete", "codes": [note.code]},
+            {"action": "save", "codes": note.code},
+            {"action": "save", "codes": [1]},
+            {"action": "save", "codes": [note.code] * 1001},
+        ]:
+            self.assertEqual(self.post_collection_action(data).status_code, 400)
+        self.assertEqual(note.collectors.count(), 0)
+        url = reverse("notes:collection-bulk-action")
+        self.assertEqual(self.client.get(url).status_code, 405)
+        self.client.logout()
+        res = self.post_collection_action({"action": "save", "codes": [note.code]})
+        self.assertEqual(res.status_code, 302)
+
     def test_Start_view(self):
         req = self.factory.get("/test/")
         res = views.Start.as_view()(req)
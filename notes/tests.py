@@ -1,17 +1,60 @@
+import collections
+import json
+import pickle
+import random
+from contextlib import contextmanager
 from io import StringIO
+from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
 from django.core.management import call_command
 from django.core.management.base import CommandError
-from django.db import IntegrityError
+from django.core.paginator import EmptyPage
+from django.db import IntegrityError, connection, transaction
 from django.template import Context, Template
 from django.template.loader import render_to_string
 from django.test import RequestFactory, TestCase, override_settings
 from django.urls import reverse, resolve, Resolver404
 from django.utils import timezone
 
-from .models import Collection, Deattribution, Note
+from .benchmarks import chi_squared_test
+from .caching import note_controls_cache_key
+from .collecting import apply_collection_action, save_notes, unsave_notes
+from .counters import exact_counts, get_count
+from .discover import (
+    DISCOVER_POOL_CACHE_KEY,
+    DISCOVER_POOL_LOCK_CACHE_KEY,
+    get_pooled_note,
+    refresh_discover_pool,
+)
+from .drill import (
+    DRILL_QUEUE_SIZE,
+    REVIEW_AGAIN_DELAY,
+    REVIEW_MIN_EASE,
+    DrillSampler,
+    drill_queue_cache_key,
+    get_drill_sampler,
+    pop_drill_card,
+    review_note,
+    save_drill_sampler,
+    schedule_review,
+)
+from .drill_stats import DrillStats, build_drill_stats, get_drill_stats, hour_of
+from .exclusions import NoteIdSet, build_excluded_ids, get_excluded_ids
+from .models import Collection, Counter, Deattribution, Note, NoteCard
+from .pagination import (
+    AFTER,
+    BEFORE,
+    PAGE_NUMBER_LIMIT,
+    CursorPaginator,
+    InvalidCursor,
+    decode_cursor,
+    encode_cursor,
+)
+from .views import Drill, MyCollectionPromoted, NotesByAuthor
 from .utils import generate_lorem_ipsum, generate_reference_code
 
 UserModel = get_user_model()
@@ -222,6 +265,79 @@ class ModelsTests(TestCase):
         qs = Note.objects.annotate_for_controls(user)
         self.assertTrue(qs[0].saved)
 
+    def test_notequeryset_with_saved(self):
+        user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+        saved, unsaved, authored = [Note.objects.create() for _ in range(3)]
+        Note.objects.filter(pk=authored.pk).update(author=user)
+        user.collected_notes.add(saved)
+
+        qs = Note.objects.with_saved(AnonymousUser())
+        with self.assertRaises(AttributeError):
+            qs[0].saved
+
+        # One query for the notes and one for their saved state:
+        with self.assertNumQueries(2):
+            notes = {note.pk: note.saved for note in Note.objects.with_saved(user)}
+        self.assertEqual(notes, {saved.pk: True, unsaved.pk: False, authored.pk: False})
+        with self.assertNumQueries(2):
+            self.assertTrue(Note.objects.with_saved(user).get(pk=saved.pk).saved)
+        # Survives cloning, but not other iterables:
+        qs = Note.objects.with_saved(user).filter(pk=unsaved.pk).order_by("pk")
+        self.assertFalse(qs[0].saved)
+        self.assertEqual(list(qs.values_list("pk", flat=True)), [unsaved.pk])
+
+        # Cached sets of collected notes may be stale (e.g., when updated by
+        # another process), and aren't used:
+        get_excluded_ids(user.pk)
+        Collection.objects.bulk_create([Collection(user=user, note=unsaved)])
+        self.assertNotIn(unsaved.pk, get_excluded_ids(user.pk))
+        self.assertTrue(Note.objects.with_saved(user).get(pk=unsaved.pk).saved)
+        cache.clear()
+
+    def test_notequeryset_cards(self):
+        user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+        note = Note.objects.create(author=user, text="*Hi*")
+        anonymous = Note.objects.create(visibility=Note.Visibility.UNLISTED)
+        user.collected_notes.add(note)
+
+        with self.assertNumQueries(1):
+            cards = list(Note.objects.order_by("pk").cards())
+        card, anonymous_card = cards
+        self.assertIsInstance(card, NoteCard)
+        self.assertEqual(cards, [note, anonymous])
+        self.assertEqual((card.pk, card.code), (note.pk, note.code))
+        self.assertEqual(card.html, note.html)
+        self.assertEqual(card.get_absolute_url(), note.get_absolute_url())
+        self.assertEqual(card.author_id, user.pk)
+        self.assertEqual(card.author.username, "juan")
+        self.assertIsNone(anonymous_card.author)
+        self.assertIsNone(anonymous_card.author_id)
+        self.assertEqual(anonymous_card.get_visibility_display(), "Unlisted")
+        with self.assertRaises(AttributeError):
+            card.saved
+
+        # Saved state, either annotated or resolved after fetching:
+        card = Note.objects.annotate_for_controls(user).cards().get(pk=note.pk)
+        self.assertTrue(card.saved)
+        with self.assertNumQueries(2):
+            cards = list(Note.objects.with_saved(user).order_by("pk").cards())
+        self.assertEqual([card.saved for card in cards], [True, False])
+
+        # Cards render like notes:
+        request = RequestFactory().get("/")
+        request.user = user
+
+        def render(obj):
+            cache.clear()
+            return render_to_string(
+                "notes/includes/note_card.html", {"object": obj, "request": request}
+            )
+
+        card = Note.objects.cards().get(pk=note.pk)
+        note.saved = card.saved = True
+        self.assertEqual(render(card), render(note))
+        cache.clear()
+
     def test_notequeryset_get_random(self):
         """
         Test get_random()
@@ -254,6 +370,101 @@ class ModelsTests(TestCase):
         self.assertEqual(Note.objects.get_random().id, note.id)
         note.delete()
 
+    def test_notequeryset_get_random_is_uniform(self):
+        notes = [Note.objects.create() for _ in range(5)]
+        Note.objects.create(visibility=Note.Visibility.UNLISTED)
+        counts = {note.pk: 0 for note in notes}
+        for _ in range(1000):
+            counts[Note.objects.get_random().pk] += 1
+        # Expected count is 200 each; the bounds are several SDs away:
+        for count in counts.values():
+            self.assertGreater(count, 120)
+            self.assertLess(count, 280)
+
+    @patch("notes.models.note.RANDOM_PROBE_MIN_SIZE", 2)
+    @patch("notes.models.note.RANDOM_PROBE_OVERSAMPLING", 1)
+    def test_notequeryset_get_random_many(self):
+        user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+        listed = [Note.objects.create() for _ in range(10)]
+        for _ in range(30):
+            Note.objects.create(visibility=Note.Visibility.UNLISTED)
+        collected = listed[:3]
+        for note in collected:
+            user.collected_notes.add(note)
+        authored = Note.objects.create(author=user)
+
+        self.assertEqual(Note.objects.get_random_many(0), [])
+        for _ in range(20):
+            notes = Note.objects.get_random_many(5)
+            self.assertEqual(len(notes), 5)
+            self.assertEqual(len({note.pk for note in notes}), 5)
+            for note in notes:
+                self.assertEqual(note.visibility, Note.Visibility.NORMAL)
+
+            # With sparse eligible notes, probing falls back to scanning:
+            notes = Note.objects.get_random_many(10, for_user=user)
+            self.assertCountEqual(notes, listed[3:])
+            self.assertNotIn(authored, notes)
+
+    def test_notequeryset_get_random_many_exclude_ids(self):
+        notes = [Note.objects.create() for _ in range(40)]
+        exclude_ids = {note.pk for note in notes[:30]}
+        for _ in range(10):
+            found = Note.objects.get_random_many(5, exclude_ids=exclude_ids)
+            self.assertEqual(len(found), 5)
+            self.assertTrue(exclude_ids.isdisjoint(note.pk for note in found))
+        # Scanning fallback:
+        with patch("notes.models.note.RANDOM_PROBE_ATTEMPTS", 0):
+            found = Note.objects.get_random_many(
+                20, pks_only=True, exclude_ids=exclude_ids
+            )
+        self.assertCountEqual(found, [note.pk for note in notes[30:]])
+
+    def test_notequeryset_get_random_many_probe_queries(self):
+        for _ in range(40):
+            Note.objects.create()
+        # One query for the key range, one for the probe:
+        with self.assertNumQueries(2):
+            notes = Note.objects.get_random_many(3)
+        self.assertEqual(len(notes), 3)
+
+    def test_notequeryset_popular(self):
+        users = [
+            UserModel.objects.create_user(f"user{i}", f"user{i}@example.com", "1234")
+            for i in range(3)
+        ]
+        notes = [Note.objects.create() for _ in range(3)]
+        notes[0].collectors.add(users[0])
+        notes[1].collectors.add(*users)
+        notes[2].collectors.add(*users[:2])
+        unlisted = Note.objects.create(visibility=Note.Visibility.UNLISTED)
+        unlisted.collectors.add(*users)
+        self.assertEqual(list(Note.objects.popular()), [notes[1], notes[2], notes[0]])
+
+    def test_note_collector_count(self):
+        def collector_counts():
+            return [note.collector_count for note in Note.objects.order_by("pk")]
+
+        users = [
+            UserModel.objects.create_user(f"user{i}", f"user{i}@example.com", "1234")
+            for i in range(3)
+        ]
+        notes = [Note.objects.create() for _ in range(3)]
+        users[0].collected_notes.add(*notes)
+        notes[0].collectors.add(users[1], users[2])
+        Collection.objects.create(user=users[1], note=notes[1])
+        self.assertEqual(collector_counts(), [3, 2, 1])
+        users[0].collected_notes.remove(notes[1])
+        Collection.objects.filter(note=notes[2]).delete()
+        self.assertEqual(collector_counts(), [3, 1, 0])
+        users[1].delete()
+        notes[0].collectors.clear()
+        self.assertEqual(collector_counts(), [0, 0, 0])
+
+    def test_notequeryset_get_random_many_empty(self):
+        self.assertEqual(Note.objects.get_random_many(3), [])
+        self.assertIsNone(Note.objects.get_random())
+
     def test_note_author_on_delete(self):
         user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
         note = Note.objects.create(author=user)
@@ -314,6 +525,21 @@ class ModelsTests(TestCase):
             html,
         )
 
+    def test_note_html_stored_on_save(self):
+        note = Note.objects.create(text="Foo *bar*.")
+        note = Note.objects.get(pk=note.pk)
+        self.assertEqual(note.html_rendered, "<p>Foo <em>bar</em>.</p>\n")
+        self.assertEqual(note.html_renderer_version, Note.HTML_RENDERER_VERSION)
+        self.assertEqual(note.html, note.html_rendered)
+
+    def test_note_html_stale_renderer_version(self):
+        note = Note.objects.create(text="Foo *bar*.")
+        Note.objects.filter(pk=note.pk).update(
+            html_rendered="stale", html_renderer_version=0
+        )
+        note = Note.objects.get(pk=note.pk)
+        self.assertEqual(note.html, "<p>Foo <em>bar</em>.</p>\n")
+
     def test_note_default_ordering(self):
         Note.objects.create(text="first")
         Note.objects.create(text="second")
@@ -372,6 +598,217 @@ class ModelsTests(TestCase):
             Deattribution.objects.create(note=note, author=u2)
 
 
+class QueryPlanTests(TestCase):
+    """Check that hot query shapes can use their indexes."""
+
+    def setUp(self):
+        self.user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+        for _ in range(3):
+            self.user.collected_notes.add(Note.objects.create(author=self.user))
+        # Like most of a collection, not drilled recently:
+        Collection.objects.update(last_drilled=timezone.now() - timezone.timedelta(30))
+
+    @contextmanager
+    def index_scans_only(self):
+        # Test tables are tiny, so sequential scans (or scans of another
+        # index followed by a sort) would otherwise win. Statistics are
+        # refreshed so that plans don't depend on when autovacuum last ran:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "ANALYZE %s, %s" % (Collection._meta.db_table, Note._meta.db_table)
+            )
+            cursor.execute("SET enable_seqscan = off")
+            cursor.execute("SET enable_sort = off")
+        try:
+            yield
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("RESET enable_seqscan")
+                cursor.execute("RESET enable_sort")
+
+    def assertUsesIndex(self, queryset, index_name):
+        with self.index_scans_only():
+            plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def get_view_queryset(self, view_class, **kwargs):
+        request = RequestFactory().get("/")
+        request.user = self.user
+        view = view_class()
+        view.setup(request, **kwargs)
+        return view.get_queryset()
+
+    def test_drill_sampler_and_stats(self):
+        self.assertUsesIndex(
+            Collection.objects.filter(user=self.user).order_by("last_drilled", "pk"),
+            "collection_user_last_drilled",
+        )
+        self.assertUsesIndex(
+            Collection.objects.filter(
+                user=self.user,
+                last_drilled__gte=timezone.now() - timezone.timedelta(hours=24),
+            ),
+            "collection_user_last_drilled",
+        )
+
+    def test_promoted_collection(self):
+        self.assertUsesIndex(
+            self.get_view_queryset(MyCollectionPromoted), "collection_user_promoted"
+        )
+
+    def test_notes_by_author(self):
+        self.assertUsesIndex(
+            self.get_view_queryset(NotesByAuthor, username=self.user.username),
+            "note_author_created_listed",
+        )
+
+    def test_cursor_seek(self):
+        paginator = CursorPaginator(
+            self.get_view_queryset(NotesByAuthor, username=self.user.username), 10
+        )
+        for direction, bound in ((AFTER, "<="), (BEFORE, ">=")):
+            with self.index_scans_only():
+                plan = paginator.seek(direction, timezone.now(), 1).explain()
+            self.assertIn("note_author_created_listed", plan)
+            # The scan starts at the cursor instead of filtering out the
+            # rows before it:
+            index_cond = next(
+                line for line in plan.splitlines() if "Index Cond" in line
+            )
+            self.assertIn(f"created {bound}", index_cond)
+
+
+class CursorPaginatorTests(TestCase):
+    def setUp(self):
+        for _ in range(20):
+            Note.objects.create()
+        # Ties on `created` are broken by primary key:
+        Note.objects.filter(pk__in=Note.objects.order_by("pk")[5:10]).update(
+            created=timezone.now()
+        )
+        self.notes = list(Note.objects.order_by("-created", "-pk"))
+        self.paginator = CursorPaginator(Note.objects.all(), 3)
+
+    def get_page(self, query):
+        key, value = query.split("=")
+        if key == "page":
+            return self.paginator.page(value)
+        return self.paginator.cursor_page(value)
+
+    def test_walk(self):
+        pages = [self.paginator.page(1)]
+        while pages[-1].has_next():
+            pages.append(self.get_page(pages[-1].next_page_query()))
+        self.assertEqual([page.number for page in pages], list(range(1, 8)))
+        self.assertEqual([note for page in pages for note in page], self.notes)
+        self.assertEqual(pages[PAGE_NUMBER_LIMIT - 1].next_page_query()[:7], "cursor=")
+
+        backward = [pages[-1]]
+        while backward[-1].has_previous():
+            backward.append(self.get_page(backward[-1].previous_page_query()))
+        self.assertEqual(
+            [list(page) for page in backward], [list(page) for page in pages[::-1]]
+        )
+
+    def test_cursor_page_queries(self):
+        token = encode_cursor(20, "a", self.notes[2].created, self.notes[2].pk)
+        with self.assertNumQueries(1):
+            page = self.paginator.cursor_page(token)
+        self.assertEqual(list(page), self.notes[3:6])
+        self.assertEqual(page.number, 20)
+
+    def test_page_number_out_of_range(self):
+        page = self.paginator.page(100)
+        self.assertEqual(page.number, 7)
+        self.assertEqual(list(page), self.notes[18:])
+        self.assertFalse(page.has_next())
+        # Numbers too large for an OFFSET aren't passed to the database:
+        page = self.paginator.page("99999999999999999999999")
+        self.assertEqual(page.number, 7)
+        with self.assertRaises(EmptyPage):
+            self.paginator.page(0)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(
+            decode_cursor(encode_cursor(6, "b", self.notes[0].created, 1))[:2],
+            (6, "b"),
+        )
+        for token in ("", "foo", encode_cursor(0, "a", timezone.now(), 1)):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(token)
+
+    def test_cursor_rows_gone(self):
+        token = encode_cursor(6, "a", self.notes[-1].created, self.notes[-1].pk)
+        self.assertEqual(self.paginator.cursor_page(token).number, 1)
+
+
+class CountersTests(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+        self.other = UserModel.objects.create_user("mary", "mary@example.com", "1234")
+
+    def get_counters(self, user):
+        return dict(Counter.objects.filter(user=user).values_list("kind", "count"))
+
+    def assertCountersExact(self):
+        for user in (self.user, self.other):
+            self.assertEqual(
+                self.get_counters(user),
+                {kind: exact_counts(kind, [user.pk])[user.pk] for kind in Counter.Kind},
+            )
+
+    def test_maintained(self):
+        self.assertEqual(self.get_counters(self.user), dict.fromkeys(Counter.Kind, 0))
+        notes = [Note.objects.create(author=self.user) for _ in range(4)]
+        Note.objects.create(author=self.user, visibility=Note.Visibility.UNLISTED)
+        self.user.collected_notes.add(*notes[:3])
+        notes[3].collectors.add(self.user, self.other)
+        Collection.objects.create(user=self.other, note=notes[0])
+        self.user.collected_notes.remove(notes[0])
+        notes[1].delete()
+        self.assertCountersExact()
+
+        notes[2].visibility = Note.Visibility.UNLISTED
+        notes[2].save()
+        # As done by the RemoveAttribution and RestoreAttribution views:
+        Note.objects.filter(pk=notes[3].pk).update(author=None)
+        Deattribution.objects.create(note=notes[3], author=self.user)
+        self.assertCountersExact()
+        Note.objects.filter(pk=notes[3].pk).update(author=self.user)
+        Deattribution.objects.get(note=notes[3]).delete()
+        self.assertCountersExact()
+        self.other.collected_notes.clear()
+        self.assertCountersExact()
+        self.assertEqual(
+            self.get_counters(self.user),
+            {
+                Counter.Kind.COLLECTED: 2,
+                Counter.Kind.LISTED: 2,
+                Counter.Kind.DEATTRIBUTED: 0,
+            },
+        )
+
+    def test_get_count(self):
+        for _ in range(3):
+            self.user.collected_notes.create()
+        queryset = self.user.collected_notes.all()
+        counter = (Counter.Kind.COLLECTED, self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_count(queryset, counter), (3, False))
+
+        # Missing counters are counted up to the threshold, and stored:
+        Counter.objects.filter(user=self.user).delete()
+        with self.assertNumQueries(3):
+            self.assertEqual(get_count(queryset, counter), (3, False))
+        self.assertEqual(self.get_counters(self.user), {Counter.Kind.COLLECTED: 3})
+        # Longer lists are estimated:
+        with patch("notes.counters.EXACT_COUNT_THRESHOLD", 2):
+            with self.assertNumQueries(2):
+                count, is_estimate = get_count(queryset.filter(author=None))
+        self.assertTrue(is_estimate)
+        self.assertGreaterEqual(count, 2)
+
+
 class CommandRemoveOldDeattributionsTests(TestCase):
     def setUp(self):
         user = UserModel.objects.create_user("x", "x@example.com", "1234")
@@ -398,6 +835,742 @@ class CommandRemoveOldDeattributionsTests(TestCase):
         self.assertEqual(Deattribution.objects.count(), 1)
 
 
+class CommandRenderNoteHtmlTests(TestCase):
+    def setUp(self):
+        self.stale = Note.objects.create(text="*Stale*")
+        self.current = Note.objects.create(text="*Current*")
+        Note.objects.filter(pk=self.stale.pk).update(
+            html_rendered="", html_renderer_version=0
+        )
+        Note.objects.filter(pk=self.current.pk).update(html_rendered="kept")
+
+    def test_invalid_options(self):
+        with self.assertRaises(CommandError):
+            call_command("render_note_html", "--batch-size", "0")
+        with self.assertRaises(CommandError):
+            call_command("render_note_html", "--jobs", "0")
+
+    def test_render_stale_only(self):
+        out = StringIO()
+        call_command("render_note_html", "--batch-size", "1", stdout=out)
+        self.assertIn("1 note(s) rendered", out.getvalue())
+        self.stale.refresh_from_db()
+        self.current.refresh_from_db()
+        self.assertEqual(self.stale.html_rendered, "<p><em>Stale</em></p>\n")
+        self.assertEqual(self.stale.html_renderer_version, Note.HTML_RENDERER_VERSION)
+        self.assertEqual(self.current.html_rendered, "kept")
+
+    def test_render_all(self):
+        out = StringIO()
+        call_command("render_note_html", "--all", stdout=out)
+        self.assertIn("2 note(s) rendered", out.getvalue())
+        self.current.refresh_from_db()
+        self.assertEqual(self.current.html_rendered, "<p><em>Current</em></p>\n")
+
+    def test_render_parallel(self):
+        out = StringIO()
+        call_command(
+            "render_note_html", "--all", "--jobs", "2", "--batch-size", "1", stdout=out
+        )
+        self.assertIn("2 note(s) rendered", out.getvalue())
+        self.stale.refresh_from_db()
+        self.assertEqual(self.stale.html_rendered, "<p><em>Stale</em></p>\n")
+
+
+class CommandRepairCountersTests(TestCase):
+    def setUp(self):
+        self.users = [
+            UserModel.objects.create_user(f"user{i}", f"user{i}@example.com", "1234")
+            for i in range(3)
+        ]
+        for user in self.users:
+            user.collected_notes.add(Note.objects.create(author=user))
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(CommandError):
+            call_command("repair_counters", "--batch-size", "0")
+
+    def test_repair(self):
+        Counter.objects.filter(user=self.users[0]).update(count=99)
+        Counter.objects.filter(user=self.users[2], kind=Counter.Kind.LISTED).delete()
+        out = StringIO()
+        call_command("repair_counters", "--batch-size", "2", stdout=out)
+        self.assertEqual(out.getvalue(), "4 counter(s) repaired.\n")
+        for user in self.users:
+            self.assertEqual(
+                dict(Counter.objects.filter(user=user).values_list("kind", "count")),
+                {
+                    Counter.Kind.COLLECTED: 1,
+                    Counter.Kind.LISTED: 1,
+                    Counter.Kind.DEATTRIBUTED: 0,
+                },
+            )
+
+
+class CommandReconcileCollectorCountsTests(TestCase):
+    def setUp(self):
+        self.notes = [Note.objects.create() for _ in range(3)]
+        user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+        user.collected_notes.add(*self.notes[:2])
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(CommandError):
+            call_command("reconcile_collector_counts", "--batch-size", "0")
+
+    def test_reconcile(self):
+        Note.objects.filter(pk=self.notes[0].pk).update(collector_count=5)
+        Note.objects.filter(pk=self.notes[2].pk).update(collector_count=1)
+        out = StringIO()
+        call_command("reconcile_collector_counts", "--batch-size", "2", stdout=out)
+        self.assertEqual(out.getvalue(), "2 note(s) reconciled.\n")
+        self.assertEqual(
+            [note.collector_count for note in Note.objects.order_by("pk")], [1, 1, 0]
+        )
+
+
+class CommandBenchmarkTests(TestCase):
+    def test_invalid_options(self):
+        with self.assertRaises(CommandError):
+            call_command("benchmark", "markdown", "--number", "0")
+
+    def test_markdown_benchmark(self):
+        out = StringIO()
+        call_command(
+            "benchmark", "markdown", "--number", "20", "--repeat", "1", stdout=out
+        )
+        output = json.loads(out.getvalue())
+        self.assertEqual(output["benchmark"], "markdown")
+        self.assertEqual(output["results"]["notes"], 20)
+        self.assertIn("speedup", output["results"])
+
+    def test_urls_benchmark(self):
+        out = StringIO()
+        call_command(
+            "benchmark", "urls", "--number", "100", "--repeat", "1", stdout=out
+        )
+        results = json.loads(out.getvalue())["results"]
+        self.assertIn("speedup", results["notes:single-note"])
+
+    def test_random_benchmark(self):
+        out = StringIO()
+        args = ["--sizes", "50", "--number", "2", "--repeat", "1"]
+        call_command("benchmark", "random", *args, stdout=out)
+        results = json.loads(out.getvalue())["results"]
+        self.assertEqual(results[0]["notes"], 50)
+        self.assertIn("get_random_ms", results[0])
+        # Seeded data is rolled back:
+        self.assertEqual(Note.objects.count(), 0)
+
+    def test_drill_weights_benchmark(self):
+        out = StringIO()
+        args = ["--sizes", "10", "100", "--number", "2", "--repeat", "1"]
+        call_command("benchmark", "drill-weights", *args, stdout=out)
+        results = json.loads(out.getvalue())["results"]
+        self.assertEqual([result["notes"] for result in results], [10, 100])
+        self.assertIn("speedup", results[0])
+
+    def test_cards_benchmark(self):
+        out = StringIO()
+        args = ["--sizes", "10", "20", "--number", "2", "--repeat", "1"]
+        call_command("benchmark", "cards", *args, stdout=out)
+        results = json.loads(out.getvalue())["results"]
+        self.assertEqual([result["notes"] for result in results], [10, 20])
+        self.assertIn("speedup", results[0])
+        self.assertIn("memory_ratio", results[0])
+        self.assertEqual(Note.objects.count(), 0)
+
+    def test_drill_benchmark(self):
+        out = StringIO()
+        args = ["--sizes", "10", "50", "--number", "3"]
+        call_command("benchmark", "drill", *args, stdout=out)
+        results = json.loads(out.getvalue())["results"]
+        self.assertEqual([result["notes"] for result in results], [10, 50])
+        self.assertEqual(results[1]["promoted"], 5)
+        self.assertTrue(all(result["distribution_ok"] for result in results))
+        # Session and user queries are not involved:
+        self.assertEqual(results[1]["draw_max_queries"], 2)
+        self.assertGreater(results[1]["cold_draw_queries"], 2)
+        self.assertEqual(Collection.objects.count(), 0)
+
+
+class DiscoverPoolTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.notes = [Note.objects.create() for _ in range(5)]
+        self.unlisted = Note.objects.create(visibility=Note.Visibility.UNLISTED)
+
+    def test_refresh(self):
+        self.assertEqual(refresh_discover_pool(3), 3)
+        self.assertEqual(refresh_discover_pool(), 5)
+        pool = cache.get(DISCOVER_POOL_CACHE_KEY)
+        self.assertCountEqual(pool, [note.pk for note in self.notes])
+
+    def test_get_pooled_note(self):
+        refresh_discover_pool()
+        with self.assertNumQueries(1):
+            note = get_pooled_note()
+        self.assertIn(note, self.notes)
+
+    def test_missing_pool_is_refilled(self):
+        # E.g., evicted, or never filled in this worker's cache:
+        self.assertIn(get_pooled_note(), self.notes)
+        self.assertCountEqual(
+            cache.get(DISCOVER_POOL_CACHE_KEY), [note.pk for note in self.notes]
+        )
+        # While another request refills the pool, the caller falls back:
+        cache.delete(DISCOVER_POOL_CACHE_KEY)
+        cache.add(DISCOVER_POOL_LOCK_CACHE_KEY, True)
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_pooled_note())
+        self.assertIsNone(cache.get(DISCOVER_POOL_CACHE_KEY))
+        # Empty pools are kept until the next refresh:
+        cache.set(DISCOVER_POOL_CACHE_KEY, [])
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_pooled_note())
+
+    def test_anonymous_discover_uses_pool(self):
+        refresh_discover_pool()
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("notes:discover"))
+        self.assertIn(response.context["note"], self.notes)
+
+    def test_unlisted_and_deleted_notes_are_removed(self):
+        refresh_discover_pool()
+        self.notes[0].visibility = Note.Visibility.UNLISTED
+        self.notes[0].save()
+        self.notes[1].delete()
+        pool = cache.get(DISCOVER_POOL_CACHE_KEY)
+        self.assertCountEqual(pool, [note.pk for note in self.notes[2:]])
+
+    def test_stale_entries_are_skipped(self):
+        cache.set(DISCOVER_POOL_CACHE_KEY, [self.unlisted.pk])
+        self.assertIsNone(get_pooled_note())
+        self.assertEqual(cache.get(DISCOVER_POOL_CACHE_KEY), [])
+
+    def test_command(self):
+        out = StringIO()
+        call_command("refresh_discover_pool", "--size", "2", stdout=out)
+        self.assertIn("2 note(s)", out.getvalue())
+        self.assertEqual(len(cache.get(DISCOVER_POOL_CACHE_KEY)), 2)
+        with self.assertRaises(CommandError):
+            call_command("refresh_discover_pool", "--size", "0")
+
+
+class ExcludedIdsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+        self.notes = [Note.objects.create() for _ in range(5)]
+        self.authored = Note.objects.create(author=self.user)
+        self.user.collected_notes.add(self.notes[0])
+
+    def assertExcludedIds(self, notes):
+        expected = sorted(note.pk for note in notes)
+        self.assertEqual(list(get_excluded_ids(self.user.pk)), expected)
+        self.assertEqual(list(build_excluded_ids(self.user.pk)), expected)
+
+    def test_note_id_set(self):
+        note_ids = NoteIdSet([5, 3, 9, 3])
+        self.assertEqual(list(note_ids), [3, 5, 9])
+        note_ids.add(4)
+        note_ids.add(5)
+        note_ids.discard(9)
+        note_ids.discard(10)
+        self.assertEqual(list(note_ids), [3, 4, 5])
+        self.assertIn(4, note_ids)
+        self.assertNotIn(9, note_ids)
+        restored = NoteIdSet.frombytes(note_ids.tobytes())
+        self.assertEqual(list(restored), [3, 4, 5])
+
+    def test_cached(self):
+        self.assertExcludedIds([self.notes[0], self.authored])
+        with self.assertNumQueries(0):
+            get_excluded_ids(self.user.pk)
+
+    def test_updated_in_place(self):
+        get_excluded_ids(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.collected_notes.add(self.notes[1], self.authored)
+            self.notes[2].collectors.add(self.user)
+            Collection.objects.create(user=self.user, note=self.notes[3])
+            authored = Note.objects.create(author=self.user)
+        with self.assertNumQueries(0):
+            note_ids = get_excluded_ids(self.user.pk)
+        self.assertEqual(len(note_ids), 6)
+        self.assertExcludedIds(self.notes[:4] + [self.authored, authored])
+
+        # Unsaving an authored note keeps it excluded:
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.collected_notes.remove(self.notes[0], self.authored)
+            self.notes[2].collectors.remove(self.user)
+            Collection.objects.filter(note=self.notes[3]).delete()
+        self.assertExcludedIds([self.notes[1], self.authored, authored])
+
+    def test_invalidated(self):
+        get_excluded_ids(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.collected_notes.clear()
+        self.assertExcludedIds([self.authored])
+        self.notes[1].collectors.add(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.notes[1].collectors.clear()
+        self.assertExcludedIds([self.authored])
+        # Removal of attribution:
+        Note.objects.filter(pk=self.authored.pk).update(author=None)
+        with self.captureOnCommitCallbacks(execute=True):
+            Deattribution.objects.create(note=self.authored, author=self.user)
+        self.assertExcludedIds([])
+
+    def test_too_large(self):
+        with patch("notes.exclusions.MAX_EXCLUDED_IDS", 2):
+            self.assertEqual(len(get_excluded_ids(self.user.pk)), 2)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.collected_notes.add(self.notes[1])
+            self.assertIsNone(get_excluded_ids(self.user.pk))
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.collected_notes.remove(self.notes[1])
+            self.assertEqual(len(get_excluded_ids(self.user.pk)), 2)
+
+    def test_discover(self):
+        self.client.login(username="juan", password="1234")
+        for _ in range(10):
+            response = self.client.get(reverse("notes:discover"))
+            self.assertIn(response.context["note"], self.notes[1:])
+
+
+class DrillSamplerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+
+    def assertDrawsMatchWeights(self, promoted_statuses, draws=50_000):
+        """
+        Check the draw distribution against `Drill.generate_weights()` with a
+        chi-squared test at the 0.1% significance level.
+        """
+        # Items are least recently drilled first; the last one is excluded
+        # from draws, and `generate_weights()` takes the most recent first:
+        items = [(pk, promoted) for pk, promoted in enumerate(promoted_statuses, 1)]
+        sampler = DrillSampler(items)
+        weights = Drill.generate_weights(
+            [promoted for _, promoted in reversed(items[:-1])]
+        )
+        expected = dict(
+            zip(
+                reversed(range(1, len(items))),
+                (draws * weight / sum(weights) for weight in weights),
+            )
+        )
+        rng = random.Random(1234)
+        observed = collections.Counter(sampler.draw(rng) for _ in range(draws))
+        self.assertNotIn(len(items), observed)
+
+        chi_squared, critical = chi_squared_test(observed, expected)
+        self.assertLess(chi_squared, critical)
+
+    def test_distribution(self):
+        rng = random.Random(42)
+        self.assertDrawsMatchWeights([False] * 30)
+        self.assertDrawsMatchWeights([True] * 30)
+        self.assertDrawsMatchWeights([rng.random() < 0.3 for _ in range(60)])
+        self.assertDrawsMatchWeights([True, False, False, True])
+
+    def test_operations(self):
+        sampler = DrillSampler([(1, False), (2, True), (3, False)])
+        self.assertEqual(len(sampler), 3)
+        sampler.touch(1)
+        sampler.add(4, True)
+        sampler.add(2)
+        sampler.remove(3)
+        sampler.set_promoted(1, True)
+        self.assertEqual(sampler.items(), [(2, True), (1, True), (4, True)])
+        self.assertTrue(sampler.is_promoted(4))
+        self.assertFalse(sampler.is_promoted(3))
+        self.assertIsNone(DrillSampler([(1, False)]).draw())
+        # Exhausting slots compacts them:
+        for _ in range(200):
+            sampler.touch(2)
+            sampler.touch(1)
+        self.assertEqual(sampler.items(), [(4, True), (2, True), (1, True)])
+        self.assertIn(sampler.draw(), (4, 2))
+
+    def test_draw_and_touch(self):
+        sampler = DrillSampler([(1, False), (2, False), (3, True)])
+        note_pk = sampler.draw_and_touch(random.Random(1))
+        self.assertIn(note_pk, (1, 2))
+        self.assertEqual(sampler.items()[-1], (note_pk, False))
+        self.assertIsNone(sampler.slots)
+        self.assertIsNone(DrillSampler([(1, False)]).draw_and_touch())
+
+    def test_pickling(self):
+        items = [(pk, pk % 3 == 0) for pk in range(1, 1001)]
+        sampler = DrillSampler(items)
+        sampler.remove(500)
+        sampler.touch(1)
+        restored = pickle.loads(pickle.dumps(sampler))
+        self.assertEqual(restored.items(), sampler.items())
+        self.assertEqual(len(restored), 999)
+        self.assertEqual(list(restored.tree), list(sampler.tree))
+        self.assertEqual(len(restored.note_ids), len(sampler.note_ids))
+        # Unused slots, the tree and the slot map are left out:
+        self.assertIn(1, sampler)
+        self.assertLess(
+            len(pickle.dumps(sampler)), len(pickle.dumps(sampler.note_ids)) * 0.6
+        )
+        restored.touch(2)
+        restored.add(1001, True)
+        self.assertEqual(restored.items()[-2:], [(2, False), (1001, True)])
+        self.assertTrue(restored.is_promoted(999))
+        self.assertNotIn(500, restored)
+
+    def test_set_promoted_many(self):
+        items = [(pk, False) for pk in range(1, 11)]
+        mapped = DrillSampler(items)
+        self.assertIn(1, mapped)  # builds the slot map
+        for sampler in (DrillSampler(items), mapped):
+            sampler.set_promoted_many([2, 5, 11], True)
+            sampler.set_promoted_many(iter([5]), False)
+            self.assertEqual(
+                [note_pk for note_pk, promoted in sampler.items() if promoted], [2]
+            )
+
+    def test_slot_map_through_compaction(self):
+        sampler = DrillSampler([(1, False), (2, False), (3, False)])
+        self.assertIn(1, sampler)
+        for _ in range(200):
+            sampler.touch(2)
+            sampler.touch(1)
+            sampler.draw_and_touch()
+        self.assertEqual(
+            sampler.slots,
+            {note_pk: sampler.note_ids.index(note_pk) for note_pk in (1, 2, 3)},
+        )
+
+    def test_tree(self):
+        for size in (0, 1, 63, 64, 65, 1000):
+            sampler = DrillSampler((pk, False) for pk in range(1, size + 1))
+            self.assertEqual(
+                [sampler._find(k) for k in range(1, size + 1)],
+                list(range(1, size + 1)),
+            )
+        sampler.remove(10)
+        sampler.touch(1)
+        self.assertEqual(sampler.note_ids[sampler._find(1)], 2)
+        self.assertEqual(sampler.note_ids[sampler._find(9)], 11)
+        self.assertEqual(sampler.note_ids[sampler._find(999)], 1)
+
+    def test_updated_in_place(self):
+        notes = [Note.objects.create() for _ in range(4)]
+        self.user.collected_notes.add(notes[0])
+        get_drill_sampler(self.user.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.collected_notes.add(notes[1], notes[2])
+            notes[3].collectors.add(self.user)
+            self.user.collected_notes.remove(notes[1])
+            Collection.objects.filter(note=notes[2]).delete()
+            collection = Collection.objects.get(note=notes[3])
+            collection.promoted = True
+            collection.save()
+        with self.assertNumQueries(0):
+            sampler = get_drill_sampler(self.user.pk)
+        self.assertEqual(sampler.items(), [(notes[0].pk, False), (notes[3].pk, True)])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.collected_notes.clear()
+        self.assertEqual(len(get_drill_sampler(self.user.pk)), 0)
+
+    def test_view_queue(self):
+        notes = [Note.objects.create() for _ in range(3)]
+        for note in notes:
+            self.user.collected_notes.add(note)
+        self.client.login(username="juan", password="1234")
+        response = self.client.post(reverse("notes:drill"), {"promote": notes[2].code})
+        drawn = [response.context["note"].pk]
+        self.assertEqual(response.context["promoted"], drawn[0] == notes[2].pk)
+        queue = cache.get(drill_queue_cache_key(self.user.pk))
+        self.assertEqual(len(queue), DRILL_QUEUE_SIZE - 1)
+        # The sampler is advanced past the queued cards:
+        sampler = get_drill_sampler(self.user.pk)
+        self.assertEqual(sampler.items()[-1][0], queue[0])
+        self.assertTrue(sampler.is_promoted(notes[2].pk))
+
+        # Cards are served in order; promotion keeps the queue:
+        response = self.client.post(reverse("notes:drill"), {"demote": notes[2].code})
+        self.assertFalse(get_drill_sampler(self.user.pk).is_promoted(notes[2].pk))
+        drawn.append(response.context["note"].pk)
+        for _ in range(DRILL_QUEUE_SIZE - 2):
+            drawn.append(self.client.post(reverse("notes:drill")).context["note"].pk)
+        self.assertEqual(drawn[1:], queue[::-1])
+        self.assertFalse(cache.get(drill_queue_cache_key(self.user.pk)))
+        # The last drilled note is never repeated:
+        for previous, current in zip(drawn, drawn[1:]):
+            self.assertNotEqual(previous, current)
+        last_drilled = (
+            Collection.objects.filter(user=self.user).latest("last_drilled").note_id
+        )
+        self.assertEqual(last_drilled, drawn[-1])
+
+        # Refilled when empty, and discarded when the collection changes:
+        self.client.post(reverse("notes:drill"))
+        self.assertTrue(cache.get(drill_queue_cache_key(self.user.pk)))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.collected_notes.add(Note.objects.create())
+        self.assertIsNone(cache.get(drill_queue_cache_key(self.user.pk)))
+        self.assertEqual(len(get_drill_sampler(self.user.pk)), 4)
+
+    def test_evicted_queue(self):
+        for _ in range(3):
+            self.user.collected_notes.add(Note.objects.create())
+        self.client.login(username="juan", password="1234")
+        previous = None
+        for _ in range(10):
+            note = self.client.post(reverse("notes:drill")).context["note"]
+            self.assertNotEqual(note.pk, previous)
+            previous = note.pk
+            # The queue is evicted, but the advanced sampler stays cached:
+            cache.delete(drill_queue_cache_key(self.user.pk))
+        # The sampler is rebuilt from the database in that case:
+        with self.assertNumQueries(1):
+            pop_drill_card(self.user.pk)
+        with self.assertNumQueries(0):
+            pop_drill_card(self.user.pk)
+
+    def test_view_rebuilds_outdated_sampler(self):
+        notes = [Note.objects.create() for _ in range(3)]
+        for note in notes[:2]:
+            self.user.collected_notes.add(note)
+        # A sampler where the only drawable note is not in the collection:
+        sampler = DrillSampler([(notes[2].pk, False), (notes[0].pk, False)])
+        save_drill_sampler(self.user.pk, sampler)
+        self.client.login(username="juan", password="1234")
+        response = self.client.post(reverse("notes:drill"))
+        self.assertEqual(response.context["note"], notes[0])
+        self.assertNotIn(notes[2].pk, get_drill_sampler(self.user.pk))
+
+
+class DrillStatsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+
+    def assertStatsEqual(self, first, second):
+        self.assertEqual((first.size, first.hourly), (second.size, second.hourly))
+
+    def test_recent_drill_count(self):
+        now = timezone.now()
+        hour = timezone.timedelta(hours=1)
+        stats = DrillStats()
+        for moment in (now, now - hour, now - 23 * hour, now - 24 * hour):
+            stats.record_added(moment)
+        self.assertEqual(stats.size, 4)
+        # Counted to the hour, so the oldest item has been pruned:
+        self.assertEqual(len(stats.hourly), 3)
+        self.assertEqual(stats.recent_drill_count(now), 3)
+        self.assertEqual(stats.recent_drill_count(now + hour), 2)
+
+        stats.record_drill(now - 23 * hour, now)
+        self.assertEqual(stats.hourly[hour_of(now)], 2)
+        stats.record_drills([(now - 24 * hour, now), (now - hour, now)])
+        self.assertEqual(stats.hourly, {hour_of(now): 4})
+        stats.record_removed(now)
+        self.assertEqual((stats.size, stats.recent_drill_count(now)), (3, 3))
+
+    def test_updated_in_place(self):
+        notes = [Note.objects.create() for _ in range(4)]
+        self.user.collected_notes.add(notes[0])
+        Collection.objects.create(
+            user=self.user,
+            note=notes[1],
+            last_drilled=timezone.now() - timezone.timedelta(hours=30),
+        )
+        stats = get_drill_stats(self.user.pk)
+        self.assertEqual((stats.size, stats.recent_drill_count(timezone.now())), (2, 1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            notes[2].collectors.add(self.user)
+            self.user.collected_notes.add(notes[3])
+            self.user.collected_notes.remove(notes[0])
+        self.client.login(username="juan", password="1234")
+        self.client.post(reverse("notes:drill"))
+        review_note(self.user.pk, notes[1].code, "good")
+        with self.assertNumQueries(0):
+            stats = get_drill_stats(self.user.pk)
+        self.assertStatsEqual(stats, build_drill_stats(self.user.pk))
+        self.assertEqual((stats.size, stats.recent_drill_count(timezone.now())), (3, 3))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.collected_notes.clear()
+        self.assertEqual(get_drill_stats(self.user.pk).size, 0)
+
+
+class CollectingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+        self.notes = [Note.objects.create() for _ in range(3)]
+        other = UserModel.objects.create_user("mary", "mary@example.com", "1234")
+        other.collected_notes.add(self.notes[2])
+
+    def assertConsistent(self):
+        """Check the maintained data against the database."""
+        user_pk = self.user.pk
+        self.assertEqual(
+            sorted(note_pk for note_pk, _ in get_drill_sampler(user_pk).items()),
+            sorted(self.user.collected_notes.values_list("pk", flat=True)),
+        )
+        stats, built = get_drill_stats(user_pk), build_drill_stats(user_pk)
+        self.assertEqual((stats.size, stats.hourly), (built.size, built.hourly))
+        self.assertEqual(
+            list(get_excluded_ids(user_pk)), list(build_excluded_ids(user_pk))
+        )
+        self.assertEqual(
+            Counter.objects.get(user=user_pk, kind=Counter.Kind.COLLECTED).count,
+            exact_counts(Counter.Kind.COLLECTED, [user_pk])[user_pk],
+        )
+        for note in Note.objects.all():
+            self.assertEqual(note.collector_count, note.collectors.count())
+
+    def warm_caches(self):
+        get_drill_sampler(self.user.pk)
+        get_drill_stats(self.user.pk)
+        get_excluded_ids(self.user.pk)
+
+    def test_save_notes(self):
+        a, b, c = self.notes
+        self.warm_caches()
+        # The statement, and the counter update:
+        with self.assertNumQueries(2), self.captureOnCommitCallbacks(execute=True):
+            results = save_notes(self.user.pk, [a.code, c.code, "FOOBAR"])
+        self.assertEqual(results, {a.code: (a.pk, True), c.code: (c.pk, True)})
+        self.assertConsistent()
+
+        # Saving again changes nothing:
+        with self.assertNumQueries(1), self.captureOnCommitCallbacks(execute=True):
+            results = save_notes(self.user.pk, [a.code])
+        self.assertEqual(results, {a.code: (a.pk, False)})
+        self.assertConsistent()
+
+        # Without cached data:
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            save_notes(self.user.pk, [b.code])
+        self.assertConsistent()
+
+    def test_unsave_notes(self):
+        a, b, c = self.notes
+        self.user.collected_notes.add(a, c)
+        self.warm_caches()
+        # The statement, the counter update, and the check for authored
+        # notes in the cached set:
+        with self.assertNumQueries(3), self.captureOnCommitCallbacks(execute=True):
+            results = unsave_notes(self.user.pk, [a.code, b.code, "FOOBAR"])
+        self.assertEqual(results, {a.code: (a.pk, True), b.code: (b.pk, False)})
+        self.assertConsistent()
+        self.assertNotIn(a.pk, get_excluded_ids(self.user.pk))
+
+        with self.assertNumQueries(1), self.captureOnCommitCallbacks(execute=True):
+            results = unsave_notes(self.user.pk, [a.code])
+        self.assertEqual(results, {a.code: (a.pk, False)})
+
+        cache.clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            unsave_notes(self.user.pk, [c.code])
+        self.assertConsistent()
+
+    def test_rollback_leaves_caches(self):
+        a, b, c = self.notes
+        self.warm_caches()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                apply_collection_action(self.user.pk, "save", [a.code])
+                apply_collection_action(self.user.pk, "promote", [a.code])
+                raise IntegrityError
+        self.assertEqual(callbacks, [])
+        self.assertNotIn(a.pk, get_excluded_ids(self.user.pk))
+        self.assertEqual(len(get_drill_sampler(self.user.pk)), 0)
+        self.assertEqual(get_drill_stats(self.user.pk).size, 0)
+
+    def test_apply_collection_action_promotion(self):
+        a, b, c = self.notes
+        self.user.collected_notes.add(a, b)
+        self.warm_caches()
+        # Savepoint, the statement, and savepoint release:
+        with self.assertNumQueries(3), self.captureOnCommitCallbacks(execute=True):
+            results = apply_collection_action(
+                self.user.pk, "promote", [a.code, c.code, "FOOBAR"]
+            )
+        self.assertEqual(
+            results,
+            {
+                a.code: "promoted",
+                c.code: "not-in-collection",
+                "FOOBAR": "not-in-collection",
+            },
+        )
+        sampler = get_drill_sampler(self.user.pk)
+        self.assertTrue(sampler.is_promoted(a.pk))
+        self.assertFalse(sampler.is_promoted(b.pk))
+        with self.captureOnCommitCallbacks(execute=True):
+            results = apply_collection_action(self.user.pk, "demote", [a.code, b.code])
+        self.assertEqual(results, {a.code: "demoted", b.code: "unchanged"})
+        self.assertFalse(get_drill_sampler(self.user.pk).is_promoted(a.pk))
+        self.assertFalse(Collection.objects.filter(promoted=True).exists())
+
+    def test_note_card_invalidated(self):
+        note = self.notes[0]
+        key = note_controls_cache_key(note.pk, False, False)
+        cache.set(key, "controls")
+        with self.captureOnCommitCallbacks(execute=True):
+            save_notes(self.user.pk, [note.code])
+        self.assertIsNone(cache.get(key))
+        cache.set(key, "controls")
+        with self.captureOnCommitCallbacks() as callbacks:
+            unsave_notes(self.user.pk, [note.code])
+        # Not invalidated before the transaction commits:
+        self.assertEqual(cache.get(key), "controls")
+        for callback in callbacks:
+            callback()
+        self.assertIsNone(cache.get(key))
+
+
+class SpacedRepetitionTests(TestCase):
+    def test_schedule_review(self):
+        day = timezone.timedelta(days=1)
+        intervals = []
+        interval, ease = timezone.timedelta(), 2.5
+        for _ in range(4):
+            interval, ease, delay = schedule_review(interval, ease, "good", False)
+            self.assertEqual(delay, interval)
+            intervals.append(interval)
+        self.assertEqual(intervals, [day, 6 * day, 15 * day, 37.5 * day])
+        self.assertEqual(ease, 2.5)
+
+        interval, ease, delay = schedule_review(interval, ease, "again", False)
+        self.assertEqual(interval, timezone.timedelta())
+        self.assertAlmostEqual(ease, 2.3)
+        self.assertEqual(delay, REVIEW_AGAIN_DELAY)
+        self.assertEqual(
+            schedule_review(interval, 1.3, "again", False)[1], REVIEW_MIN_EASE
+        )
+
+        # Promoted notes are due sooner:
+        interval, ease, delay = schedule_review(6 * day, 2.0, "good", True)
+        self.assertEqual(interval, 12 * day)
+        self.assertEqual(delay, 6 * day)
+
+    def test_review_note(self):
+        cache.clear()
+        user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+        notes = [user.collected_notes.create() for _ in range(3)]
+        get_drill_sampler(user.pk)
+        self.assertFalse(review_note(user.pk, "missing", "good"))
+        self.assertTrue(review_note(user.pk, notes[0].code, "again"))
+        item = Collection.objects.get(note=notes[0])
+        self.assertEqual(item.ease, 2.3)
+        self.assertLess(item.due_at, timezone.now() + REVIEW_AGAIN_DELAY)
+        # Counts as drilling the note:
+        self.assertEqual(get_drill_sampler(user.pk).items()[-1][0], notes[0].pk)
+
+
 class TemplatesTests(TestCase):
     def setUp(self):
         self.factory = RequestFactory()
@@ -524,6 +1697,124 @@ class NoteControlsTemplateTagTests(TestCase):
         self.assertIn("/test-9ebb5a63/", out)
 
 
+class NoteCardCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = UserModel.objects.create_user("juan", "juan@example.com", "1234")
+        self.notes = [
+            Note.objects.create(author=self.user, text=f"Note {i}") for i in range(10)
+        ]
+        self.note = self.notes[0]
+        self.client.login(username="juan", password="1234")
+
+    def get_page(self):
+        return self.client.get(
+            reverse("notes:notes-by-username", kwargs={"username": "juan"})
+        )
+
+    def is_card_cached(self, note, saved=False, is_author=True):
+        return (
+            cache.get(make_template_fragment_key("note-card-html", [note.pk]))
+            is not None
+            and cache.get(make_template_fragment_key("note-card-footer", [note.pk]))
+            is not None
+            and cache.get(note_controls_cache_key(note.pk, saved, is_author))
+            is not None
+        )
+
+    def test_page_assembled_from_cache(self):
+        self.get_page()
+        for note in self.notes:
+            self.assertTrue(self.is_card_cached(note))
+        # Changes that bypass signals are not seen, as the cards are cached:
+        Note.objects.update(html_rendered="<p>Changed</p>\n")
+        res = self.get_page()
+        self.assertNotContains(res, "Changed")
+        self.assertContains(res, "Note 9")
+
+    def test_cache_timeout(self):
+        with patch("notes.templatetags.note_controls.NOTE_CARD_CACHE_TIMEOUT", 0):
+            self.get_page()
+        self.assertIsNone(
+            cache.get(make_template_fragment_key("note-card-html", [self.note.pk]))
+        )
+
+    def test_invalidation_on_save_and_unsave(self):
+        self.get_page()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse(
+                    "notes:collection-action",
+                    kwargs={"code": self.note.code, "action": "save"},
+                )
+            )
+        self.assertFalse(self.is_card_cached(self.note))
+        self.assertTrue(self.is_card_cached(self.notes[1]))
+        self.get_page()
+        self.assertTrue(self.is_card_cached(self.note, saved=True))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.collected_notes.remove(self.note)
+        self.assertFalse(self.is_card_cached(self.note, saved=True))
+
+    def test_invalidation_on_visibility_change(self):
+        self.get_page()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse("notes:change-vis", kwargs={"slug": self.note.code}),
+                {"visibility": Note.Visibility.UNLISTED},
+            )
+        self.assertFalse(self.is_card_cached(self.note))
+        self.assertTrue(self.is_card_cached(self.notes[1]))
+
+    def test_invalidation_on_deattribution_and_restoration(self):
+        self.get_page()
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.client.post(
+                reverse("notes:deattribute", kwargs={"slug": self.note.code})
+            )
+        # Not invalidated before the transaction commits:
+        self.assertTrue(self.is_card_cached(self.note))
+        for callback in callbacks:
+            callback()
+        self.assertFalse(self.is_card_cached(self.note))
+        self.get_page()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse("notes:reattribute", kwargs={"slug": self.note.code})
+            )
+        self.assertFalse(self.is_card_cached(self.note))
+        res = self.get_page()
+        self.assertContains(res, "Note 0")
+
+    def test_invalidation_on_deletion(self):
+        self.get_page()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse("notes:delete-note", kwargs={"slug": self.note.code})
+            )
+        self.assertFalse(Note.objects.filter(pk=self.note.pk).exists())
+        self.assertFalse(self.is_card_cached(self.note))
+
+    def test_invalidation_on_author_deletion(self):
+        self.get_page()
+        other = UserModel.objects.create_user("mary", "mary@example.com", "1234")
+        other_note = Note.objects.create(author=other)
+        cache.set(make_template_fragment_key("note-card-footer", [other_note.pk]), "x")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+        self.assertFalse(self.is_card_cached(self.note))
+        self.assertIsNotNone(
+            cache.get(make_template_fragment_key("note-card-footer", [other_note.pk]))
+        )
+
+    def test_invalidation_on_rerender(self):
+        self.get_page()
+        Note.objects.filter(pk=self.note.pk).update(html_renderer_version=0)
+        call_command("render_note_html", stdout=StringIO())
+        self.assertFalse(self.is_card_cached(self.note))
+        self.assertTrue(self.is_card_cached(self.notes[1]))
+
+
 class NoteExtrasTemplateTagTests(TestCase):
     def test_note_vis_badge(self):
         note = Note.objects.create(visibility=Note.Visibility.NORMAL)
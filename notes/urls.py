@@ -42,10 +42,18 @@ urlpatterns = [
         views.MyCollectionPromoted.as_view(),
         name="my-collection-promoted",
     ),
+    path(
+        "collection/bulk/",
+        views.CollectionBulkAction.as_view(),
+        name="collection-bulk-action",
+    ),
     path("deattributed/", views.DeattributedNotes.as_view(), name="deattributed-notes"),
     path("@<username>/", views.NotesByAuthor.as_view(), name="notes-by-username"),
     path("discover/", views.Discover.as_view(), name="discover"),
     path("drill/", views.Drill.as_view(), name="drill"),
+    path("drill/due/", views.DrillDue.as_view(), name="drill-due"),
+    path("drill/snapshot/", views.DrillSnapshot.as_view(), name="drill-snapshot"),
+    path("drill/sync/", views.DrillSync.as_view(), name="drill-sync"),
     re_path(
         # Same as "<slug:code>/<action>/" where <action> is save or unsave:
         r"^(?P<code>[\w-]+)/(?P<action>save|unsave)/$",
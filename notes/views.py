@@ -1,5 +1,5 @@
 import itertools
-import random
+import json
 
 from django.contrib import messages
 from django.contrib.auth import get_user_model
@@ -12,13 +12,15 @@ from django.core.exceptions import (
     ObjectDoesNotExist,
     PermissionDenied,
 )
-from django.core.paginator import EmptyPage, Paginator
+from django.core.paginator import InvalidPage
 from django.db import transaction
+from django.db.models import Value
 from django.forms import modelform_factory
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.http import url_has_allowed_host_and_scheme
 from django.utils.safestring import mark_safe
 from django.views import View
@@ -33,7 +35,36 @@ from django.views.generic.detail import SingleObjectMixin
 
 from formtools.preview import FormPreview
 
-from .models import Collection, Deattribution, Note
+from leornian_helpers.markdown import renderer
+from leornian_helpers.mixins import IdentityMapMixin
+
+from .collecting import (
+    COLLECTION_ACTION_MAX_CODES,
+    COLLECTION_ACTIONS,
+    apply_collection_action,
+    save_notes,
+    unsave_notes,
+)
+from .discover import get_pooled_note
+from .drill import (
+    DRILL_SYNC_MAX_EVENTS,
+    REVIEW_RESULTS,
+    DrillSampler,
+    apply_drill_events,
+    count_due,
+    get_next_due,
+    invalidate_drill_sampler,
+    pop_drill_card,
+    review_note,
+    set_promoted,
+    stamp_drilled,
+    update_drill_sampler,
+)
+from .drill_stats import DrillStats, get_drill_stats, update_drill_stats
+from .exclusions import get_excluded_ids
+from .models import Collection, Counter, Deattribution, Note
+from .models.note import SINGLE_NOTE_URL
+from .pagination import CursorPaginator
 
 UserModel = get_user_model()
 
@@ -41,24 +72,35 @@ UserModel = get_user_model()
 NoteForm = modelform_factory(Note, fields=["text", "visibility"])
 
 
-class GracefulPaginator(Paginator):
+class CursorListView(ListView):
     """
-    django.core.paginator.Paginator modified so that page() behaves
-    like get_page() when receiving a page number greater than num_pages.
-    Solution from https://stackoverflow.com/a/40835335/14354604.
+    ListView paginated newest first with `CursorPaginator`, which takes
+    either a `page` number or a `cursor` token. Use with the
+    `notes/includes/cursor_pagination.html` template.
     """
 
-    def validate_number(self, number):
-        try:
-            return super().validate_number(number)
-        except EmptyPage:
-            if number > 1:
-                return self.num_pages
-            raise
+    counter_kind = None
+    """Kind of the `Counter` of the user's objects listed, if any."""
 
+    def get_counter(self):
+        """
+        Return the `(kind, user_pk)` of the `Counter` holding the number of
+        objects in the list, if there is one.
+        """
+        if self.counter_kind is None:
+            return None
+        return self.counter_kind, self.request.user.pk
 
-class GracefulListView(ListView):
-    paginator_class = GracefulPaginator
+    def paginate_queryset(self, queryset, page_size):
+        paginator = CursorPaginator(queryset, page_size, counter=self.get_counter())
+        try:
+            page = paginator.get_page(
+                self.request.GET.get(self.page_kwarg),
+                self.request.GET.get("cursor"),
+            )
+        except InvalidPage as e:
+            raise Http404(f"Invalid page: {e}")
+        return paginator, page, page.object_list, page.has_other_pages()
 
 
 class _NoteCreate(FormPreview):
@@ -78,66 +120,78 @@ create_note = login_required(_NoteCreate(NoteForm))
 """View function for creating a Note with a preview stage."""
 
 
-class NotesByAuthor(GracefulListView):
+class NotesByAuthor(IdentityMapMixin, CursorListView):
     paginate_by = 10
 
     def get_queryset(self):
         if "username" in self.kwargs:
-            author = get_object_or_404(UserModel, username=self.kwargs["username"])
+            author = self.lookup_object(UserModel, username=self.kwargs["username"])
+            self.author = author
             return (
                 Note.objects.filter(author=author, visibility=Note.Visibility.NORMAL)
-                .select_related("author")
-                .annotate_for_controls(self.request.user)
+                .with_saved(self.request.user)
+                .cards()
             )
 
         raise ImproperlyConfigured("'username' keyword argument not supplied.")
 
+    def get_counter(self):
+        return Counter.Kind.LISTED, self.author.pk
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context["author"] = get_object_or_404(
+        context["author"] = self.lookup_object(
             UserModel, username=self.kwargs["username"]
         )
         return context
 
 
-class MyCollection(LoginRequiredMixin, GracefulListView):
+class MyCollection(LoginRequiredMixin, CursorListView):
     paginate_by = 10
     template_name = "notes/my-collection.html"
+    counter_kind = Counter.Kind.COLLECTED
 
     def get_queryset(self):
-        return self.request.user.collected_notes.select_related(
-            "author"
-        ).annotate_for_controls(self.request.user)
+        # Every note in the collection is saved:
+        return self.request.user.collected_notes.annotate(saved=Value(True)).cards()
 
 
 class MyCollectionByMe(MyCollection):
+    counter_kind = None
+
     def get_queryset(self):
         qs = super().get_queryset()
         return qs.filter(author=self.request.user)
 
 
 class NotInCollectionByMe(MyCollection):
+    counter_kind = None
+
     def get_queryset(self):
         return (
             Note.objects.filter(author=self.request.user)
             .exclude(collectors=self.request.user)
-            .select_related("author")
-            .annotate_for_controls(self.request.user)
+            .annotate(saved=Value(False))
+            .cards()
         )
 
 
 class MyCollectionByOthers(MyCollection):
+    counter_kind = None
+
     def get_queryset(self):
         qs = super().get_queryset()
         return qs.exclude(author=self.request.user)
 
 
 class MyCollectionPromoted(MyCollection):
+    counter_kind = None
+
     def get_queryset(self):
         return (
             Note.objects.filter(collectors=self.request.user, collection__promoted=True)
-            .select_related("author")
-            .annotate_for_controls(self.request.user)
+            .annotate(saved=Value(True))
+            .cards()
         )
 
 
@@ -149,12 +203,14 @@ class SingleNote(DetailView):
         return (
             super()
             .get_queryset()
-            .annotate_for_controls(self.request.user)
+            .with_saved(self.request.user)
             .select_related("author")
         )
 
 
-class ChangeNoteVisibility(LoginRequiredMixin, SuccessMessageMixin, UpdateView):
+class ChangeNoteVisibility(
+    LoginRequiredMixin, IdentityMapMixin, SuccessMessageMixin, UpdateView
+):
     model = Note
     slug_field = "code"
     fields = ["visibility"]
@@ -194,12 +250,17 @@ class ChangeNoteVisibility(LoginRequiredMixin, SuccessMessageMixin, UpdateView):
         return redirect_url
 
 
-class DeleteNote(LoginRequiredMixin, DeleteView):
+class DeleteNote(LoginRequiredMixin, IdentityMapMixin, DeleteView):
     model = Note
     slug_field = "code"
 
     def get_queryset(self):
-        return super().get_queryset().select_related("author")
+        return (
+            super()
+            .get_queryset()
+            .select_related("author")
+            .with_saved(self.request.user)
+        )
 
     def blocker(self):
         """
@@ -215,7 +276,7 @@ class DeleteNote(LoginRequiredMixin, DeleteView):
         note = self.get_object()
         if note.author != self.request.user:
             return "not-author"
-        if note.collectors.exclude(pk=self.request.user.pk).count() > 0:
+        if note.collector_count - note.saved > 0:
             return "other-collectors"
         return None
 
@@ -310,9 +371,10 @@ class RestoreAttribution(View):
         return HttpResponseRedirect(reverse("notes:deattributed-notes"))
 
 
-class DeattributedNotes(LoginRequiredMixin, GracefulListView):
+class DeattributedNotes(LoginRequiredMixin, CursorListView):
     paginate_by = 10
     template_name = "notes/deattributed.html"
+    counter_kind = Counter.Kind.DEATTRIBUTED
 
     def get_queryset(self):
         return Deattribution.objects.filter(author=self.request.user).select_related(
@@ -328,11 +390,14 @@ class CollectionAction(LoginRequiredMixin, View):
         if action not in ("save", "unsave"):
             raise ImproperlyConfigured("Invalid 'action' keyword argument.")
 
-        note = get_object_or_404(Note, code=self.kwargs["code"])
+        code = self.kwargs["code"]
         if action == "save":
-            request.user.collected_notes.add(note)
+            results = save_notes(request.user.pk, [code])
         elif action == "unsave":
-            request.user.collected_notes.remove(note)
+            results = unsave_notes(request.user.pk, [code])
+        if code not in results:
+            raise Http404("No note matches the given query.")
+        note_url = SINGLE_NOTE_URL.format(slug=code)
 
         redirect_url = self.request.POST.get("redirect_url", "")
 
@@ -340,11 +405,11 @@ class CollectionAction(LoginRequiredMixin, View):
             success_msg = "Note saved to collection."
         elif action == "unsave":
             success_msg = "Note removed from collection."
-        if redirect_url != note.get_absolute_url():
+        if redirect_url != note_url:
             # Add link to actioned note to help users with undoing actions,
             # unless the user performed the action from the note detail
             # page itself.
-            success_msg += f" <a href='{note.get_absolute_url()}'>"
+            success_msg += f" <a href='{note_url}'>"
             if action == "save":
                 success_msg += "View saved note</a>"
             elif action == "unsave":
@@ -354,13 +419,39 @@ class CollectionAction(LoginRequiredMixin, View):
 
         if url_has_allowed_host_and_scheme(redirect_url, allowed_hosts=None):
             return HttpResponseRedirect(redirect_url)
-        return HttpResponseRedirect(note.get_absolute_url())
+        return HttpResponseRedirect(note_url)
+
+
+class CollectionBulkAction(LoginRequiredMixin, View):
+    """
+    Save, unsave, promote or demote many notes at once. Takes a JSON body
+    like `{"action": "save", "codes": [...]}`, and returns the result for
+    each code (see `notes.collecting.apply_collection_action()`).
+    """
+
+    def post(self, request, *args, **kwargs):
+        try:
+            data = json.loads(request.body)
+            action, codes = data["action"], data["codes"]
+            if (
+                action not in COLLECTION_ACTIONS
+                or not isinstance(codes, list)
+                or len(codes) > COLLECTION_ACTION_MAX_CODES
+                or not all(isinstance(code, str) for code in codes)
+            ):
+                raise ValueError
+        except (KeyError, TypeError, ValueError) as exc:
+            raise BadRequest("Invalid collection action") from exc
+        results = apply_collection_action(request.user.pk, action, codes)
+        return JsonResponse({"action": action, "results": results})
 
 
 class Discover(View):
     def get(self, request, *args, **kwargs):
         if not request.user.is_authenticated:
-            note = Note.objects.get_random()
+            note = get_pooled_note() or Note.objects.get_random()
+        elif (exclude_ids := get_excluded_ids(request.user.pk)) is not None:
+            note = Note.objects.get_random(exclude_ids=exclude_ids)
         else:
             note = Note.objects.get_random(for_user=request.user)
         return render(request, "notes/discover.html", {"note": note})
@@ -369,12 +460,13 @@ class Discover(View):
         if not request.user.is_authenticated:
             raise PermissionDenied
 
-        note = get_object_or_404(Note, code=request.POST.get("code"))
-        request.user.collected_notes.add(note)
+        code = request.POST.get("code")
+        if not code or code not in save_notes(request.user.pk, [code]):
+            raise Http404("No note matches the given query.")
 
         success_msg = (
             "A note has been saved to your collection."
-            + f" <a href='{note.get_absolute_url()}'>View saved note</a>"
+            + f" <a href='{SINGLE_NOTE_URL.format(slug=code)}'>View saved note</a>"
         )
         success_msg = mark_safe(success_msg)
         messages.add_message(request, messages.SUCCESS, success_msg)
@@ -386,17 +478,21 @@ class Drill(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         """Display the Drill start page"""
 
-        collection_size = Collection.objects.filter(user=request.user).count()
-        disable_begin = bool(collection_size < 2)
-        recent_drill_count = Collection.objects.filter(
-            user=request.user,
-            last_drilled__gt=timezone.now() - timezone.timedelta(hours=24),
-        ).count()
+        now = timezone.now()
+        stats = get_drill_stats(request.user.pk)
+        disable_begin = bool(stats.size < 2)
+        recent_drill_count = stats.recent_drill_count(now)
+        due_count, due_count_is_capped = count_due(request.user.pk, now)
 
         return render(
             request,
             "notes/drill.html",
-            {"disable_begin": disable_begin, "recent_drill_count": recent_drill_count},
+            {
+                "disable_begin": disable_begin,
+                "recent_drill_count": recent_drill_count,
+                "due_count": due_count,
+                "due_count_is_capped": due_count_is_capped,
+            },
         )
 
     @staticmethod
@@ -422,76 +518,60 @@ class Drill(LoginRequiredMixin, View):
             weights[index] = p * ((index + 1) / n)
         return weights
 
-    def post(self, request, *args, **kwargs):
-        """Run a drill (do a 'draw'), and also process any pro-/demotion"""
-
-        # ---------------------------------------
-        # Perform promotion/demotion if requested
-        # ---------------------------------------
-
-        # Make sure to filter by user to prevent modifying other users' data!
+    def apply_promotion(self, request):
+        """Perform promotion/demotion if requested"""
         if promote_code := request.POST.get("promote"):
-            updated = Collection.objects.filter(
-                note__code=promote_code, user=request.user
-            ).update(promoted=True)
-            if updated > 0:
+            if note_pk := set_promoted(request.user.pk, promote_code, True):
+                update_drill_sampler(
+                    request.user.pk, DrillSampler.set_promoted, note_pk, True
+                )
                 messages.add_message(
                     request, messages.SUCCESS, "A note has been promoted."
                 )
         if demote_code := request.POST.get("demote"):
-            updated = Collection.objects.filter(
-                note__code=demote_code, user=request.user
-            ).update(promoted=False)
-            if updated > 0:
+            if note_pk := set_promoted(request.user.pk, demote_code, False):
+                update_drill_sampler(
+                    request.user.pk, DrillSampler.set_promoted, note_pk, False
+                )
                 messages.add_message(
                     request, messages.SUCCESS, "A note has been demoted."
                 )
 
-        # -----------------------
-        # Prepare inputs for draw
-        # -----------------------
-
-        values = (
-            Collection.objects.filter(user=request.user)
-            .order_by("-last_drilled")
-            .values_list("id", "note_id", "promoted")
-        )
-        unzipped_values = tuple(zip(*values))
-        # Collection must have at least two notes:
-        if not unzipped_values or len(unzipped_values[0]) < 2:
-            return render(
-                request, "notes/drill.html", {"error": "insufficient-collection"}
-            )
-        # Last-drilled note should not be picked, hence `[1:]`:
-        coll_pks = unzipped_values[0][1:]
-        note_pks = unzipped_values[1][1:]
-        promoted_vals = unzipped_values[2][1:]
-
-        # ----------------
-        # Perform the draw
-        # ----------------
+    def post(self, request, *args, **kwargs):
+        """Run a drill (do a 'draw'), and also process any pro-/demotion"""
 
-        weights = self.generate_weights(promoted_vals)
-        draw_index = random.choices(range(len(weights)), weights)[0]
+        self.apply_promotion(request)
+        now = timezone.now()
 
-        # ------------------------------------
-        # Update the drawn note's last_drilled
-        # ------------------------------------
+        # ----------------------------------------------------
+        # Perform the draw, and update the note's last_drilled
+        # ----------------------------------------------------
 
-        Collection.objects.filter(id=coll_pks[draw_index]).update(
-            last_drilled=timezone.now()
+        while True:
+            note_pk = pop_drill_card(request.user.pk)
+            # Collection must have at least two notes:
+            if note_pk is None:
+                return render(
+                    request, "notes/drill.html", {"error": "insufficient-collection"}
+                )
+            if stamped := stamp_drilled(request.user.pk, note_pk, now):
+                promoted, previous_drilled = stamped
+                break
+            # The sampler is out of date (e.g., the note was unsaved in a way
+            # that bypassed signals):
+            invalidate_drill_sampler(request.user.pk)
+
+        # Statistics rebuilt on a cache miss already include this drill:
+        update_drill_stats(
+            request.user.pk, DrillStats.record_drill, previous_drilled, now
         )
+        recent_drill_count = get_drill_stats(request.user.pk).recent_drill_count(now)
 
         # ----------------------------------------
         # Prepare context data, and finally render
         # ----------------------------------------
 
-        note = Note.objects.select_related("author").get(pk=note_pks[draw_index])
-        promoted = Collection.objects.get(id=coll_pks[draw_index]).promoted
-        recent_drill_count = Collection.objects.filter(
-            user=request.user,
-            last_drilled__gt=timezone.now() - timezone.timedelta(hours=24),
-        ).count()
+        note = Note.objects.select_related("author").get(pk=note_pk)
         return render(
             request,
             "notes/drill.html",
@@ -503,5 +583,99 @@ class Drill(LoginRequiredMixin, View):
         )
 
 
+class DrillDue(Drill):
+    """Review due notes in spaced-repetition mode."""
+
+    http_method_names = ["post"]
+
+    def post(self, request, *args, **kwargs):
+        """Record a review if given, and present the next due note"""
+
+        self.apply_promotion(request)
+        if review_code := request.POST.get("review"):
+            if (result := request.POST.get("result")) not in REVIEW_RESULTS:
+                raise BadRequest("Invalid review result")
+            review_note(request.user.pk, review_code, result)
+
+        now = timezone.now()
+        due_count, due_count_is_capped = count_due(request.user.pk, now)
+        context = {
+            "due_mode": True,
+            "due_count": due_count,
+            "due_count_is_capped": due_count_is_capped,
+        }
+        if collection := get_next_due(request.user.pk, now):
+            context["note"] = collection.note
+            context["promoted"] = collection.promoted
+        else:
+            context["next_due_at"] = (
+                Collection.objects.filter(user=request.user)
+                .order_by("due_at")
+                .values_list("due_at", flat=True)
+                .first()
+            )
+        return render(request, "notes/drill.html", context)
+
+
+class DrillSnapshot(LoginRequiredMixin, View):
+    """Compact snapshot of the user's collection for offline drills."""
+
+    def get(self, request, *args, **kwargs):
+        items = (
+            Collection.objects.filter(user=request.user)
+            .order_by("last_drilled", "pk")
+            .values_list(
+                "note__code",
+                "note__html_rendered",
+                "note__html_renderer_version",
+                "note__text",
+                "promoted",
+            )
+        )
+        # Notes are least recently drilled first, as `[code, html, promoted]`:
+        notes = [
+            [
+                code,
+                (
+                    html
+                    if version == Note.HTML_RENDERER_VERSION
+                    else renderer.render(text)
+                ),
+                promoted,
+            ]
+            for code, html, version, text, promoted in items
+        ]
+        return JsonResponse({"notes": notes})
+
+
+class DrillSync(LoginRequiredMixin, View):
+    """Apply a batch of drill events recorded by the offline drill runner."""
+
+    @staticmethod
+    def parse_event(event):
+        drilled_at = parse_datetime(event["drilled_at"])
+        promoted = event.get("promoted")
+        if (
+            not isinstance(event["code"], str)
+            or drilled_at is None
+            or timezone.is_naive(drilled_at)
+            or promoted not in (None, True, False)
+        ):
+            raise ValueError
+        # Guard against clients with clocks that are ahead:
+        return event["code"], min(drilled_at, timezone.now()), promoted
+
+    def post(self, request, *args, **kwargs):
+        try:
+            events = json.loads(request.body)["events"]
+            if len(events) > DRILL_SYNC_MAX_EVENTS:
+                raise ValueError
+            events = [self.parse_event(event) for event in events]
+        except (KeyError, TypeError, ValueError) as exc:
+            raise BadRequest("Invalid drill events") from exc
+        unknown = apply_drill_events(request.user.pk, events)
+        return JsonResponse({"synced": len(events), "unknown": sorted(unknown)})
+
+
 class Start(TemplateView):
     template_name = "notes/start.html"